@@ -1,14 +1,28 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
+import asyncio
+import base64
+import contextvars
 import sqlite3
 import hashlib
+import hmac
+import json
 import jwt
+import math
 import datetime
 import os
+import queue
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 
 # 创建FastAPI应用
@@ -32,11 +46,93 @@ JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# 已验证token缓存配置
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))  # 缓存条目最长存活秒数，且不会超过token自身的exp
+TOKEN_REVOKED_MAX = int(os.getenv("TOKEN_REVOKED_MAX", "100000"))  # 已吊销token记录的上限
+
+# 密码哈希配置
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", "12"))  # bcrypt cost
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(max((os.cpu_count() or 2) - 1, 1))))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "64"))  # 排队中的哈希任务上限，超过直接返回503
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", "10"))
+
 # 安全认证
 security = HTTPBearer()
 
 # 数据库路径
-DB_PATH = Path(__file__).parent / "game.db"
+DB_PATH = Path(os.getenv("DB_PATH", Path(__file__).parent / "game.db"))
+
+# 数据库连接池配置
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # 等待空闲连接的秒数
+DB_CONN_MAX_AGE = float(os.getenv("DB_CONN_MAX_AGE", "3600"))  # 连接最长存活秒数
+DB_CONN_MAX_USES = int(os.getenv("DB_CONN_MAX_USES", "0"))  # 单个连接最多借出次数，0表示不限
+DB_HEALTHCHECK_IDLE = 30  # 空闲超过该秒数的连接在借出前做一次健康检查
+DB_BUSY_TIMEOUT_MS = 5000
+DB_BUSY_RETRIES = int(os.getenv("DB_BUSY_RETRIES", "3"))  # 写事务仍报 database is locked 时的重试次数
+DB_BUSY_RETRY_BASE_MS = float(os.getenv("DB_BUSY_RETRY_BASE_MS", "20"))  # 重试退避的基准毫秒数，按次数翻倍并加随机抖动
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # 需要每次提交都落盘时设为 FULL
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+# 数据库执行层配置
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+DB_MAX_QUEUE = int(os.getenv("DB_MAX_QUEUE", "256"))  # 排队中的数据库任务上限，超过直接返回503
+DB_TASK_TIMEOUT = float(os.getenv("DB_TASK_TIMEOUT", "10"))  # 单个数据库任务的超时秒数
+
+# 积分写入流水线配置：多条游戏记录合并到一个事务中提交
+EARN_BATCH_MAX = int(os.getenv("EARN_BATCH_MAX", "64"))  # 单个事务最多合并的记录数
+EARN_BATCH_WAIT_MS = float(os.getenv("EARN_BATCH_WAIT_MS", "5"))  # 凑批最长等待毫秒数
+EARN_QUEUE_MAX = int(os.getenv("EARN_QUEUE_MAX", "2048"))  # 等待写入的记录上限，超过直接返回503
+
+# 批量提交游戏记录的限制
+EARN_BATCH_MAX_RECORDS = int(os.getenv("EARN_BATCH_MAX_RECORDS", "50"))
+EARN_BATCH_MAX_BYTES = int(os.getenv("EARN_BATCH_MAX_BYTES", "65536"))
+GAME_RESULTS = ('win', 'lose', 'draw')
+
+# 积分历史分页配置
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+HISTORY_EXPORT_CHUNK = int(os.getenv("HISTORY_EXPORT_CHUNK", "1000"))  # 导出时每次查询的行数
+
+# 分时段排行榜配置：按日、周、赛季汇总积分，过期的时段定期删除
+SEASON_MONTHS = int(os.getenv("SEASON_MONTHS", "3"))  # 每个赛季的月数，需能整除12
+ROLLUP_RETENTION = {
+    "day": int(os.getenv("ROLLUP_RETENTION_DAYS", "14")),
+    "week": int(os.getenv("ROLLUP_RETENTION_WEEKS", "12")),
+    "season": int(os.getenv("ROLLUP_RETENTION_SEASONS", "8")),
+}
+ROLLUP_EXPIRE_INTERVAL = float(os.getenv("ROLLUP_EXPIRE_INTERVAL", "3600"))  # 清理过期时段的间隔秒数
+
+# 历史记录归档配置：较早的游戏记录分批移到独立的归档库，主库的表和索引保持小巧
+ARCHIVE_DB_PATH = Path(os.getenv("ARCHIVE_DB_PATH", DB_PATH.with_name(DB_PATH.stem + ".archive.db")))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))  # 早于该天数的记录会被归档，0表示不归档
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))  # 每个事务移动的记录数，控制持有写锁的时间
+ARCHIVE_BATCH_PAUSE_MS = float(os.getenv("ARCHIVE_BATCH_PAUSE_MS", "50"))  # 两批之间让出写锁的毫秒数
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "600"))  # 后台归档的检查间隔秒数
+ARCHIVE_VACUUM_PAGES = int(os.getenv("ARCHIVE_VACUUM_PAGES", "2000"))  # 每轮归档后回收的空闲页数（需 auto_vacuum=INCREMENTAL）
+
+# 监控指标配置
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # 秒
+METRICS_STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)  # 每个请求执行的SQL语句数
+
+# 限流配置：令牌桶，rate 为每秒补充的令牌数，burst 为桶容量
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_USER_READ = (float(os.getenv("RATE_USER_READ_PER_SEC", "10")), float(os.getenv("RATE_USER_READ_BURST", "30")))
+RATE_USER_WRITE = (float(os.getenv("RATE_USER_WRITE_PER_SEC", "2")), float(os.getenv("RATE_USER_WRITE_BURST", "10")))
+RATE_IP_READ = (float(os.getenv("RATE_IP_READ_PER_SEC", "50")), float(os.getenv("RATE_IP_READ_BURST", "100")))
+RATE_IP_WRITE = (float(os.getenv("RATE_IP_WRITE_PER_SEC", "10")), float(os.getenv("RATE_IP_WRITE_BURST", "30")))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))  # 每类令牌桶最多跟踪的键数，超过按LRU淘汰
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"  # 部署在反向代理后时按 X-Forwarded-For 取客户端IP
+WRITE_MAX_CONCURRENCY = int(os.getenv("WRITE_MAX_CONCURRENCY", "32"))  # 同时处理中的写请求上限
 
 # Pydantic模型
 class UserRegister(BaseModel):
@@ -58,6 +154,12 @@ class GameRecord(BaseModel):
     sets_won: int
     sets_lost: int
 
+class BatchGameRecord(GameRecord):
+    played_at: Optional[datetime.datetime] = None  # 客户端记录的比赛结束时间（离线缓存的对局）
+
+class GameRecordBatch(BaseModel):
+    records: List[BatchGameRecord]
+
 class PurchaseItem(BaseModel):
     item_id: int
     item_type: str
@@ -66,11 +168,8 @@ class EquipItem(BaseModel):
     item_id: int
     item_type: str
 
-# 数据库初始化
-def init_database():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+# 数据库迁移：按版本号顺序执行，每个迁移都必须可以安全地重复执行
+def _migration_initial_schema(cursor):
     # 用户表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -134,575 +233,3847 @@ def init_database():
         )
     ''')
     
-    # 插入默认商店物品
-    default_items = [
-        # 球拍
-        ('专业球拍', 'racket', 800, '提升击球力量和精准度', '/images/racket_pro.png', '{"power": 10, "accuracy": 15}', True),
-        ('高级球拍', 'racket', 1500, '显著提升所有属性', '/images/racket_advanced.png', '{"power": 20, "accuracy": 25, "speed": 10}', True),
-        ('传奇球拍', 'racket', 3000, '顶级球拍，全面提升', '/images/racket_legendary.png', '{"power": 35, "accuracy": 40, "speed": 20}', True),
-        
-        # 服装
-        ('运动套装', 'outfit', 300, '专业运动员套装', '/images/outfit_sport.png', '{"speed": 5, "stamina": 10}', True),
-        ('休闲装', 'outfit', 200, '舒适的休闲运动装', '/images/outfit_casual.png', '{"comfort": 10}', True),
-        ('科技战衣', 'outfit', 1000, '未来科技风格战衣', '/images/outfit_tech.png', '{"power": 15, "speed": 15, "accuracy": 10}', True),
-        ('传奇战袍', 'outfit', 2500, '传说中的战袍', '/images/outfit_legendary.png', '{"power": 25, "speed": 25, "accuracy": 20, "stamina": 20}', True),
-        
-        # 配饰
-        ('能量头带', 'accessory', 150, '增加专注力', '/images/headband_energy.png', '{"accuracy": 8}', True),
-        ('力量护腕', 'accessory', 200, '增强击球力量', '/images/wristband_power.png', '{"power": 12}', True),
-        ('速度靴', 'accessory', 250, '提升移动速度', '/images/shoes_speed.png', '{"speed": 15}', True),
-        ('光环特效', 'accessory', 500, '炫酷的光环特效', '/images/aura_effect.png', '{"charisma": 100}', True),
-        
-        # 道具
-        ('双倍积分卡', 'consumable', 500, '下一场比赛获得双倍积分', '/images/card_double_points.png', '{"effect": "double_points"}', True),
-        ('技能加成卡', 'consumable', 200, '临时提升所有属性', '/images/card_skill_boost.png', '{"effect": "skill_boost"}', True),
-        ('幸运加成卡', 'consumable', 300, '增加获得稀有奖励的几率', '/images/card_lucky.png', '{"effect": "lucky_boost"}', True),
-    ]
+def _migration_hot_query_indexes(cursor):
+    # 唯一索引建立前先清理历史遗留的重复物品，保留最早的一条
+    cursor.execute('''
+        DELETE FROM user_items WHERE id NOT IN (
+            SELECT MIN(id) FROM user_items GROUP BY user_id, item_type, item_id
+        )
+    ''')
+
+    # 积分历史和游戏统计：WHERE user_id = ? ORDER BY created_at DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_records_user_created ON game_records (user_id, created_at)")
+    # 排行榜：ORDER BY total_points DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_total_points ON users (total_points DESC)")
+    # 购买/装备时的物品归属检查，同时保证同一物品不会重复拥有
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_items_owner ON user_items (user_id, item_type, item_id)")
+
+def _migration_cache_versions(cursor):
+    # 进程内缓存的版本号，对应数据表的任何改动都会通过触发器递增版本
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('catalog')")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_shop_items_{event.lower()}_catalog
+            AFTER {event} ON shop_items
+            BEGIN
+                UPDATE cache_versions SET version = version + 1 WHERE name = 'catalog';
+            END
+        ''')
+
+def _migration_user_stats(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            games INTEGER NOT NULL DEFAULT 0,
+            current_win_streak INTEGER NOT NULL DEFAULT 0,
+            best_win_streak INTEGER NOT NULL DEFAULT 0,
+            total_play_time INTEGER NOT NULL DEFAULT 0,
+            total_score_margin INTEGER NOT NULL DEFAULT 0,
+            sets_won INTEGER NOT NULL DEFAULT 0,
+            sets_lost INTEGER NOT NULL DEFAULT 0,
+            game_types TEXT NOT NULL DEFAULT '{}',  -- JSON：每种 game_type 的胜/负/平场数
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # 已有数据库一次性从历史记录回填。回填语句固定写在迁移中，不调用 _rebuild_user_stats：
+    # 迁移的行为不能随后续修改的代码而改变。连胜按“非胜场出现次数”把比赛切成段，最后一段的胜场数即当前连胜
+    cursor.execute('''
+        INSERT OR REPLACE INTO user_stats (user_id, games, current_win_streak, best_win_streak, total_play_time,
+                                           total_score_margin, sets_won, sets_lost, game_types)
+        WITH ordered AS (
+            SELECT user_id, result,
+                   SUM(result != 'win') OVER (PARTITION BY user_id ORDER BY created_at, id) AS run
+            FROM game_records
+        ),
+        runs AS (
+            SELECT user_id, run, SUM(result = 'win') AS wins FROM ordered GROUP BY user_id, run
+        ),
+        best AS (
+            SELECT user_id, MAX(wins) AS best_win_streak FROM runs GROUP BY user_id
+        ),
+        latest AS (
+            SELECT user_id, wins AS current_win_streak, MAX(run) FROM runs GROUP BY user_id
+        ),
+        type_counts AS (
+            SELECT user_id, game_type, SUM(result = 'win') AS wins, SUM(result NOT IN ('win', 'draw')) AS losses,
+                   SUM(result = 'draw') AS draws
+            FROM game_records GROUP BY user_id, game_type
+        ),
+        types AS (
+            SELECT user_id, json_group_object(game_type, json_object('wins', wins, 'losses', losses, 'draws', draws)) AS game_types
+            FROM type_counts GROUP BY user_id
+        ),
+        totals AS (
+            SELECT user_id, COUNT(*) AS games, SUM(duration) AS total_play_time,
+                   SUM(player_score - ai_score) AS total_score_margin, SUM(sets_won) AS sets_won, SUM(sets_lost) AS sets_lost
+            FROM game_records GROUP BY user_id
+        )
+        SELECT t.user_id, t.games, l.current_win_streak, b.best_win_streak, t.total_play_time,
+               t.total_score_margin, t.sets_won, t.sets_lost, ty.game_types
+        FROM totals t
+        JOIN best b ON b.user_id = t.user_id
+        JOIN latest l ON l.user_id = t.user_id
+        JOIN types ty ON ty.user_id = t.user_id
+    ''')
+
+def _migration_points_rollups(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS points_rollups (
+            period TEXT NOT NULL,  -- day / week / season
+            bucket TEXT NOT NULL,  -- 2024-05-01 / 2024-W18 / 2024-S02
+            user_id INTEGER NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            games INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket, user_id)
+        ) WITHOUT ROWID
+    ''')
+    # 时段排行榜沿该索引按积分顺序读取，不需要排序
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_points_rollups_rank ON points_rollups (period, bucket, points DESC, user_id)")
+
+    # 迁移中不回填：按保留期回填的结果取决于执行时间和 SEASON_MONTHS 等配置，迁移的结果不能随之变化。
+    # 只标记待重建，启动后由后台任务调用 rebuild_rollups 完成，期间的增量更新会在重建时一并重新计算
+    cursor.execute("INSERT OR REPLACE INTO cache_versions (name, version) VALUES ('rollups_rebuild', 1)")
+
+# 默认商店物品，以名称作为唯一键
+DEFAULT_SHOP_ITEMS = [
+    # 球拍
+    ('专业球拍', 'racket', 800, '提升击球力量和精准度', '/images/racket_pro.png', '{"power": 10, "accuracy": 15}', True),
+    ('高级球拍', 'racket', 1500, '显著提升所有属性', '/images/racket_advanced.png', '{"power": 20, "accuracy": 25, "speed": 10}', True),
+    ('传奇球拍', 'racket', 3000, '顶级球拍，全面提升', '/images/racket_legendary.png', '{"power": 35, "accuracy": 40, "speed": 20}', True),
+    
+    # 服装
+    ('运动套装', 'outfit', 300, '专业运动员套装', '/images/outfit_sport.png', '{"speed": 5, "stamina": 10}', True),
+    ('休闲装', 'outfit', 200, '舒适的休闲运动装', '/images/outfit_casual.png', '{"comfort": 10}', True),
+    ('科技战衣', 'outfit', 1000, '未来科技风格战衣', '/images/outfit_tech.png', '{"power": 15, "speed": 15, "accuracy": 10}', True),
+    ('传奇战袍', 'outfit', 2500, '传说中的战袍', '/images/outfit_legendary.png', '{"power": 25, "speed": 25, "accuracy": 20, "stamina": 20}', True),
     
+    # 配饰
+    ('能量头带', 'accessory', 150, '增加专注力', '/images/headband_energy.png', '{"accuracy": 8}', True),
+    ('力量护腕', 'accessory', 200, '增强击球力量', '/images/wristband_power.png', '{"power": 12}', True),
+    ('速度靴', 'accessory', 250, '提升移动速度', '/images/shoes_speed.png', '{"speed": 15}', True),
+    ('光环特效', 'accessory', 500, '炫酷的光环特效', '/images/aura_effect.png', '{"charisma": 100}', True),
+    
+    # 道具
+    ('双倍积分卡', 'consumable', 500, '下一场比赛获得双倍积分', '/images/card_double_points.png', '{"effect": "double_points"}', True),
+    ('技能加成卡', 'consumable', 200, '临时提升所有属性', '/images/card_skill_boost.png', '{"effect": "skill_boost"}', True),
+    ('幸运加成卡', 'consumable', 300, '增加获得稀有奖励的几率', '/images/card_lucky.png', '{"effect": "lucky_boost"}', True),
+]
+
+def seed_shop_items(cursor):
     cursor.executemany('''
         INSERT OR IGNORE INTO shop_items (name, type, price, description, image_url, attributes, is_available)
         VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', default_items)
-    
-    conn.commit()
-    conn.close()
+    ''', DEFAULT_SHOP_ITEMS)
 
-# 工具函数
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+def _migration_shop_items_unique_name(cursor):
+    # 旧版本每次启动都会重复插入默认物品，先把重复物品合并到id最小的那一条
+    cursor.execute("SELECT name, MIN(id) FROM shop_items GROUP BY name HAVING COUNT(*) > 1")
+    for name, keep_id in cursor.fetchall():
+        cursor.execute("SELECT id FROM shop_items WHERE name = ? AND id != ?", (name, keep_id))
+        for (duplicate_id,) in cursor.fetchall():
+            # 同时拥有两份的用户：保留的那份继承装备状态，重复的那份删除
+            cursor.execute('''
+                UPDATE user_items SET is_equipped = TRUE
+                WHERE item_id = ? AND user_id IN (SELECT user_id FROM user_items WHERE item_id = ? AND is_equipped)
+            ''', (keep_id, duplicate_id))
+            cursor.execute('''
+                DELETE FROM user_items WHERE item_id = ? AND EXISTS (
+                    SELECT 1 FROM user_items AS owned
+                    WHERE owned.user_id = user_items.user_id AND owned.item_type = user_items.item_type AND owned.item_id = ?
+                )
+            ''', (duplicate_id, keep_id))
+            cursor.execute("UPDATE user_items SET item_id = ? WHERE item_id = ?", (keep_id, duplicate_id))
+        cursor.execute("DELETE FROM shop_items WHERE name = ? AND id != ?", (name, keep_id))
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_shop_items_name ON shop_items (name)")
+    seed_shop_items(cursor)
 
-def verify_password(password: str, hashed: str) -> bool:
-    return hash_password(password) == hashed
+# 跨进程缓存失效：任何连接（包括其他 worker 进程）提交的改动都由触发器写入 cache_changes，
+# 各进程按 seq 增量把改动应用到自己的内存缓存
+CACHE_CHANGE_TRIGGERS = (
+    ("users_insert_leaderboard", "AFTER INSERT ON users", "'leaderboard', NEW.id"),
+    ("users_update_leaderboard", "AFTER UPDATE OF username, total_points, games_played, games_won ON users", "'leaderboard', NEW.id"),
+    ("user_items_insert_loadout", "AFTER INSERT ON user_items", "'loadout', NEW.user_id"),
+    ("user_items_update_loadout", "AFTER UPDATE OF is_equipped ON user_items WHEN OLD.is_equipped IS NOT NEW.is_equipped", "'loadout', NEW.user_id"),
+    ("user_items_delete_loadout", "AFTER DELETE ON user_items", "'loadout', OLD.user_id"),
+    ("shop_items_insert_changes", "AFTER INSERT ON shop_items", "'catalog', NULL"),
+    ("shop_items_update_changes", "AFTER UPDATE ON shop_items", "'catalog', NULL"),
+    ("shop_items_delete_changes", "AFTER DELETE ON shop_items", "'catalog', NULL"),
+    ("revoked_tokens_insert_token", "AFTER INSERT ON revoked_tokens", "'token', NEW.digest"),
+)
 
-def create_jwt_token(user_id: int, username: str) -> str:
-    payload = {
-        'user_id': user_id,
-        'username': username,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=JWT_EXPIRATION_HOURS)
+def _migration_cache_changes(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            cache TEXT NOT NULL,
+            key
+        )
+    ''')
+    # 已登出的token：原来只记在进程内，其他 worker 和重启后的进程都看不到
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            digest BLOB PRIMARY KEY,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # 已清理的最大 seq：落后于它的进程无法增量同步，需要整体重建缓存
+    cursor.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('cache_changes_floor')")
+    for name, event, values in CACHE_CHANGE_TRIGGERS:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{name}
+            {event}
+            BEGIN
+                INSERT INTO cache_changes (cache, key) VALUES ({values});
+            END
+        ''')
+
+def _migration_balance_changes(cursor):
+    # 余额变化也写入日志，推送连接所在的 worker 据此给客户端推送其他 worker 上发生的消费
+    cursor.execute("DROP TRIGGER IF EXISTS trg_users_update_leaderboard")
+    cursor.execute('''
+        CREATE TRIGGER trg_users_update_leaderboard
+        AFTER UPDATE OF username, total_points, current_points, games_played, games_won ON users
+        BEGIN
+            INSERT INTO cache_changes (cache, key) VALUES ('leaderboard', NEW.id);
+        END
+    ''')
+
+def _migration_idempotency_keys(cursor):
+    # 幂等键：只保存请求指纹和响应内容，过期后由后台任务清理
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint BLOB NOT NULL,
+            response BLOB NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)")
+
+def _migration_user_ratings(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_ratings (
+            user_id INTEGER NOT NULL,
+            game_type TEXT NOT NULL,
+            rating REAL NOT NULL,
+            games INTEGER NOT NULL,
+            PRIMARY KEY (user_id, game_type)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_ratings_rank ON user_ratings (game_type, rating DESC, user_id, games)")
+    # 迁移中不计算评分：重放需要读取归档库，而迁移连接没有挂载归档库，且评分公式会随参数调整。
+    # 只标记待重算，启动后由后台任务调用 recompute_ratings 完成，期间的增量更新会在重算结束时被覆盖
+    cursor.execute("INSERT OR REPLACE INTO cache_versions (name, version) VALUES ('ratings_recompute', 1)")
+
+def _migration_cache_changes_origin(cursor):
+    # 写入改动的进程：连接池的连接由临时触发器填写，同步时跳过本进程自己写入的改动；
+    # 其他连接（命令行工具、手工修改）写入的为 NULL，所有进程都会应用
+    # SQLite 没有 ADD COLUMN IF NOT EXISTS：先查看已有的列，重复执行时跳过
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(cache_changes)")]
+    if "origin" not in columns:
+        cursor.execute("ALTER TABLE cache_changes ADD COLUMN origin INTEGER")
+
+def _migration_push_tickets(cursor):
+    # 推送连接票据：只保存票据摘要，兑换时删除；放在数据库中，换票和建立连接可以落在不同的 worker 上
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS push_tickets (
+            digest BLOB PRIMARY KEY,
+            token_digest BLOB NOT NULL,
+            payload BLOB NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_push_tickets_expires ON push_tickets(expires_at)")
+
+MIGRATIONS = [
+    (1, "初始表结构", _migration_initial_schema),
+    (2, "热点查询索引", _migration_hot_query_indexes),
+    (3, "缓存版本号", _migration_cache_versions),
+    (4, "用户统计物化表", _migration_user_stats),
+    (5, "商店物品名称唯一并写入默认物品", _migration_shop_items_unique_name),
+    (6, "分时段积分汇总表", _migration_points_rollups),
+    (7, "跨进程缓存失效日志", _migration_cache_changes),
+    (8, "余额变化写入缓存失效日志", _migration_balance_changes),
+    (9, "写请求幂等键", _migration_idempotency_keys),
+    (10, "技术评分", _migration_user_ratings),
+    (11, "缓存失效日志记录写入进程", _migration_cache_changes_origin),
+    (12, "推送连接票据", _migration_push_tickets),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn) -> int:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(conn):
+    for version, description, migration in MIGRATIONS:
+        # 每个迁移独占一个写事务，多个进程同时启动时只有一个会真正执行
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            cursor = conn.cursor()
+            migration(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            # user_version 位于数据库文件头，启动时据此判断是否需要迁移
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# 用户统计：在积分写入路径上增量维护，查询时只需按主键读取一行
+def _empty_user_stats() -> dict:
+    return {
+        "games": 0,
+        "current_win_streak": 0,
+        "best_win_streak": 0,
+        "total_play_time": 0,
+        "total_score_margin": 0,
+        "sets_won": 0,
+        "sets_lost": 0,
+        "game_types": {}
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def verify_jwt_token(token: str) -> dict:
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token已过期")
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="无效的token")
+def _fold_user_stats(stats: dict, game_type, result, duration, player_score, ai_score, sets_won, sets_lost):
+    stats["games"] += 1
+    if result == 'win':
+        stats["current_win_streak"] += 1
+        stats["best_win_streak"] = max(stats["best_win_streak"], stats["current_win_streak"])
+    else:
+        stats["current_win_streak"] = 0
+    stats["total_play_time"] += duration
+    stats["total_score_margin"] += player_score - ai_score
+    stats["sets_won"] += sets_won
+    stats["sets_lost"] += sets_lost
+    by_type = stats["game_types"].setdefault(game_type, {"wins": 0, "losses": 0, "draws": 0})
+    if result == 'win':
+        by_type["wins"] += 1
+    elif result == 'draw':
+        by_type["draws"] += 1
+    else:
+        by_type["losses"] += 1
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    payload = verify_jwt_token(token)
-    return payload
+def _stats_row(user_id: int, stats: dict) -> tuple:
+    return (
+        user_id, stats["games"], stats["current_win_streak"], stats["best_win_streak"],
+        stats["total_play_time"], stats["total_score_margin"], stats["sets_won"], stats["sets_lost"],
+        json.dumps(stats["game_types"], ensure_ascii=False)
+    )
 
-def get_db_connection():
-    return sqlite3.connect(DB_PATH)
+USER_STATS_UPSERT = '''
+    INSERT OR REPLACE INTO user_stats (user_id, games, current_win_streak, best_win_streak, total_play_time,
+                                       total_score_margin, sets_won, sets_lost, game_types)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
 
-# API路由
-@app.on_event("startup")
-async def startup_event():
-    init_database()
+def _update_user_stats(cursor, user_id: int, records):
+    # records 需按比赛先后顺序排列
+    cursor.execute(
+        "SELECT games, current_win_streak, best_win_streak, total_play_time, total_score_margin, sets_won, sets_lost, game_types FROM user_stats WHERE user_id = ?",
+        (user_id,)
+    )
+    row = cursor.fetchone()
+    stats = _empty_user_stats()
+    if row:
+        stats.update(zip(stats.keys(), row))
+        stats["game_types"] = json.loads(row[7])
+    for record in records:
+        _fold_user_stats(stats, record.game_type, record.result, record.duration,
+                         record.player_score, record.ai_score, record.sets_won, record.sets_lost)
+    cursor.execute(USER_STATS_UPSERT, _stats_row(user_id, stats))
 
-@app.get("/")
-async def root():
-    return {"message": "羽毛球游戏API服务正在运行"}
+def _rebuild_user_stats(cursor, chunk_size: int = 1000):
+    # 按 (user_id, created_at) 索引顺序流式读取全部历史，内存中只保留当前用户的统计
+    cursor.execute("DELETE FROM user_stats")
+    reader = cursor.connection.cursor()
+    reader.execute(
+        f"SELECT user_id, game_type, result, duration, player_score, ai_score, sets_won, sets_lost FROM {game_records_source(cursor.connection)} ORDER BY user_id, created_at, id"
+    )
+    pending = []
+    current_user, stats = None, None
+    while True:
+        rows = reader.fetchmany(chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            if row[0] != current_user:
+                if current_user is not None:
+                    pending.append(_stats_row(current_user, stats))
+                current_user, stats = row[0], _empty_user_stats()
+            _fold_user_stats(stats, *row[1:])
+        if len(pending) >= chunk_size:
+            cursor.executemany(USER_STATS_UPSERT, pending)
+            pending = []
+    if current_user is not None:
+        pending.append(_stats_row(current_user, stats))
+    cursor.executemany(USER_STATS_UPSERT, pending)
 
-# 用户认证相关API
-@app.post("/api/auth/register")
-async def register(user: UserRegister):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def backfill_user_stats(conn):
+    # 一次性任务：从 game_records 全量重建 user_stats，执行期间阻塞其他写入以保证一致
+    attach_archive(conn)
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        # 检查用户名和邮箱是否已存在
-        cursor.execute("SELECT id FROM users WHERE username = ? OR email = ?", (user.username, user.email))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="用户名或邮箱已存在")
-        
-        # 创建新用户
-        password_hash = hash_password(user.password)
-        cursor.execute(
-            "INSERT INTO users (username, email, password_hash, current_points) VALUES (?, ?, ?, ?)",
-            (user.username, user.email, password_hash, 1000)  # 新用户赠送1000积分
-        )
-        user_id = cursor.lastrowid
-        
-        # 给新用户添加基础装备
-        cursor.execute(
-            "INSERT INTO user_items (user_id, item_type, item_id, item_name, is_equipped) VALUES (?, ?, ?, ?, ?)",
-            (user_id, 'racket', 0, '基础球拍', True)
-        )
-        cursor.execute(
-            "INSERT INTO user_items (user_id, item_type, item_id, item_name, is_equipped) VALUES (?, ?, ?, ?, ?)",
-            (user_id, 'outfit', 0, '基础服装', True)
-        )
-        
+        _rebuild_user_stats(conn.cursor())
         conn.commit()
-        
-        # 生成JWT token
-        token = create_jwt_token(user_id, user.username)
-        
-        return {
-            "message": "注册成功",
-            "token": token,
-            "user": {
-                "id": user_id,
-                "username": user.username,
-                "email": user.email,
-                "current_points": 1000
-            }
-        }
-    
-    except Exception as e:
+    except Exception:
         conn.rollback()
-        raise HTTPException(status_code=500, detail=f"注册失败: {str(e)}")
+        raise
+    return conn.execute("SELECT COUNT(*) FROM user_stats").fetchone()[0]
+
+# 分时段积分汇总：每条游戏记录累加到所在的日、周、赛季时段
+ROLLUP_PERIODS = ("day", "week", "season")
+ROLLUP_UPSERT = '''
+    INSERT INTO points_rollups (period, bucket, user_id, points, games, wins) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (period, bucket, user_id) DO UPDATE SET
+        points = points + excluded.points, games = games + excluded.games, wins = wins + excluded.wins
+'''
+
+def rollup_bucket(period: str, ts: datetime.datetime) -> str:
+    # 时段名按字典序与时间顺序一致，过期清理直接按字符串比较
+    if period == "day":
+        return ts.strftime("%Y-%m-%d")
+    if period == "week":
+        year, week, _ = ts.isocalendar()
+        return f"{year}-W{week:02d}"
+    return f"{ts.year}-S{(ts.month - 1) // SEASON_MONTHS + 1:02d}"
+
+def rollup_bucket_start(period: str, bucket: str) -> datetime.datetime:
+    if period == "day":
+        return datetime.datetime.strptime(bucket, "%Y-%m-%d")
+    if period == "week":
+        return datetime.datetime.strptime(bucket + "-1", "%G-W%V-%u")
+    year, season = bucket.split("-S")
+    return datetime.datetime(int(year), (int(season) - 1) * SEASON_MONTHS + 1, 1)
+
+def rollup_cutoffs(now: datetime.datetime) -> dict:
+    # 每种时段最早保留的时段名（含），更早的时段视为过期
+    season_start = datetime.datetime(now.year, (now.month - 1) // SEASON_MONTHS * SEASON_MONTHS + 1, 1)
+    months = season_start.year * 12 + season_start.month - 1 - (ROLLUP_RETENTION["season"] - 1) * SEASON_MONTHS
+    return {
+        "day": rollup_bucket("day", now - datetime.timedelta(days=ROLLUP_RETENTION["day"] - 1)),
+        "week": rollup_bucket("week", now - datetime.timedelta(weeks=ROLLUP_RETENTION["week"] - 1)),
+        "season": rollup_bucket("season", datetime.datetime(months // 12, months % 12 + 1, 1)),
+    }
+
+def _fold_rollups(totals: dict, user_id: int, ts: datetime.datetime, points: int, won: bool, cutoffs: dict):
+    for period in ROLLUP_PERIODS:
+        bucket = rollup_bucket(period, ts)
+        if bucket < cutoffs[period]:
+            continue
+        entry = totals.setdefault((period, bucket, user_id), [0, 0, 0])
+        entry[0] += points
+        entry[1] += 1
+        entry[2] += won
+
+def _update_rollups(cursor, user_id: int, entries):
+    # entries 为 (比赛时间, 积分, 是否获胜)；同一时段的多条记录合并为一次写入
+    totals = {}
+    cutoffs = rollup_cutoffs(datetime.datetime.utcnow())
+    for ts, points, won in entries:
+        _fold_rollups(totals, user_id, ts, points, won, cutoffs)
+    cursor.executemany(ROLLUP_UPSERT, [key + tuple(value) for key, value in totals.items()])
+
+ROLLUP_SOURCE_COLUMNS = "user_id, points_earned, result, created_at"
+
+def _fold_rollup_rows(totals: dict, rows, cutoffs: dict):
+    for user_id, points, result, created_at in rows:
+        ts = datetime.datetime.strptime(created_at[:19], "%Y-%m-%d %H:%M:%S")
+        _fold_rollups(totals, user_id, ts, points, result == 'win', cutoffs)
+
+def _read_rollups(conn, cutoffs: dict, chunk_size: int = 1000):
+    # 只读取仍在保留期内的记录；汇总结果的大小与保留期内的 (时段, 用户) 数成正比
+    source = game_records_source(conn)
+    earliest = min(rollup_bucket_start(period, bucket) for period, bucket in cutoffs.items())
+    last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {source}").fetchone()[0]
+    reader = conn.execute(
+        f"SELECT {ROLLUP_SOURCE_COLUMNS} FROM {source} WHERE created_at >= ? AND id <= ?",
+        (earliest.strftime("%Y-%m-%d %H:%M:%S"), last_id)
+    )
+    totals = {}
+    while True:
+        rows = reader.fetchmany(chunk_size)
+        if not rows:
+            break
+        _fold_rollup_rows(totals, rows, cutoffs)
+    return totals, last_id
+
+def _store_rebuilt_rollups(cursor, totals: dict, last_id: int, cutoffs: dict):
+    cursor.execute("DELETE FROM points_rollups")
+    cursor.executemany(ROLLUP_UPSERT, [key + tuple(value) for key, value in totals.items()])
+    # 汇总期间新写入的记录按增量路径补上；单独累加，忙重试时不会重复计入快照的结果
+    cursor.execute(
+        f"SELECT {ROLLUP_SOURCE_COLUMNS} FROM {game_records_source(cursor.connection)} WHERE id > ?",
+        (last_id,)
+    )
+    late = {}
+    _fold_rollup_rows(late, cursor.fetchall(), cutoffs)
+    cursor.executemany(ROLLUP_UPSERT, [key + tuple(value) for key, value in late.items()])
+    cursor.execute("INSERT OR REPLACE INTO cache_versions (name, version) VALUES ('rollups_rebuild', 0)")
+
+def rebuild_rollups(conn):
+    # 从 game_records 全量重建分时段汇总：在只读快照中汇总，不阻塞在线写入；
+    # 只有最后替换结果并补上期间新增记录的短事务持有写锁
+    attach_archive(conn)
+    cutoffs = rollup_cutoffs(datetime.datetime.utcnow())
+    conn.execute("BEGIN")
+    try:
+        totals, last_id = _read_rollups(conn, cutoffs)
     finally:
-        conn.close()
+        conn.rollback()
+    run_write_transaction(conn, _store_rebuilt_rollups, totals, last_id, cutoffs)
+    return conn.execute("SELECT COUNT(*) FROM points_rollups").fetchone()[0]
 
-@app.post("/api/auth/login")
-async def login(user: UserLogin):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def expire_rollups(conn):
+    cutoffs = rollup_cutoffs(datetime.datetime.utcnow())
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        # 查找用户
-        cursor.execute(
-            "SELECT id, username, email, password_hash, current_points, total_points, games_played, games_won FROM users WHERE username = ?",
-            (user.username,)
-        )
-        user_data = cursor.fetchone()
-        
-        if not user_data or not verify_password(user.password, user_data[3]):
-            raise HTTPException(status_code=401, detail="用户名或密码错误")
-        
-        # 更新最后登录时间
-        cursor.execute(
-            "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?",
-            (user_data[0],)
-        )
+        deleted = 0
+        for period, cutoff in cutoffs.items():
+            deleted += conn.execute("DELETE FROM points_rollups WHERE period = ? AND bucket < ?", (period, cutoff)).rowcount
         conn.commit()
-        
-        # 生成JWT token
-        token = create_jwt_token(user_data[0], user_data[1])
-        
-        return {
-            "message": "登录成功",
-            "token": token,
-            "user": {
-                "id": user_data[0],
-                "username": user_data[1],
-                "email": user_data[2],
-                "current_points": user_data[4],
-                "total_points": user_data[5],
-                "games_played": user_data[6],
-                "games_won": user_data[7]
-            }
-        }
-    
-    except HTTPException:
+    except Exception:
+        conn.rollback()
         raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"登录失败: {str(e)}")
+    return deleted
+
+# 历史记录归档：归档库按需 ATTACH 为 archive，表结构与主库 game_records 相同并保留原记录id
+ARCHIVE_COLUMNS = "id, user_id, game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at"
+
+def archive_is_attached(conn) -> bool:
+    if isinstance(conn, PooledConnection):
+        return conn.archive_attached
+    return any(row[1] == "archive" for row in conn.execute("PRAGMA database_list"))
+
+def attach_archive(conn, create: bool = False) -> bool:
+    # ATTACH 不能在事务中执行；连接池中的连接挂载一次后一直保留
+    if archive_is_attached(conn):
+        return True
+    if not create and not ARCHIVE_DB_PATH.exists():
+        return False
+    conn.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.game_records (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            game_type TEXT NOT NULL,
+            result TEXT NOT NULL,
+            points_earned INTEGER NOT NULL,
+            duration INTEGER NOT NULL,
+            player_score INTEGER NOT NULL,
+            ai_score INTEGER NOT NULL,
+            sets_won INTEGER NOT NULL,
+            sets_lost INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_game_records_user_created ON game_records (user_id, created_at)")
+    if isinstance(conn, PooledConnection):
+        conn.archive_attached = True
+    return True
+
+def game_records_source(conn) -> str:
+    # 全量重建类任务读取的数据源：挂载了归档库时合并两边
+    if archive_is_attached(conn):
+        return f"(SELECT {ARCHIVE_COLUMNS} FROM main.game_records UNION ALL SELECT {ARCHIVE_COLUMNS} FROM archive.game_records)"
+    return "game_records"
+
+def archive_cutoff(now: datetime.datetime) -> str:
+    return (now - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+
+def archive_batch(conn, cutoff: str, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    attach_archive(conn, create=True)
+    # 先在事务外挑出要移动的记录，写事务里只做移动，持有写锁的时间与批大小成正比
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM main.game_records WHERE created_at < ? ORDER BY id LIMIT ?",
+        (cutoff, batch_size)
+    )]
+    if not ids:
+        return 0
+    placeholders = ", ".join("?" * len(ids))
+    # 跨库事务在 WAL 模式下不是原子的，两个库各自提交且主库在前，崩溃时可能丢失记录。
+    # 因此分两个事务：先复制到归档库并提交，再从主库删除已确认在归档库中的记录。
+    # 两次提交之间崩溃只会让记录同时留在两边，下一批用 OR IGNORE 重新移动即可
+    run_write_transaction(conn, _copy_to_archive_tx, ids, placeholders)
+    return run_write_transaction(conn, _delete_archived_tx, ids, placeholders)
+
+def _copy_to_archive_tx(cursor, ids: list, placeholders: str):
+    cursor.execute(
+        f"INSERT OR IGNORE INTO archive.game_records ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM main.game_records WHERE id IN ({placeholders})",
+        ids
+    )
+
+def _delete_archived_tx(cursor, ids: list, placeholders: str):
+    cursor.execute(
+        f"DELETE FROM main.game_records WHERE id IN ({placeholders}) AND id IN (SELECT id FROM archive.game_records WHERE id IN ({placeholders}))",
+        ids + ids
+    )
+    return cursor.rowcount
+
+def compact_database(conn):
+    # 归档后释放的页会被新写入复用；需要缩小文件时执行一次，之后每轮归档自动增量回收
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return conn.execute("PRAGMA page_count").fetchone()[0]
+
+def incremental_vacuum(conn):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        conn.execute(f"PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})").fetchall()
+
+def archive_records(conn):
+    # 命令行入口：一次归档全部过期记录
+    if not ARCHIVE_AFTER_DAYS:
+        return 0
+    cutoff = archive_cutoff(datetime.datetime.utcnow())
+    total = 0
+    while True:
+        moved = archive_batch(conn, cutoff)
+        if not moved:
+            break
+        total += moved
+        time.sleep(ARCHIVE_BATCH_PAUSE_MS / 1000)
+    incremental_vacuum(conn)
+    return total
+
+# 技术评分：每个用户在每种 game_type 下一个 Elo 评分，对手是固定评分的 AI。
+# 实际得分由胜负和盘数比例加权，评分变化再按比分差缩放；前若干场为定级赛，K 值更大
+RATING_INITIAL = float(os.getenv("RATING_INITIAL", "1500"))
+RATING_AI = float(os.getenv("RATING_AI", "1500"))  # AI 对手的固定评分
+RATING_K = float(os.getenv("RATING_K", "32"))
+RATING_K_PROVISIONAL = float(os.getenv("RATING_K_PROVISIONAL", "64"))  # 定级赛期间的 K 值
+RATING_PROVISIONAL_GAMES = int(os.getenv("RATING_PROVISIONAL_GAMES", "10"))  # 定级赛场数，未完成的不进入评分排行榜
+RATING_RESULT_WEIGHT = float(os.getenv("RATING_RESULT_WEIGHT", "0.75"))  # 实际得分中胜负的权重，其余为盘数比例
+RATING_MARGIN_REF = float(os.getenv("RATING_MARGIN_REF", "5"))  # 比分差为该值时缩放系数为1
+RATING_RECOMPUTE_CHUNK = int(os.getenv("RATING_RECOMPUTE_CHUNK", "100000"))  # 离线重算每次读取的记录数
+RATING_RESULT_SCORES = {'win': 1.0, 'draw': 0.5, 'lose': 0.0}
+RATING_COLUMNS = "user_id, game_type, result, player_score, ai_score, sets_won, sets_lost"
+RATING_UPSERT = "INSERT OR REPLACE INTO user_ratings (user_id, game_type, rating, games) VALUES (?, ?, ?, ?)"
+
+def rating_inputs(result: str, player_score: int, ai_score: int, sets_won: int, sets_lost: int) -> tuple:
+    # 返回 (实际得分, 比分差缩放系数)，只取决于这场比赛本身
+    sets = sets_won + sets_lost
+    share = min(max(sets_won / sets, 0.0), 1.0) if sets > 0 else 0.5
+    actual = RATING_RESULT_WEIGHT * RATING_RESULT_SCORES.get(result, 0.0) + (1 - RATING_RESULT_WEIGHT) * share
+    margin = min(max(math.log1p(abs(player_score - ai_score)) / math.log1p(RATING_MARGIN_REF), 0.5), 2.0)
+    return actual, margin
+
+def rating_update(rating: float, games: int, actual: float, margin: float) -> float:
+    expected = 1 / (1 + 10 ** ((RATING_AI - rating) / 400))
+    k = RATING_K_PROVISIONAL if games < RATING_PROVISIONAL_GAMES else RATING_K
+    return rating + k * margin * (actual - expected)
+
+def _rating_inputs_np(results, player_scores, ai_scores, sets_won, sets_lost):
+    # 与 rating_inputs 相同的公式，按列计算
+    import numpy as np
+    sets = sets_won + sets_lost
+    share = np.where(sets > 0, np.clip(sets_won / np.where(sets > 0, sets, 1), 0.0, 1.0), 0.5)
+    actual = RATING_RESULT_WEIGHT * results + (1 - RATING_RESULT_WEIGHT) * share
+    margin = np.clip(np.log1p(np.abs(player_scores - ai_scores)) / math.log1p(RATING_MARGIN_REF), 0.5, 2.0)
+    return actual, margin
+
+def _rating_update_np(ratings, games, actual, margin):
+    # 与 rating_update 相同的公式，按列计算
+    import numpy as np
+    expected = 1 / (1 + 10 ** ((RATING_AI - ratings) / 400))
+    k = np.where(games < RATING_PROVISIONAL_GAMES, RATING_K_PROVISIONAL, RATING_K)
+    return ratings + k * margin * (actual - expected)
+
+def _record_rating_fields(record: GameRecord) -> tuple:
+    return (record.game_type, record.result, record.player_score, record.ai_score, record.sets_won, record.sets_lost)
+
+def _update_ratings(cursor, user_id: int, records):
+    # 增量更新：records 为 (game_type, result, player_score, ai_score, sets_won, sets_lost)，需按比赛先后顺序排列
+    states = {}
+    for game_type, *fields in records:
+        state = states.get(game_type)
+        if state is None:
+            cursor.execute("SELECT rating, games FROM user_ratings WHERE user_id = ? AND game_type = ?", (user_id, game_type))
+            state = states[game_type] = list(cursor.fetchone() or (RATING_INITIAL, 0))
+        state[0] = rating_update(state[0], state[1], *rating_inputs(*fields))
+        state[1] += 1
+    cursor.executemany(RATING_UPSERT, [(user_id, game_type, rating, games) for game_type, (rating, games) in states.items()])
+
+def _replay_ratings_python(reader, chunk_size: int) -> list:
+    states = {}
+    while True:
+        rows = reader.fetchmany(chunk_size)
+        if not rows:
+            break
+        for user_id, game_type, *fields in rows:
+            state = states.setdefault((user_id, game_type), [RATING_INITIAL, 0])
+            state[0] = rating_update(state[0], state[1], *rating_inputs(*fields))
+            state[1] += 1
+    return [(user_id, game_type, rating, games) for (user_id, game_type), (rating, games) in states.items()]
+
+def _replay_ratings_numpy(reader, chunk_size: int) -> list:
+    # 评分存放在 [user_id, game_type编号] 的稠密数组中。每个块内按“该组合在块内的第几场”分轮，
+    # 同一轮中每个 (用户, game_type) 最多一场，整轮一次向量化更新；同一组合的比赛仍按时间先后依次计算
+    import numpy as np
+    type_codes = {}
+    ratings = np.full((0, 0), RATING_INITIAL)
+    games = np.zeros((0, 0), dtype=np.int64)
+    while True:
+        rows = reader.fetchmany(chunk_size)
+        if not rows:
+            break
+        user_ids, game_types, results, player_scores, ai_scores, sets_won, sets_lost = zip(*rows)
+        for game_type in set(game_types):
+            type_codes.setdefault(game_type, len(type_codes))
+        user_ids = np.array(user_ids, dtype=np.int64)
+        height, width = ratings.shape
+        if user_ids.max() >= height or len(type_codes) > width:
+            # 用户数按倍数扩容，避免每个块都复制整个数组
+            if user_ids.max() >= height:
+                height = max(int(user_ids.max()) + 1, height * 2)
+            pad = ((0, height - ratings.shape[0]), (0, len(type_codes) - width))
+            ratings = np.pad(ratings, pad, constant_values=RATING_INITIAL)
+            games = np.pad(games, pad)
+            width = len(type_codes)
+
+        actual, margin = _rating_inputs_np(
+            np.array([RATING_RESULT_SCORES.get(result, 0.0) for result in results]),
+            np.array(player_scores, dtype=np.float64), np.array(ai_scores, dtype=np.float64),
+            np.array(sets_won, dtype=np.float64), np.array(sets_lost, dtype=np.float64)
+        )
+        cells = user_ids * width + np.array([type_codes[game_type] for game_type in game_types])
+
+        # 块内每条记录是其组合的第几场：稳定排序后减去所在分组的起始位置
+        n = len(cells)
+        order = np.argsort(cells, kind="stable")
+        sorted_cells = cells[order]
+        group_start = np.ones(n, dtype=bool)
+        group_start[1:] = sorted_cells[1:] != sorted_cells[:-1]
+        positions = np.arange(n)
+        occurrence = np.empty(n, dtype=np.int64)
+        occurrence[order] = positions - np.maximum.accumulate(np.where(group_start, positions, 0))
+
+        by_round = np.argsort(occurrence, kind="stable")
+        bounds = np.searchsorted(occurrence[by_round], np.arange(occurrence.max() + 2))
+        flat_ratings = ratings.reshape(-1)
+        flat_games = games.reshape(-1)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            batch = by_round[start:end]
+            targets = cells[batch]
+            flat_ratings[targets] = _rating_update_np(flat_ratings[targets], flat_games[targets], actual[batch], margin[batch])
+            flat_games[targets] += 1
+
+    names = sorted(type_codes, key=type_codes.get)
+    user_index, type_index = np.nonzero(games)
+    return list(zip(
+        user_index.tolist(), [names[code] for code in type_index.tolist()],
+        ratings[user_index, type_index].tolist(), games[user_index, type_index].tolist()
+    ))
+
+def _replay_ratings(reader, chunk_size: int = RATING_RECOMPUTE_CHUNK) -> list:
+    # reader 按 (created_at, id) 顺序返回 RATING_COLUMNS，结果为 (user_id, game_type, rating, games)
+    # NumPy 为可选依赖，只在重算时导入，不拖慢服务启动；未安装时逐条计算，结果相同，只是更慢
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return _replay_ratings_python(reader, chunk_size)
+    return _replay_ratings_numpy(reader, chunk_size)
+
+def _store_recomputed_ratings(cursor, ratings: list, last_id: int):
+    cursor.execute("DELETE FROM user_ratings")
+    cursor.executemany(RATING_UPSERT, ratings)
+    # 重算期间新写入的记录按增量路径补上
+    cursor.execute(
+        f"SELECT {RATING_COLUMNS} FROM {game_records_source(cursor.connection)} WHERE id > ? ORDER BY created_at, id",
+        (last_id,)
+    )
+    late = {}
+    for user_id, *fields in cursor.fetchall():
+        late.setdefault(user_id, []).append(fields)
+    for user_id, records in late.items():
+        _update_ratings(cursor, user_id, records)
+    cursor.execute("UPDATE cache_versions SET version = 0 WHERE name = 'ratings_recompute'")
+    return len(ratings)
+
+def recompute_ratings(conn):
+    # 修改评分参数后全量重算：在只读快照中重放全部历史，不阻塞在线写入；
+    # 只有最后替换结果并补上期间新增记录的短事务持有写锁
+    attach_archive(conn)
+    source = game_records_source(conn)
+    conn.execute("BEGIN")
+    try:
+        last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {source}").fetchone()[0]
+        reader = conn.execute(f"SELECT {RATING_COLUMNS} FROM {source} WHERE id <= ? ORDER BY created_at, id", (last_id,))
+        ratings = _replay_ratings(reader)
     finally:
-        conn.close()
+        conn.rollback()
+    return run_write_transaction(conn, _store_recomputed_ratings, ratings, last_id)
 
-@app.get("/api/auth/profile")
-async def get_profile(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def recompute_pending_ratings():
+    # 迁移后首次启动时调用：使用独立连接，不占用连接池
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     try:
-        cursor.execute(
-            "SELECT id, username, email, current_points, total_points, games_played, games_won, created_at, last_login FROM users WHERE id = ?",
-            (current_user['user_id'],)
-        )
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            raise HTTPException(status_code=404, detail="用户不存在")
-        
-        return {
-            "user": {
-                "id": user_data[0],
-                "username": user_data[1],
-                "email": user_data[2],
-                "current_points": user_data[3],
-                "total_points": user_data[4],
-                "games_played": user_data[5],
-                "games_won": user_data[6],
-                "win_rate": round(user_data[6] / max(user_data[5], 1) * 100, 2),
-                "created_at": user_data[7],
-                "last_login": user_data[8]
-            }
-        }
-    
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"获取用户信息失败: {str(e)}")
+        if read_cache_version(conn, "ratings_recompute"):
+            return recompute_ratings(conn)
+        return 0
     finally:
         conn.close()
 
-# 积分管理API
-@app.get("/api/points/balance")
-async def get_points_balance(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def rebuild_pending_rollups():
+    # 迁移后首次启动时调用：使用独立连接，不占用连接池
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     try:
-        cursor.execute(
-            "SELECT current_points, total_points FROM users WHERE id = ?",
-            (current_user['user_id'],)
-        )
-        points_data = cursor.fetchone()
-        
-        return {
-            "current_points": points_data[0],
-            "total_points": points_data[1]
-        }
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"获取积分失败: {str(e)}")
+        if read_cache_version(conn, "rollups_rebuild"):
+            return rebuild_rollups(conn)
+        return 0
     finally:
         conn.close()
 
-@app.post("/api/points/earn")
-async def earn_points(record: GameRecord, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+# 数据库初始化
+def init_database():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     try:
-        # 记录游戏结果
-        cursor.execute(
-            "INSERT INTO game_records (user_id, game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (current_user['user_id'], record.game_type, record.result, record.points_earned, record.duration, record.player_score, record.ai_score, record.sets_won, record.sets_lost)
-        )
-        
-        # 更新用户积分和统计
-        cursor.execute(
-            "UPDATE users SET current_points = current_points + ?, total_points = total_points + ?, games_played = games_played + 1, games_won = games_won + ? WHERE id = ?",
-            (record.points_earned, record.points_earned, 1 if record.result == 'win' else 0, current_user['user_id'])
-        )
-        
-        # 获取更新后的积分
-        cursor.execute(
-            "SELECT current_points, total_points FROM users WHERE id = ?",
-            (current_user['user_id'],)
-        )
-        points_data = cursor.fetchone()
-        
-        conn.commit()
-        
+        # 快速路径：库结构已是最新时只需读取一次文件头中的 user_version，跳过建表和初始数据
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        migrate(conn)
+    finally:
+        conn.close()
+
+# 工具函数
+def _password_bytes(password: str) -> bytes:
+    # bcrypt 只使用前72字节
+    return password.encode()[:72]
+
+def is_legacy_password_hash(hashed: str) -> bool:
+    # 旧版本使用无盐的单次 SHA-256，存储为64位十六进制字符串
+    return len(hashed) == 64 and not hashed.startswith("$")
+
+def hash_password(password: str, rounds: int = PASSWORD_HASH_ROUNDS) -> str:
+    import bcrypt
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds)).decode()
+
+def verify_password(password: str, hashed: str) -> bool:
+    if is_legacy_password_hash(hashed):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), hashed)
+    import bcrypt
+    return bcrypt.checkpw(_password_bytes(password), hashed.encode())
+
+def password_needs_rehash(hashed: str) -> bool:
+    if is_legacy_password_hash(hashed):
+        return True
+    # $2b$12$... 中的 cost 低于当前配置时也升级
+    try:
+        return int(hashed.split("$")[2]) < PASSWORD_HASH_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+# 密码哈希工作池：bcrypt 是CPU密集型操作，放到独立进程中执行并限制排队数量，
+# 登录洪峰只会让登录请求排队，不会拖慢其他接口
+class PasswordHasher:
+    def __init__(self, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING, timeout=PASSWORD_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+        self.pending = 0
+        self.rejected = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    try:
+                        # 进程池模块会连带导入 multiprocessing，只在第一次哈希时加载，缩短冷启动
+                        from concurrent.futures import ProcessPoolExecutor
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    except (OSError, NotImplementedError, ImportError):
+                        # Serverless 等环境不支持多进程（缺少 /dev/shm），退回线程池；
+                        # bcrypt 计算时会释放GIL，仍然不会阻塞事件循环
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="请求过多，请稍后重试")
+            self.pending += 1
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # 超时后请求先返回，但已开始的计算仍在池中运行：名额在计算真正结束（或排队中被取消）时才释放，
+        # max_pending 限制的始终是池中实际积压的任务数
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="请求过多，请稍后重试")
+
+    def _release(self, future=None):
+        with self._lock:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        # 旧版 SHA-256 校验开销很小，不必进入工作池
+        if is_legacy_password_hash(hashed):
+            return verify_password(password, hashed)
+        return await self._run(verify_password, password, hashed)
+
+    async def verify_dummy(self, password: str):
+        # 用户名不存在时同样做一次完整的 bcrypt 校验，响应时间不泄露用户名是否已注册；
+        # 比对用的哈希在本进程第一次用到时按当前 cost 生成一次，之后固定不变
+        if self._dummy_hash is None:
+            self._dummy_hash = await self.hash(secrets.token_urlsafe(16))
+        await self._run(verify_password, password, self._dummy_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
         return {
-            "message": "积分记录成功",
-            "points_earned": record.points_earned,
-            "current_points": points_data[0],
-            "total_points": points_data[1]
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
         }
-    
+
+password_hasher = PasswordHasher()
+
+# 已验证token缓存：以token摘要为键，避免同一token反复做HMAC校验
+class TokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, revoked_max=TOKEN_REVOKED_MAX):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.revoked_max = revoked_max
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # 摘要 -> (payload, 过期时间)
+        self._revoked = OrderedDict()  # 摘要 -> token的exp
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, digest: bytes) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, digest: bytes, payload: dict):
+        expires_at = min(payload.get('exp', 0), time.time() + self.ttl)
+        with self._lock:
+            self._entries[digest] = (payload, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def is_revoked(self, digest: bytes) -> bool:
+        with self._lock:
+            return digest in self._revoked
+
+    def revoke_token(self, token: str, exp: Optional[float] = None):
+        # 登出时调用：记录到token过期为止
+        self.revoke_digest(self.digest(token), exp)
+
+    def revoke_digest(self, digest: bytes, exp: Optional[float] = None):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._revoked[digest] = exp or now + JWT_EXPIRATION_HOURS * 3600
+            while self._revoked:
+                oldest, oldest_exp = next(iter(self._revoked.items()))
+                if len(self._revoked) <= self.revoked_max and oldest_exp > now:
+                    break
+                del self._revoked[oldest]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "revoked": len(self._revoked),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+token_cache = TokenCache()
+
+def create_jwt_token(user_id: int, username: str) -> str:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    payload = {
+        'user_id': user_id,
+        'username': username,
+        'iat': now,
+        'exp': now + datetime.timedelta(hours=JWT_EXPIRATION_HOURS)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def verify_jwt_token(token: str) -> dict:
+    digest = token_cache.digest(token)
+    payload = token_cache.get(digest)
+    if payload is not None:
+        return payload
+
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token已过期")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="无效的token")
+
+    if token_cache.is_revoked(digest):
+        raise HTTPException(status_code=401, detail="Token已失效，请重新登录")
+    token_cache.put(digest, payload)
+    return payload
+
+# orjson 为可选依赖，未安装时回退到标准库 json，输出格式相同
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dump_json(payload) -> bytes:
+    # 与 FastAPI 默认 JSONResponse 的输出格式保持一致
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    # 路由直接返回该响应时 FastAPI 不再经过 jsonable_encoder，内容必须已是 dict/list/str/int 等基本类型
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+def rows_to_dicts(cursor, rows=None) -> list:
+    # 列名按 cursor.description 每个游标只取一次，逐行只做一次 zip
+    columns = tuple(column[0] for column in cursor.description)
+    if rows is None:
+        rows = cursor.fetchall()
+    return [dict(zip(columns, row)) for row in rows]
+
+def parse_attributes(text: Optional[str]) -> dict:
+    try:
+        attributes = json.loads(text) if text else {}
+    except ValueError:
+        return {}
+    return attributes if isinstance(attributes, dict) else {}
+
+# 缓存命中时只是一次字典查找，直接在事件循环上执行，不再占用线程池
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    payload = verify_jwt_token(token)
+    return payload
+
+# 限流：按用户和IP的令牌桶，读写分开计算；写请求另有全局并发上限，超限直接返回429
+class TokenBucketLimiter:
+    def __init__(self, rate: float, burst: float, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [剩余令牌, 上次更新时间]；按最近访问排序，满了淘汰最久未访问的键
+        # 被淘汰的键下次按满桶重新计算，长时间未访问的桶本来也早已补满
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now: float) -> float:
+        # 成功返回0，否则返回需要等待的秒数
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def refund(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def __len__(self):
+        return len(self._buckets)
+
+class AdmissionControl:
+    def __init__(self, max_writes=WRITE_MAX_CONCURRENCY):
+        self.limiters = {
+            ("user", "read"): TokenBucketLimiter(*RATE_USER_READ),
+            ("user", "write"): TokenBucketLimiter(*RATE_USER_WRITE),
+            ("ip", "read"): TokenBucketLimiter(*RATE_IP_READ),
+            ("ip", "write"): TokenBucketLimiter(*RATE_IP_WRITE),
+        }
+        self.max_writes = max_writes
+        self.writes_in_flight = 0
+        self.rejected = {"user": 0, "ip": 0, "concurrency": 0}
+
+    def _reject(self, reason: str, retry_after: float):
+        self.rejected[reason] += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="请求过于频繁，请稍后重试",
+            headers={"Retry-After": str(max(int(retry_after + 0.999), 1))}
+        )
+
+    def check(self, kind: str, ip: str, user_id: Optional[int] = None):
+        if not RATE_LIMIT_ENABLED:
+            return
+        now = time.monotonic()
+        wait = self.limiters[("ip", kind)].acquire(ip, now)
+        if wait:
+            self._reject("ip", wait)
+        if user_id is not None:
+            wait = self.limiters[("user", kind)].acquire(user_id, now)
+            if wait:
+                # 被用户桶拒绝的请求不占用IP的额度
+                self.limiters[("ip", kind)].refund(ip)
+                self._reject("user", wait)
+
+    @contextmanager
+    def write_slot(self):
+        # 只在事件循环中调用，计数无需加锁
+        if RATE_LIMIT_ENABLED and self.writes_in_flight >= self.max_writes:
+            self._reject("concurrency", 1)
+        self.writes_in_flight += 1
+        try:
+            yield
+        finally:
+            self.writes_in_flight -= 1
+
+    def stats(self) -> dict:
+        result = {f"rejected_{reason}": count for reason, count in self.rejected.items()}
+        result["writes_in_flight"] = self.writes_in_flight
+        for (scope, kind), limiter in self.limiters.items():
+            result[f"{scope}_{kind}_keys"] = len(limiter)
+        return result
+
+admission = AdmissionControl()
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+# 路由依赖：匿名接口按IP限流，登录后的接口同时按用户和IP限流并返回当前用户
+async def limit_ip_read(request: Request):
+    admission.check("read", client_ip(request))
+
+async def limit_ip_auth(request: Request):
+    # 注册、登录、登出只按IP限流：bcrypt 由 PasswordHasher 自行排队，
+    # 写并发名额只在真正写数据库时占用，登录高峰不会挤占积分和购买的写入
+    admission.check("write", client_ip(request))
+
+async def limit_user_read(request: Request, current_user: dict = Depends(get_current_user)):
+    admission.check("read", client_ip(request), current_user['user_id'])
+    return current_user
+
+async def limit_user_write(request: Request, current_user: dict = Depends(get_current_user)):
+    # 只做限流：写并发名额由各接口在真正写数据库时用 admission.write_slot() 占用，单条积分提交改由写入队列限制
+    admission.check("write", client_ip(request), current_user['user_id'])
+    return current_user
+
+# 监控指标：请求延迟直方图、状态码计数、进行中请求数，以及每个请求的SQL语句数和耗时
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # 只记录落入的第一个桶，输出时再累加成 Prometheus 的累计桶
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class RequestSql:
+    # 单个请求内的SQL统计，通过 contextvar 传递到数据库线程
+    __slots__ = ("statements", "execute_time", "commit_time", "lock_wait")
+
+    def __init__(self):
+        self.statements = 0
+        self.execute_time = 0.0
+        self.commit_time = 0.0
+        self.lock_wait = 0.0
+
+current_request_sql = contextvars.ContextVar("current_request_sql", default=None)
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # (method, route, status) -> 次数
+        self.latency = {}  # (method, route) -> Histogram
+        self.statements = {}  # (method, route) -> Histogram
+        self.route_sql = {}  # (method, route) -> [语句数, 执行秒数, 提交秒数, 等锁秒数]
+        self.in_flight = 0  # 进行中的请求数；开始时还没有匹配路由，只统计总数
+        self.sql_statements = 0
+        self.sql_execute_time = 0.0
+        self.sql_commit_time = 0.0
+        self.sql_lock_wait = 0.0
+        self.sql_errors = 0
+        self.busy_retries = 0
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, key, status_code: int, elapsed: float, sql: RequestSql):
+        with self._lock:
+            self.in_flight -= 1
+            status_key = key + (status_code,)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            if key not in self.latency:
+                self.latency[key] = Histogram(METRICS_LATENCY_BUCKETS)
+                self.statements[key] = Histogram(METRICS_STATEMENT_BUCKETS)
+                self.route_sql[key] = [0, 0.0, 0.0, 0.0]
+            self.latency[key].observe(elapsed)
+            self.statements[key].observe(sql.statements)
+            totals = self.route_sql[key]
+            totals[0] += sql.statements
+            totals[1] += sql.execute_time
+            totals[2] += sql.commit_time
+            totals[3] += sql.lock_wait
+
+    def sql_executed(self, sql: str, elapsed: float, failed: bool = False):
+        # BEGIN IMMEDIATE 的耗时基本都是在等待SQLite写锁
+        lock_wait = elapsed if sql.startswith("BEGIN IMMEDIATE") else 0.0
+        request = current_request_sql.get()
+        if request is not None:
+            request.statements += 1
+            request.execute_time += elapsed
+            request.lock_wait += lock_wait
+        with self._lock:
+            self.sql_statements += 1
+            self.sql_execute_time += elapsed
+            self.sql_lock_wait += lock_wait
+            self.sql_errors += failed
+
+    def sql_committed(self, elapsed: float):
+        request = current_request_sql.get()
+        if request is not None:
+            request.commit_time += elapsed
+        with self._lock:
+            self.sql_commit_time += elapsed
+
+    def pool_waited(self, elapsed: float):
+        request = current_request_sql.get()
+        if request is not None:
+            request.lock_wait += elapsed
+        with self._lock:
+            self.sql_lock_wait += elapsed
+
+    def render(self, gauges: dict) -> str:
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(method, route, **extra):
+            pairs = [("method", method), ("route", route)] + [(k, str(v)) for k, v in extra.items()]
+            return ",".join(f'{k}="{v}"' for k, v in pairs)
+
+        def histogram(name, histograms):
+            for (method, route), hist in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels(method, route, le=bound)}}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels(method, route, le="+Inf")}}} {hist.count}')
+                lines.append(f"{name}_sum{{{labels(method, route)}}} {hist.sum}")
+                lines.append(f"{name}_count{{{labels(method, route)}}} {hist.count}")
+
+        with self._lock:
+            family("http_requests_total", "counter", "按路由和状态码统计的请求数")
+            for (method, route, code), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{{labels(method, route, status=code)}}} {count}')
+            family("http_requests_in_flight", "gauge", "正在处理的请求数")
+            lines.append(f"http_requests_in_flight {self.in_flight}")
+            family("http_request_duration_seconds", "histogram", "请求处理耗时")
+            histogram("http_request_duration_seconds", self.latency)
+            family("http_request_db_statements", "histogram", "每个请求执行的SQL语句数")
+            histogram("http_request_db_statements", self.statements)
+            for index, (name, help_text) in enumerate((
+                ("http_request_db_statements_total", "请求执行的SQL语句总数"),
+                ("http_request_db_execute_seconds_total", "请求执行SQL语句的总耗时"),
+                ("http_request_db_commit_seconds_total", "请求提交事务的总耗时"),
+                ("http_request_db_lock_wait_seconds_total", "请求等待数据库连接和写锁的总耗时"),
+            )):
+                family(name, "counter", help_text)
+                for (method, route), totals in sorted(self.route_sql.items()):
+                    lines.append(f"{name}{{{labels(method, route)}}} {totals[index]}")
+            for name, value, help_text in (
+                ("db_statements_total", self.sql_statements, "执行的SQL语句总数（含后台任务）"),
+                ("db_statement_errors_total", self.sql_errors, "执行失败的SQL语句数"),
+                ("db_busy_retries_total", self.busy_retries, "写事务因数据库繁忙重试的次数"),
+                ("db_execute_seconds_total", self.sql_execute_time, "执行SQL语句的总耗时"),
+                ("db_commit_seconds_total", self.sql_commit_time, "提交事务的总耗时"),
+                ("db_lock_wait_seconds_total", self.sql_lock_wait, "等待数据库连接和写锁的总耗时"),
+            ):
+                family(name, "counter", help_text)
+                lines.append(f"{name} {value}")
+        for name, value in sorted(gauges.items()):
+            family(name, "gauge", name.replace("_", " "))
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsMiddleware:
+    # 纯ASGI中间件：不缓冲响应体，流式导出等接口不受影响
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        sql = RequestSql()
+        token = current_request_sql.set(sql)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        metrics.request_started()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request_sql.reset(token)
+            # 路由匹配后 scope 中才有路由模板；未匹配的请求统一记为 unmatched，避免任意路径撑爆标签数量
+            route = getattr(scope.get("route"), "path", "unmatched")
+            metrics.request_finished((scope["method"], route), status_code, elapsed, sql)
+
+# 健康检查和指标不读取业务缓存，不等待同步，数据库繁忙时也能如实返回
+COHERENCE_SKIP_PATHS = ("/health", "/metrics")
+
+class CoherenceMiddleware:
+    # 进入路由前同步其他进程提交的缓存改动，每个请求只检查一次：读到的数据不早于请求到达前已提交的写入
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] not in COHERENCE_SKIP_PATHS:
+            try:
+                await coherence.sync(db)
+            except HTTPException as e:
+                response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+# 后添加的中间件在外层：请求耗时统计包含等待缓存同步的时间
+app.add_middleware(CoherenceMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+# 数据库连接池
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if not METRICS_ENABLED:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            result = super().execute(sql, parameters)
+        except sqlite3.Error:
+            metrics.sql_executed(sql, time.perf_counter() - start, failed=True)
+            raise
+        metrics.sql_executed(sql, time.perf_counter() - start)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        if not METRICS_ENABLED:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            result = super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error:
+            metrics.sql_executed(sql, time.perf_counter() - start, failed=True)
+            raise
+        metrics.sql_executed(sql, time.perf_counter() - start)
+        return result
+
+class PooledConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+        self.archive_attached = False
+
+    # Connection.execute 在C层直接执行，不经过游标子类，这里改为走 InstrumentedCursor
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if not METRICS_ENABLED:
+            return super().commit()
+        start = time.perf_counter()
+        super().commit()
+        metrics.sql_committed(time.perf_counter() - start)
+
+class ConnectionPool:
+    def __init__(self, db_path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 max_age=DB_CONN_MAX_AGE, max_uses=DB_CONN_MAX_USES):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_uses = max_uses
+        # LIFO让最近用过的连接优先复用，页缓存和语句缓存保持温热
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.opened = 0
+        self.recycled = 0
+        self.in_use = 0
+
+    def _open(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=256,
+            factory=PooledConnection,
+        )
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        coherence.tag_connection(conn)
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self.recycled += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _is_stale(self, conn, now) -> bool:
+        if self.max_age and now - conn.created_at > self.max_age:
+            return True
+        if self.max_uses and conn.uses >= self.max_uses:
+            return True
+        return False
+
+    def _healthy(self, conn, now) -> bool:
+        if now - conn.last_used < DB_HEALTHCHECK_IDLE:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> PooledConnection:
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HTTPException(status_code=503, detail="数据库繁忙，请稍后重试")
+        try:
+            now = time.monotonic()
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._open()
+                    break
+                if not self._is_stale(conn, now) and self._healthy(conn, now):
+                    break
+                self._discard(conn)
+            conn.uses += 1
+            with self._lock:
+                self.in_use += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: PooledConnection, broken: bool = False):
+        with self._lock:
+            self.in_use -= 1
+        try:
+            if not broken and conn.in_transaction:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    broken = True
+            conn.last_used = time.monotonic()
+            if broken or self._closed or self._is_stale(conn, conn.last_used):
+                self._discard(conn)
+            else:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+            # 约束冲突等业务错误不影响连接本身，其余数据库错误直接丢弃连接
+            broken = not isinstance(e, sqlite3.IntegrityError)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "in_use": self.in_use,
+            "opened": self.opened,
+            "recycled": self.recycled,
+        }
+
+db_pool = ConnectionPool(DB_PATH)
+
+# 数据库执行层：所有阻塞的SQLite操作都放到有界线程池中执行，避免阻塞事件循环
+class Database:
+    def __init__(self, pool: ConnectionPool, workers=DB_EXECUTOR_WORKERS,
+                 max_queue=DB_MAX_QUEUE, timeout=DB_TASK_TIMEOUT):
+        self.pool = pool
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _call(self, fn, args, deadline):
+        # 在队列中等待太久的任务，调用方已经超时放弃，不再执行
+        if time.monotonic() > deadline:
+            raise TimeoutError("任务在队列中等待超时")
+        # 连接归还时若仍处于事务中会自动回滚
+        start = time.perf_counter()
+        with self.pool.connection() as conn:
+            if METRICS_ENABLED:
+                metrics.pool_waited(time.perf_counter() - start)
+            return fn(conn, *args)
+
+    def _done(self, _future):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args, timeout: Optional[float] = None):
+        timeout = timeout or self.timeout
+        with self._lock:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="服务器繁忙，请稍后重试")
+            self.pending += 1
+        try:
+            # 复制当前上下文，数据库线程中的SQL统计归属到发起请求
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, self._call, fn, args, time.monotonic() + timeout)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            with self._lock:
+                self.timed_out += 1
+            raise HTTPException(status_code=504, detail="数据库操作超时")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+db = Database(db_pool)
+
+def get_db() -> Database:
+    return db
+
+def is_busy_error(e: sqlite3.OperationalError) -> bool:
+    message = str(e)
+    return "database is locked" in message or "database is busy" in message
+
+def run_write_transaction(conn, fn, *args):
+    # BEGIN IMMEDIATE 在事务开始时就拿到写锁，避免延迟事务读后升级写锁时的 SQLITE_BUSY；
+    # busy_timeout 用尽仍拿不到锁时整体回滚，按指数退避加随机抖动重试有限次数
+    for attempt in range(DB_BUSY_RETRIES + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn.cursor(), *args)
+                conn.commit()
+                return result
+            except BaseException:
+                conn.rollback()
+                raise
+        except sqlite3.OperationalError as e:
+            if attempt == DB_BUSY_RETRIES or not is_busy_error(e):
+                raise
+            metrics.busy_retries += 1
+            time.sleep(DB_BUSY_RETRY_BASE_MS / 1000 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+# 内存排行榜：可按下标访问的跳表，插入、删除、名次查询均为 O(log n)
+SKIPLIST_MAX_LEVEL = 24  # 足以支撑千万级用户
+
+class _SkipNode:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i] 表示沿第 i 层指针前进时跨过的元素个数
+        self.width = [1] * level
+
+class RankedIndex:
+    def __init__(self, max_level=SKIPLIST_MAX_LEVEL):
+        self.max_level = max_level
+        self._random = random.Random(0x5EED)
+        self.clear()
+
+    def clear(self):
+        self.head = _SkipNode(None, self.max_level)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.max_level and self._random.getrandbits(1):
+            level += 1
+        return level
+
+    def bulk_load(self, sorted_keys):
+        # 已排序的数据直接线性建表，避免逐个插入的 O(n log n)
+        self.clear()
+        last = [self.head] * self.max_level
+        last_pos = [-1] * self.max_level
+        pos = -1
+        for pos, key in enumerate(sorted_keys):
+            level = self._random_level()
+            node = _SkipNode(key, level)
+            for i in range(level):
+                last[i].next[i] = node
+                last[i].width[i] = pos - last_pos[i]
+                last[i] = node
+                last_pos[i] = pos
+        self.size = pos + 1
+        for i in range(self.max_level):
+            last[i].width[i] = self.size - last_pos[i]
+
+    def insert(self, key):
+        chain = [None] * self.max_level
+        steps = [0] * self.max_level
+        node = self.head
+        for i in reversed(range(self.max_level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                steps[i] += node.width[i]
+                node = node.next[i]
+            chain[i] = node
+        level = self._random_level()
+        new = _SkipNode(key, level)
+        travelled = 0
+        for i in range(level):
+            prev = chain[i]
+            new.next[i] = prev.next[i]
+            prev.next[i] = new
+            new.width[i] = prev.width[i] - travelled
+            prev.width[i] = travelled + 1
+            travelled += steps[i]
+        for i in range(level, self.max_level):
+            chain[i].width[i] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.max_level
+        node = self.head
+        for i in reversed(range(self.max_level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            chain[i] = node
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for i in range(len(target.next)):
+            prev = chain[i]
+            prev.width[i] += target.width[i] - 1
+            prev.next[i] = target.next[i]
+        for i in range(len(target.next), self.max_level):
+            chain[i].width[i] -= 1
+        self.size -= 1
+
+    def rank(self, key) -> int:
+        # 返回从0开始的名次，key 不存在时抛出 KeyError
+        node = self.head
+        pos = -1
+        for i in reversed(range(self.max_level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+        target = node.next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        return pos + 1
+
+    def _node_at(self, index):
+        node = self.head
+        pos = -1
+        for i in reversed(range(self.max_level)):
+            while node.next[i] is not None and pos + node.width[i] <= index:
+                pos += node.width[i]
+                node = node.next[i]
+        return node
+
+    def range(self, start: int, stop: int) -> list:
+        start = max(start, 0)
+        stop = min(stop, self.size)
+        if start >= stop:
+            return []
+        node = self._node_at(start)
+        keys = []
+        for _ in range(stop - start):
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+LEADERBOARD_MAX_LIMIT = 100
+LEADERBOARD_USER_ID_BITS = 32
+
+def leaderboard_key(total_points: int, user_id: int) -> int:
+    # 积分高的在前；同分时注册更早（id更小）的在前，保证名次确定
+    return (-total_points << LEADERBOARD_USER_ID_BITS) | user_id
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index = RankedIndex()
+        # user_id -> (username, total_points, games_played, games_won)
+        self._entries = {}
+        self.loaded = False
+        self._loading = None
+        self.version = 0  # 每次排名数据变化时递增，推送据此判断是否需要重新生成前N名
+
+    def load(self, conn):
+        # 加载期间持有锁：查询之后提交的积分更新会等加载完成再应用，不会被旧数据覆盖
+        with self._lock:
+            rows = conn.execute(
+                "SELECT id, username, total_points, games_played, games_won FROM users ORDER BY total_points DESC, id"
+            ).fetchall()
+            self.bulk_load(rows)
+
+    async def ensure_loaded(self, db: Database):
+        if self.loaded:
+            return
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(db.run(self.load, timeout=60))
+        try:
+            await asyncio.shield(self._loading)
+        except Exception:
+            self._loading = None
+            raise
+
+    def bulk_load(self, rows):
+        # rows 必须已按 total_points DESC, id 排序
+        with self._lock:
+            self._entries = {row[0]: tuple(row[1:]) for row in rows}
+            self._index.bulk_load(leaderboard_key(row[2], row[0]) for row in rows)
+            self.loaded = True
+            self.version += 1
+
+    def update(self, user_id: int, username: str, total_points: int, games_played: int, games_won: int):
+        with self._lock:
+            # 尚未加载时无需维护，加载时会从数据库读到最新积分
+            if not self.loaded:
+                return
+            old = self._entries.get(user_id)
+            # 更新在提交之后应用，并发提交的两次更新到达的顺序可能与提交顺序相反。
+            # 积分只在记录比赛时变化，每次都会使 games_played 增加，以它作为序号丢弃过时的值
+            if old is not None and games_played < old[2]:
+                return
+            if old is not None and old[1] != total_points:
+                self._index.remove(leaderboard_key(old[1], user_id))
+            if old is None or old[1] != total_points:
+                self._index.insert(leaderboard_key(total_points, user_id))
+            entry = (username, total_points, games_played, games_won)
+            if entry != old:
+                self._entries[user_id] = entry
+                self.version += 1
+
+    def _format(self, rank: int, key: int) -> dict:
+        user_id = key & ((1 << LEADERBOARD_USER_ID_BITS) - 1)
+        username, total_points, games_played, games_won = self._entries[user_id]
+        return {
+            "rank": rank + 1,
+            "username": username,
+            "total_points": total_points,
+            "games_played": games_played,
+            "games_won": games_won,
+            "win_rate": round(games_won / max(games_played, 1) * 100, 2)
+        }
+
+    def page(self, offset: int, limit: int) -> list:
+        with self._lock:
+            keys = self._index.range(offset, offset + limit)
+            return [self._format(offset + i, key) for i, key in enumerate(keys)]
+
+    def around(self, user_id: int, radius: int):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None, []
+            rank = self._index.rank(leaderboard_key(entry[1], user_id))
+            start = max(rank - radius, 0)
+            keys = self._index.range(start, rank + radius + 1)
+            return rank + 1, [self._format(start + i, key) for i, key in enumerate(keys)]
+
+    def __len__(self):
+        return len(self._index)
+
+leaderboard = Leaderboard()
+
+# 商店目录缓存：按 item_type 预先序列化好响应体，目录版本号变化时整体重建
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "1"))  # 检查目录版本号的最小间隔秒数
+
+def read_cache_version(conn, name: str) -> int:
+    row = conn.execute("SELECT version FROM cache_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+class CatalogCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.checked_at = 0.0
+        self.items = {}  # id -> 物品信息，attributes 已解析为 dict
+        self.attributes = {}  # id -> 属性加成，包含已下架的物品，已装备的下架物品仍然生效
+        self._bodies = {}  # item_type（None 表示全部）-> 响应体字节
+        self._empty_body = dump_json({"items": []})
+
+    def load(self, conn):
+        version = read_cache_version(conn, "catalog")
+        if version != self.version:
+            rows = conn.execute(
+                "SELECT id, name, type, price, description, image_url, attributes FROM shop_items WHERE is_available = TRUE ORDER BY type, price"
+            ).fetchall()
+            public = []
+            items = {}
+            for row in rows:
+                item = {
+                    "id": row[0],
+                    "name": row[1],
+                    "type": row[2],
+                    "price": row[3],
+                    "description": row[4],
+                    "image_url": row[5],
+                    "attributes": row[6]
+                }
+                public.append(item)
+                items[row[0]] = dict(item, attributes=parse_attributes(row[6]))
+            attributes = {
+                row[0]: parse_attributes(row[1])
+                for row in conn.execute("SELECT id, attributes FROM shop_items")
+            }
+            bodies = {None: dump_json({"items": public})}
+            for item_type in {item["type"] for item in public}:
+                bodies[item_type] = dump_json({"items": [item for item in public if item["type"] == item_type]})
+            with self._lock:
+                self.items = items
+                self.attributes = attributes
+                self._bodies = bodies
+                self.version = version
+        self.checked_at = time.monotonic()
+
+    async def ensure_fresh(self, db: Database):
+        # 启用跨进程同步时目录改动在请求开始时已经应用，这里只需处理尚未加载或已失效的情况
+        if self.version is None or (not coherence.active and time.monotonic() - self.checked_at >= CATALOG_CHECK_INTERVAL):
+            await db.run(self.load)
+
+    def invalidate(self):
+        # 同进程内修改 shop_items 后调用，下一次请求立即重建
+        with self._lock:
+            self.version = None
+
+    def body(self, item_type: Optional[str]) -> bytes:
+        return self._bodies.get(item_type or None, self._empty_body)
+
+    def get_item(self, item_id: int) -> Optional[dict]:
+        return self.items.get(item_id)
+
+catalog_cache = CatalogCache()
+
+# 装备加成缓存：按用户缓存已装备物品及汇总后的属性加成，购买/装备后失效
+LOADOUT_CACHE_SIZE = int(os.getenv("LOADOUT_CACHE_SIZE", "10000"))  # 最多缓存的用户数
+LOADOUT_BULK_MAX = int(os.getenv("LOADOUT_BULK_MAX", "100"))  # 批量查询一次最多的用户数
+LOADOUT_SLOTS = ("racket", "outfit", "accessory")
+BASE_ITEM_ID = 0  # 注册时赠送的基础装备，不在 shop_items 中，没有属性加成
+
+def sum_bonuses(attribute_sets) -> dict:
+    # 只累加数值属性；道具卡的 effect 等文本属性不参与汇总
+    bonuses = {}
+    for attributes in attribute_sets:
+        for name, value in attributes.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                bonuses[name] = bonuses.get(name, 0) + value
+    return bonuses
+
+class LoadoutCache:
+    def __init__(self, max_size=LOADOUT_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (已装备物品, 目录版本号, 响应内容)
+        # 读库期间发生的失效：读之前记下序号，写回时跳过之后被失效的用户，避免旧数据覆盖
+        self._seq = 0
+        self._invalidated = OrderedDict()  # user_id -> 失效时的序号
+        self._invalidated_floor = 0  # 已从 _invalidated 中淘汰的最大序号
+        self.hits = 0
+        self.misses = 0
+
+    def _payload(self, user_id: int, equipped: tuple) -> dict:
+        attributes = catalog_cache.attributes
+        items = {}
+        for item_type, item_id, item_name in equipped:
+            items[item_type] = {
+                "item_id": item_id,
+                "item_name": item_name,
+                "attributes": {} if item_id == BASE_ITEM_ID else attributes.get(item_id, {}),
+            }
+        return {
+            "user_id": user_id,
+            "items": items,
+            "bonuses": sum_bonuses(item["attributes"] for item in items.values()),
+        }
+
+    def lookup(self, user_ids: list):
+        # 只查内存，可以直接在事件循环中调用；返回 (命中的响应, 未命中的用户, 序号)，未命中的交给 load 读库。
+        # 调用前需保证 catalog_cache 已加载；目录版本变化时用缓存的装备重新汇总，不必再读库
+        version = catalog_cache.version
+        result = {}
+        missing = []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    missing.append(user_id)
+                    continue
+                self._entries.move_to_end(user_id)
+                if entry[1] != version:
+                    entry = (entry[0], version, self._payload(user_id, entry[0]))
+                    self._entries[user_id] = entry
+                result[user_id] = entry[2]
+            self.hits += len(result)
+            self.misses += len(missing)
+            started = self._seq
+        return result, missing, started
+
+    def load(self, conn, user_ids: list, started: int) -> dict:
+        # 从 users 左连接已装备物品：不存在的用户不出现在结果中，也不会被缓存
+        version = catalog_cache.version
+        equipped = {}
+        for user_id, item_type, item_id, item_name in conn.execute(
+            f"""
+            SELECT u.id, i.item_type, i.item_id, i.item_name
+            FROM users u LEFT JOIN user_items i
+              ON i.user_id = u.id AND i.is_equipped AND i.item_type IN ({', '.join('?' * len(LOADOUT_SLOTS))})
+            WHERE u.id IN ({', '.join('?' * len(user_ids))})
+            """,
+            list(LOADOUT_SLOTS) + user_ids
+        ):
+            rows = equipped.setdefault(user_id, [])
+            if item_type is not None:
+                rows.append((item_type, item_id, item_name))
+        result = {}
+        with self._lock:
+            stale = self._invalidated_floor > started
+            for user_id, rows in equipped.items():
+                entry = (tuple(rows), version, self._payload(user_id, rows))
+                result[user_id] = entry[2]
+                if stale or self._invalidated.get(user_id, 0) > started:
+                    continue
+                self._entries[user_id] = entry
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return result
+
+    def get_many(self, conn, user_ids: list) -> dict:
+        result, missing, started = self.lookup(user_ids)
+        if missing:
+            result.update(self.load(conn, missing, started))
+        return result
+
+    async def fetch(self, db: Database, user_ids: list) -> dict:
+        # 缓存命中在事件循环中直接返回，只有未命中的用户才交给数据库线程
+        result, missing, started = self.lookup(user_ids)
+        if missing:
+            result.update(await db.run(self.load, missing, started))
+        return result
+
+    def invalidate(self, user_id: int):
+        # 写事务提交后调用
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._seq += 1
+            self._invalidated[user_id] = self._seq
+            self._invalidated.move_to_end(user_id)
+            while len(self._invalidated) > self.max_size:
+                _, seq = self._invalidated.popitem(last=False)
+                self._invalidated_floor = max(self._invalidated_floor, seq)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._seq += 1
+            self._invalidated_floor = self._seq
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+loadout_cache = LoadoutCache()
+
+# 跨进程缓存同步配置
+CACHE_COHERENCE = os.getenv("CACHE_COHERENCE", "1") == "1"  # 多个 worker 共用一个数据库时必须开启
+CACHE_SYNC_MAX = int(os.getenv("CACHE_SYNC_MAX", "5000"))  # 单次同步最多增量应用的改动数，落后更多时整体重建
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "0.05"))  # 空闲时后台检查其他进程提交的间隔秒数，请求到来时另外检查
+CACHE_CHANGES_KEEP = int(os.getenv("CACHE_CHANGES_KEEP", "100000"))  # cache_changes 保留的最近改动数
+CACHE_CHANGES_PRUNE_INTERVAL = float(os.getenv("CACHE_CHANGES_PRUNE_INTERVAL", "60"))  # 清理 cache_changes 的间隔秒数
+
+def _revoke_token_tx(cursor, digest: bytes, expires_at: float):
+    cursor.execute("INSERT OR IGNORE INTO revoked_tokens (digest, expires_at) VALUES (?, ?)", (digest, expires_at))
+
+def load_revoked_tokens(conn):
+    for digest, expires_at in conn.execute("SELECT digest, expires_at FROM revoked_tokens WHERE expires_at > ?", (time.time(),)):
+        token_cache.revoke_digest(digest, expires_at)
+
+def _select_in(conn, sql: str, keys: list, chunk_size: int = 500):
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        yield from conn.execute(sql.format(", ".join("?" * len(chunk))), chunk)
+
+def _apply_leaderboard_changes(conn, user_ids: list):
+    for row in _select_in(conn, "SELECT id, username, total_points, games_played, games_won, current_points FROM users WHERE id IN ({})", user_ids):
+        leaderboard.update(*row[:5])
+        push_hub.publish_balance_threadsafe(row[0], row[5], row[2])
+
+def _apply_loadout_changes(conn, user_ids: list):
+    for user_id in user_ids:
+        loadout_cache.invalidate(user_id)
+
+def _apply_catalog_changes(conn, keys: list):
+    catalog_cache.load(conn)
+
+def _apply_token_changes(conn, digests: list):
+    for digest, expires_at in _select_in(conn, "SELECT digest, expires_at FROM revoked_tokens WHERE digest IN ({})", digests):
+        token_cache.revoke_digest(digest, expires_at)
+
+CACHE_CHANGE_HANDLERS = {
+    "leaderboard": _apply_leaderboard_changes,
+    "loadout": _apply_loadout_changes,
+    "catalog": _apply_catalog_changes,
+    "token": _apply_token_changes,
+}
+
+def reload_caches(conn):
+    catalog_cache.load(conn)
+    loadout_cache.clear()
+    if leaderboard.loaded:
+        leaderboard.load(conn)
+    load_revoked_tokens(conn)
+
+class CacheCoherence:
+    # 每个请求开始时在线程中检查一次 PRAGMA data_version：只读共享内存中的 WAL 头，不读任何页；
+    # 值变化说明有其他连接提交过，此时才读取 cache_changes 并应用到各个缓存。
+    # 本进程写入时已直接更新了自己的缓存，带本进程 origin 的改动只推进 seq，不再应用
+    def __init__(self, enabled=CACHE_COHERENCE):
+        self.enabled = enabled
+        self._conn = None
+        self._lock = threading.Lock()
+        self.origin = None
+        self.data_version = None
+        self.seq = 0
+        self._syncing = None
+        self.syncs = 0
+        self.full_syncs = 0
+        self.applied = 0
+        self.skipped = 0
+
+    @property
+    def active(self) -> bool:
+        return self._conn is not None
+
+    def open(self):
+        # 需在加载各缓存之前调用：之后提交的改动都会在后续同步中应用，重复应用没有副作用
+        if not self.enabled or self._conn is not None:
+            return
+        if self.origin is None:
+            # 每个 worker 随机生成而不用 pid：多个容器共用数据库时各自的 pid 可能相同
+            self.origin = random.SystemRandom().getrandbits(62)
+        # 专用连接只读 data_version，自己从不写入，其他任何连接的提交都会让该值变化
+        self._conn = sqlite3.connect(str(DB_PATH), check_same_thread=False, isolation_level=None)
+        self.data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        self.seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cache_changes").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def tag_connection(self, conn):
+        # 连接池新建连接时调用：该连接写入的改动标上本进程的 origin
+        if self.origin is not None:
+            conn.execute(f'''
+                CREATE TEMP TRIGGER IF NOT EXISTS cache_changes_origin
+                AFTER INSERT ON cache_changes
+                BEGIN
+                    UPDATE cache_changes SET origin = {self.origin} WHERE seq = NEW.seq;
+                END
+            ''')
+
+    def _read_data_version(self):
+        with self._lock:
+            if self._conn is None:
+                return self.data_version
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    async def sync(self, db: Database):
+        # 每个请求进入路由前调用一次：在线程中读一次 data_version，不占用事件循环，也不占数据库任务队列
+        if self._conn is None:
+            return
+        version = await asyncio.get_running_loop().run_in_executor(None, self._read_data_version)
+        await self._catch_up(db, version)
+
+    async def _catch_up(self, db: Database, version: int):
+        # data_version 只增不减：已应用的版本不小于读到的值时，缓存已包含读取之前的所有提交；
+        # 进行中的同步若开始于更早的版本，可能漏掉之后的提交，等它结束后再同步一次
+        while self.data_version < version:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._sync(db, version))
+            await asyncio.shield(self._syncing)
+
+    async def _sync(self, db: Database, version: int):
+        try:
+            await db.run(self.apply_changes)
+            self.data_version = max(self.data_version, version)
+        finally:
+            self._syncing = None
+
+    async def run(self, db: Database):
+        # 后台轮询只用于提前开始同步：空闲时也能跟上其他进程的提交，请求到来时多半已不需要等待
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(CACHE_SYNC_INTERVAL)
+            try:
+                await self._catch_up(db, await loop.run_in_executor(None, self._read_data_version))
+            except Exception:
+                # 队列已满或同步失败时缓存保持原样，下个周期或下一个请求再试
+                pass
+
+    def apply_changes(self, conn):
+        self.syncs += 1
+        floor = read_cache_version(conn, "cache_changes_floor")
+        rows = conn.execute(
+            "SELECT seq, cache, key, origin FROM cache_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (self.seq, CACHE_SYNC_MAX + 1)
+        ).fetchall()
+        if floor > self.seq or len(rows) > CACHE_SYNC_MAX:
+            # 日志已被清理或落后太多：先记下当前位置再整体重建，重建期间的改动留给下一次同步
+            self.seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cache_changes").fetchone()[0]
+            self.full_syncs += 1
+            reload_caches(conn)
+            return
+        if not rows:
+            return
+        changes = {}
+        for _, cache, key, origin in rows:
+            if origin == self.origin:
+                self.skipped += 1
+                continue
+            changes.setdefault(cache, set()).add(key)
+            self.applied += 1
+        for cache, keys in changes.items():
+            CACHE_CHANGE_HANDLERS[cache](conn, list(keys))
+        self.seq = rows[-1][0]
+
+    def stats(self) -> dict:
+        return {
+            "seq": self.seq,
+            "syncs": self.syncs,
+            "full_syncs": self.full_syncs,
+            "applied": self.applied,
+            "skipped": self.skipped,
+        }
+
+coherence = CacheCoherence()
+
+# 服务端推送（SSE）配置：客户端订阅自己的余额变化和排行榜前N名的变化，不再轮询
+PUSH_ENABLED = os.getenv("PUSH_ENABLED", "1") == "1"
+PUSH_LEADERBOARD_TOP = int(os.getenv("PUSH_LEADERBOARD_TOP", "10"))  # 推送的排行榜名次数
+PUSH_INTERVAL = float(os.getenv("PUSH_INTERVAL", "1"))  # 排行榜合并推送的最小间隔秒数
+PUSH_HEARTBEAT = float(os.getenv("PUSH_HEARTBEAT", "15"))  # 心跳间隔秒数，防止代理断开空闲连接
+PUSH_MAX_CONNECTIONS = int(os.getenv("PUSH_MAX_CONNECTIONS", "10000"))  # 每个 worker 的推送连接上限
+PUSH_MAX_PER_USER = int(os.getenv("PUSH_MAX_PER_USER", "5"))  # 每个用户的推送连接上限
+PUSH_TICKET_TTL = float(os.getenv("PUSH_TICKET_TTL", "30"))  # 推送连接票据的有效秒数，只能使用一次
+PUSH_SHUTDOWN_GRACE = float(os.getenv("PUSH_SHUTDOWN_GRACE", "5"))  # 退出时等待连接结束的秒数，超时后 uvicorn 取消推送连接
+
+def sse_frame(event: str, payload) -> bytes:
+    # JSON 中的换行都已转义，整条数据放在一行 data 中
+    return b"event: " + event.encode() + b"\ndata: " + dump_json(payload) + b"\n\n"
+
+class PushSubscriber:
+    # 每个连接只保存待发送的最新余额和已发送的排行榜版本：积压时自动合并，不会无限排队
+    __slots__ = ("user_id", "balance", "last_balance", "leaderboard_version", "pending", "closed", "_waiter")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.balance = None
+        self.last_balance = None
+        self.leaderboard_version = None
+        self.pending = False
+        self.closed = False
+        self._waiter = None
+
+    def wake(self):
+        self.pending = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def wait(self, timeout: float) -> bool:
+        # 用 Future 而不是 asyncio.Event：广播时每个连接只是一次 set_result，不会为等待创建任务
+        if not self.pending:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self._waiter = None
+        self.pending = False
+        return True
+
+class PushHub:
+    # 只在事件循环线程中访问；数据库线程通过 publish_balance_threadsafe 转交
+    def __init__(self, top=PUSH_LEADERBOARD_TOP):
+        self.top = top
+        self._loop = None
+        self._subscribers = set()
+        self._by_user = {}  # user_id -> 该用户的连接集合
+        self._top = []
+        self._leaderboard_seen = None
+        self.version = 0
+        self.snapshot_frame = None
+        self.diff_frame = None
+        self.broadcasts = 0
+        self.broadcast_seconds = 0.0
+        self.frames = 0
+        self.closed = False
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self.closed = False
+
+    def check_capacity(self, user_id: int):
+        if len(self._subscribers) >= PUSH_MAX_CONNECTIONS:
+            raise HTTPException(status_code=503, detail="推送连接数已满，请稍后重试")
+        if len(self._by_user.get(user_id, ())) >= PUSH_MAX_PER_USER:
+            raise HTTPException(status_code=429, detail="推送连接过多")
+
+    def subscribe(self, user_id: int) -> PushSubscriber:
+        subscriber = PushSubscriber(user_id)
+        subscriber.closed = self.closed
+        self._subscribers.add(subscriber)
+        self._by_user.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: PushSubscriber):
+        self._subscribers.discard(subscriber)
+        subscribers = self._by_user.get(subscriber.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._by_user[subscriber.user_id]
+
+    def publish_balance(self, user_id: int, current_points: int, total_points: int):
+        balance = {"current_points": current_points, "total_points": total_points}
+        for subscriber in self._by_user.get(user_id, ()):
+            # 本进程直接推送和跨进程同步可能报告同一个余额，只推送有变化的
+            if balance != subscriber.last_balance:
+                subscriber.balance = subscriber.last_balance = balance
+                subscriber.wake()
+
+    def publish_balance_threadsafe(self, user_id: int, current_points: int, total_points: int):
+        if self._loop is not None and user_id in self._by_user:
+            self._loop.call_soon_threadsafe(self.publish_balance, user_id, current_points, total_points)
+
+    def refresh_leaderboard(self):
+        # 排名有变化时生成一次完整快照和相对上一版本的差异，所有连接共用同一份编码好的数据
+        if not leaderboard.loaded or leaderboard.version == self._leaderboard_seen:
+            return
+        self._leaderboard_seen = leaderboard.version
+        top = leaderboard.page(0, self.top)
+        if top == self._top:
+            return
+        changes = [entry for i, entry in enumerate(top) if i >= len(self._top) or self._top[i] != entry]
+        self._top = top
+        self.version += 1
+        self.snapshot_frame = sse_frame("leaderboard", {"version": self.version, "top": top})
+        self.diff_frame = sse_frame("leaderboard_diff", {
+            "version": self.version,
+            "base": self.version - 1,
+            "size": len(top),
+            "changes": changes
+        })
+        started = time.perf_counter()
+        for subscriber in self._subscribers:
+            subscriber.wake()
+        self.broadcasts += 1
+        self.broadcast_seconds += time.perf_counter() - started
+
+    def leaderboard_frame(self, subscriber: PushSubscriber) -> Optional[bytes]:
+        # 只落后一个版本时发送差异，落后更多或刚连接时发送完整快照
+        if self.snapshot_frame is None or subscriber.leaderboard_version == self.version:
+            return None
+        frame = self.diff_frame if subscriber.leaderboard_version == self.version - 1 else self.snapshot_frame
+        subscriber.leaderboard_version = self.version
+        return frame
+
+    async def run(self, db: Database):
+        # 有连接时才工作：按固定间隔合并推送排行榜，其他 worker 的提交已由 coherence 的后台任务同步
+        while True:
+            await asyncio.sleep(PUSH_INTERVAL)
+            if not self._subscribers:
+                continue
+            try:
+                self.refresh_leaderboard()
+            except Exception:
+                # 推送失败不影响服务，下个周期再试
+                pass
+
+    def close(self):
+        self.closed = True
+        for subscriber in self._subscribers:
+            subscriber.closed = True
+            subscriber.wake()
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self._subscribers),
+            "users": len(self._by_user),
+            "leaderboard_version": self.version,
+            "broadcasts": self.broadcasts,
+            "broadcast_seconds": round(self.broadcast_seconds, 6),
+            "frames": self.frames,
+        }
+
+push_hub = PushHub()
+
+def _prune_cache_changes_tx(cursor, keep: int):
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM cache_changes")
+    floor = cursor.fetchone()[0] - keep
+    cursor.execute("DELETE FROM revoked_tokens WHERE expires_at < ?", (time.time(),))
+    if floor <= 0:
+        return 0
+    cursor.execute("DELETE FROM cache_changes WHERE seq <= ?", (floor,))
+    deleted = cursor.rowcount
+    cursor.execute("UPDATE cache_versions SET version = MAX(version, ?) WHERE name = 'cache_changes_floor'", (floor,))
+    return deleted
+
+def prune_cache_changes(conn):
+    return run_write_transaction(conn, _prune_cache_changes_tx, CACHE_CHANGES_KEEP)
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))  # 结果保存秒数，客户端的重试需在此时间内完成
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))  # 进程内缓存的结果数
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+IDEMPOTENCY_PRUNE_INTERVAL = float(os.getenv("IDEMPOTENCY_PRUNE_INTERVAL", "600"))  # 清理过期幂等键的间隔秒数
+IDEMPOTENCY_PRUNE_BATCH = 1000  # 每个事务删除的行数
+
+class IdempotencyClaim:
+    # 随写事务一起提交的幂等键：写入和结果要么都提交，要么都回滚
+    __slots__ = ("user_id", "key", "fingerprint", "expires_at")
+
+    def __init__(self, user_id: int, key: str, fingerprint: bytes, expires_at: float):
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        self.expires_at = expires_at
+
+class IdempotentReplay(Exception):
+    # 写事务中发现该键已有结果（另一个 worker 刚刚提交），本次写入回滚，改为返回已保存的结果
+    def __init__(self, fingerprint: bytes, response: bytes, expires_at: float):
+        super().__init__("幂等键已有结果")
+        self.fingerprint = fingerprint
+        self.response = response
+        self.expires_at = expires_at
+
+def _get_idempotency_key(conn, user_id: int, key: str, now: float):
+    return conn.execute(
+        "SELECT fingerprint, response, expires_at FROM idempotency_keys WHERE user_id = ? AND key = ? AND expires_at > ?",
+        (user_id, key, now)
+    ).fetchone()
+
+def _claim_idempotency_key(cursor, claim: Optional[IdempotencyClaim]):
+    # 写事务开始后调用：此时已持有写锁，查询结果到提交前不会再变
+    if claim is None:
+        return
+    row = _get_idempotency_key(cursor, claim.user_id, claim.key, time.time())
+    if row is not None:
+        raise IdempotentReplay(*row)
+
+def _save_idempotency_key(cursor, claim: Optional[IdempotencyClaim], result: dict):
+    if claim is None:
+        return
+    # 已过期但尚未清理的旧记录直接覆盖
+    cursor.execute(
+        "INSERT OR REPLACE INTO idempotency_keys (user_id, key, fingerprint, response, expires_at) VALUES (?, ?, ?, ?, ?)",
+        (claim.user_id, claim.key, claim.fingerprint, dump_json(result), claim.expires_at)
+    )
+
+def _prune_idempotency_keys_tx(cursor, now: float, limit: int):
+    cursor.execute(
+        "DELETE FROM idempotency_keys WHERE (user_id, key) IN (SELECT user_id, key FROM idempotency_keys WHERE expires_at <= ? LIMIT ?)",
+        (now, limit)
+    )
+    return cursor.rowcount
+
+def prune_idempotency_keys(conn):
+    # 分批删除，每批一个短事务，不会长时间占用写锁
+    deleted = 0
+    while True:
+        count = run_write_transaction(conn, _prune_idempotency_keys_tx, time.time(), IDEMPOTENCY_PRUNE_BATCH)
+        deleted += count
+        if count < IDEMPOTENCY_PRUNE_BATCH:
+            return deleted
+
+class IdempotencyStore:
+    # 带 Idempotency-Key 的写请求：已完成的直接重放保存的响应，不进入写路径；
+    # 同一个键正在执行时，重复请求等待它的结果，而不是再执行一次。
+    # 结果与写入在同一个事务中提交，跨 worker 的重复请求由写锁串行化，后到的在事务内发现结果后回滚。
+    # 只在事件循环线程中访问，不需要加锁
+    def __init__(self, capacity=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._results = OrderedDict()  # (user_id, 键) -> (请求指纹, 响应内容, 过期时间)
+        self._inflight = {}  # (user_id, 键) -> (请求指纹, 执行中的任务)
+        self.hits = 0
+        self.stored_hits = 0
+        self.waits = 0
+        self.executions = 0
+        self.conflicts = 0
+
+    @staticmethod
+    def fingerprint(endpoint: str, request: BaseModel) -> bytes:
+        return hashlib.blake2b(endpoint.encode() + b"\0" + request.model_dump_json().encode(), digest_size=16).digest()
+
+    def _remember(self, cache_key, fingerprint: bytes, response: bytes, expires_at: float):
+        self._results[cache_key] = (fingerprint, response, expires_at)
+        self._results.move_to_end(cache_key)
+        while len(self._results) > self.capacity:
+            self._results.popitem(last=False)
+
+    def _replay(self, expected: bytes, fingerprint: bytes, response: bytes) -> Response:
+        if fingerprint != expected:
+            self.conflicts += 1
+            raise HTTPException(status_code=422, detail="该幂等键已用于其他请求")
+        return Response(content=response, media_type="application/json", headers={"Idempotent-Replayed": "true"})
+
+    async def run(self, db: Database, user_id: int, key: Optional[str], endpoint: str, request: BaseModel, execute):
+        # execute(claim) 执行写入并返回响应，claim 需要传入写事务
+        if key is None:
+            return await execute(None)
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH or not (key.isascii() and key.isprintable()):
+            raise HTTPException(status_code=400, detail="无效的幂等键")
+
+        fingerprint = self.fingerprint(endpoint, request)
+        cache_key = (user_id, key)
+        cached = self._results.get(cache_key)
+        if cached is not None:
+            if cached[2] > time.time():
+                self._results.move_to_end(cache_key)
+                self.hits += 1
+                return self._replay(fingerprint, cached[0], cached[1])
+            del self._results[cache_key]
+
+        inflight = self._inflight.get(cache_key)
+        if inflight is None:
+            claim = IdempotencyClaim(user_id, key, fingerprint, time.time() + self.ttl)
+            # 写入放在独立任务中执行：客户端断开不会中断它，结果照常保存，供重试时重放
+            task = asyncio.ensure_future(self._execute(db, cache_key, claim, execute))
+            self._inflight[cache_key] = (fingerprint, task)
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+            result, stored_fingerprint, response = await asyncio.shield(task)
+            if result is not None:
+                return result
+            return self._replay(fingerprint, stored_fingerprint, response)
+
+        if inflight[0] != fingerprint:
+            self.conflicts += 1
+            raise HTTPException(status_code=422, detail="该幂等键已用于其他请求")
+        self.waits += 1
+        _, stored_fingerprint, response = await asyncio.shield(inflight[1])
+        return self._replay(fingerprint, stored_fingerprint, response)
+
+    async def _execute(self, db: Database, cache_key, claim: IdempotencyClaim, execute):
+        # 先做一次只读查询：其他 worker 或重启前已完成的请求不进入写路径
+        row = await db.run(_get_idempotency_key, claim.user_id, claim.key, time.time())
+        if row is None:
+            try:
+                result = await execute(claim)
+            except IdempotentReplay as e:
+                row = (e.fingerprint, e.response, e.expires_at)
+            else:
+                self.executions += 1
+                response = dump_json(result)
+                self._remember(cache_key, claim.fingerprint, response, claim.expires_at)
+                return result, claim.fingerprint, response
+        self.stored_hits += 1
+        self._remember(cache_key, *row)
+        return None, row[0], row[1]
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._results),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "stored_hits": self.stored_hits,
+            "waits": self.waits,
+            "executions": self.executions,
+            "conflicts": self.conflicts,
+        }
+
+idempotency_store = IdempotencyStore()
+
+# 积分写入流水线：把并发到达的游戏记录合并成一个事务提交（group commit），
+# 每条记录的请求在所在批次提交后拿到自己的最新积分
+class EarnPipeline:
+    def __init__(self, db: Database, batch_max=EARN_BATCH_MAX, wait_ms=EARN_BATCH_WAIT_MS, queue_max=EARN_QUEUE_MAX):
+        self.db = db
+        self.batch_max = batch_max
+        self.wait = wait_ms / 1000
+        self.queue_max = queue_max
+        self._queue = None
+        self._task = None
+        self._closing = False
+        self.batches = 0
+        self.records = 0
+        self.rejected = 0
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._queue = asyncio.Queue(maxsize=self.queue_max)
+            self._task = asyncio.create_task(self._worker())
+
+    async def submit(self, user_id: int, record: GameRecord, claim: Optional[IdempotencyClaim] = None) -> dict:
+        self.start()
+        if self._closing:
+            raise HTTPException(status_code=503, detail="服务正在关闭，请稍后重试")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((user_id, record, claim, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="服务器繁忙，请稍后重试")
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.wait
+            while len(batch) < self.batch_max:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            results = await self.db.run(_earn_points_batch, [item[:3] for item in batch])
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.records += len(batch)
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        # 停止接收新记录，已排队的记录全部提交后再退出
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "records": self.records,
+            "rejected": self.rejected,
+        }
+
+earn_pipeline = EarnPipeline(db)
+
+# 后台定时任务，关闭时统一取消
+background_tasks = []
+
+async def _prune_cache_changes_periodically():
+    while True:
+        await asyncio.sleep(CACHE_CHANGES_PRUNE_INTERVAL)
+        try:
+            await db.run(prune_cache_changes)
+        except Exception:
+            # 清理失败不影响服务，下个周期再试
+            pass
+
+async def _prune_idempotency_keys_periodically():
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_PRUNE_INTERVAL)
+        try:
+            await db.run(prune_idempotency_keys)
+        except Exception:
+            # 清理失败不影响服务，下个周期再试
+            pass
+
+async def _recompute_pending_ratings():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, recompute_pending_ratings)
+    except Exception:
+        # 失败时保留待重算标记，下次启动再试，也可以手动执行 recompute-ratings
+        pass
+
+async def _rebuild_pending_rollups():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, rebuild_pending_rollups)
+    except Exception:
+        # 失败时保留待重建标记，下次启动再试，也可以手动执行 rebuild-rollups
+        pass
+
+async def _archive_periodically():
+    # 每批一个短事务，批与批之间让出写锁，在线写入只会偶尔多等一批的时间
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            cutoff = archive_cutoff(datetime.datetime.utcnow())
+            while await db.run(archive_batch, cutoff):
+                await asyncio.sleep(ARCHIVE_BATCH_PAUSE_MS / 1000)
+            await db.run(incremental_vacuum)
+        except Exception:
+            # 归档失败不影响服务，下个周期再试
+            pass
+
+async def _expire_rollups_periodically():
+    while True:
+        await asyncio.sleep(ROLLUP_EXPIRE_INTERVAL)
+        try:
+            await db.run(expire_rollups)
+        except Exception:
+            # 清理失败不影响服务，下个周期再试
+            pass
+
+# API路由
+@app.on_event("startup")
+async def startup_event():
+    init_database()
+    coherence.open()
+    await db.run(load_revoked_tokens)
+    await db.run(catalog_cache.load)
+    earn_pipeline.start()
+    # 排行榜加载耗时与用户数成正比，放到后台进行，不拖慢冷启动后的第一个响应
+    asyncio.ensure_future(leaderboard.ensure_loaded(db))
+    background_tasks.append(asyncio.ensure_future(_expire_rollups_periodically()))
+    background_tasks.append(asyncio.ensure_future(_prune_idempotency_keys_periodically()))
+    if await db.run(read_cache_version, "ratings_recompute"):
+        background_tasks.append(asyncio.ensure_future(_recompute_pending_ratings()))
+    if await db.run(read_cache_version, "rollups_rebuild"):
+        background_tasks.append(asyncio.ensure_future(_rebuild_pending_rollups()))
+    if ARCHIVE_AFTER_DAYS:
+        background_tasks.append(asyncio.ensure_future(_archive_periodically()))
+    if coherence.active:
+        background_tasks.append(asyncio.ensure_future(coherence.run(db)))
+        background_tasks.append(asyncio.ensure_future(_prune_cache_changes_periodically()))
+    if PUSH_ENABLED:
+        push_hub.start()
+        background_tasks.append(asyncio.ensure_future(push_hub.run(db)))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    push_hub.close()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await earn_pipeline.close()
+    password_hasher.shutdown()
+    coherence.close()
+    db.shutdown()
+    db_pool.close()
+
+@app.get("/")
+async def root():
+    return {"message": "羽毛球游戏API服务正在运行"}
+
+# 用户认证相关API
+def _register(conn, user: UserRegister, password_hash: str):
+    cursor = conn.cursor()
+
+    # 检查用户名和邮箱是否已存在
+    cursor.execute("SELECT id FROM users WHERE username = ? OR email = ?", (user.username, user.email))
+    if cursor.fetchone():
+        raise HTTPException(status_code=400, detail="用户名或邮箱已存在")
+
+    # 创建新用户
+    cursor.execute(
+        "INSERT INTO users (username, email, password_hash, current_points) VALUES (?, ?, ?, ?)",
+        (user.username, user.email, password_hash, 1000)  # 新用户赠送1000积分
+    )
+    user_id = cursor.lastrowid
+
+    # 给新用户添加基础装备
+    cursor.execute(
+        "INSERT INTO user_items (user_id, item_type, item_id, item_name, is_equipped) VALUES (?, ?, ?, ?, ?)",
+        (user_id, 'racket', 0, '基础球拍', True)
+    )
+    cursor.execute(
+        "INSERT INTO user_items (user_id, item_type, item_id, item_name, is_equipped) VALUES (?, ?, ?, ?, ?)",
+        (user_id, 'outfit', 0, '基础服装', True)
+    )
+
+    conn.commit()
+    leaderboard.update(user_id, user.username, 0, 0, 0)
+    return user_id
+
+@app.post("/api/auth/register", dependencies=[Depends(limit_ip_auth)])
+async def register(user: UserRegister, db: Database = Depends(get_db)):
+    try:
+        password_hash = await password_hasher.hash(user.password)
+        with admission.write_slot():
+            user_id = await db.run(_register, user, password_hash)
+
+        # 生成JWT token
+        token = create_jwt_token(user_id, user.username)
+
+        return {
+            "message": "注册成功",
+            "token": token,
+            "user": {
+                "id": user_id,
+                "username": user.username,
+                "email": user.email,
+                "current_points": 1000
+            }
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"注册失败: {str(e)}")
+
+def _find_login_user(conn, username: str):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, username, email, password_hash, current_points, total_points, games_played, games_won FROM users WHERE username = ?",
+        (username,)
+    )
+    return cursor.fetchone()
+
+def _record_login(conn, user_id: int, old_hash: str, new_hash: Optional[str]):
+    cursor = conn.cursor()
+
+    # 更新最后登录时间
+    cursor.execute(
+        "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?",
+        (user_id,)
+    )
+    # 透明升级旧的密码哈希；期间密码被修改过则不覆盖
+    if new_hash:
+        cursor.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+            (new_hash, user_id, old_hash)
+        )
+    conn.commit()
+
+@app.post("/api/auth/login", dependencies=[Depends(limit_ip_auth)])
+async def login(user: UserLogin, db: Database = Depends(get_db)):
+    try:
+        # 查找用户
+        user_data = await db.run(_find_login_user, user.username)
+
+        if not user_data:
+            await password_hasher.verify_dummy(user.password)
+            raise HTTPException(status_code=401, detail="用户名或密码错误")
+        if not await password_hasher.verify(user.password, user_data[3]):
+            raise HTTPException(status_code=401, detail="用户名或密码错误")
+
+        new_hash = None
+        if password_needs_rehash(user_data[3]):
+            new_hash = await password_hasher.hash(user.password)
+        with admission.write_slot():
+            await db.run(_record_login, user_data[0], user_data[3], new_hash)
+
+        # 生成JWT token
+        token = create_jwt_token(user_data[0], user_data[1])
+
+        return {
+            "message": "登录成功",
+            "token": token,
+            "user": {
+                "id": user_data[0],
+                "username": user_data[1],
+                "email": user_data[2],
+                "current_points": user_data[4],
+                "total_points": user_data[5],
+                "games_played": user_data[6],
+                "games_won": user_data[7]
+            }
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"登录失败: {str(e)}")
+
+USER_PROFILE_COLUMNS = "id, username, email, current_points, total_points, games_played, games_won, created_at, last_login"
+
+def _profile_payload(user_data) -> dict:
+    return {
+        "id": user_data[0],
+        "username": user_data[1],
+        "email": user_data[2],
+        "current_points": user_data[3],
+        "total_points": user_data[4],
+        "games_played": user_data[5],
+        "games_won": user_data[6],
+        "win_rate": round(user_data[6] / max(user_data[5], 1) * 100, 2),
+        "created_at": user_data[7],
+        "last_login": user_data[8]
+    }
+
+def _get_profile(conn, user_id: int):
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {USER_PROFILE_COLUMNS} FROM users WHERE id = ?",
+        (user_id,)
+    )
+    user_data = cursor.fetchone()
+
+    if not user_data:
+        raise HTTPException(status_code=404, detail="用户不存在")
+
+    return {"user": _profile_payload(user_data)}
+
+@app.post("/api/auth/logout", dependencies=[Depends(limit_ip_auth)])
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security), db: Database = Depends(get_db)):
+    payload = verify_jwt_token(credentials.credentials)
+    try:
+        # 写入数据库，其他 worker 和重启后的进程同样拒绝该token
+        expires_at = payload.get('exp') or time.time() + JWT_EXPIRATION_HOURS * 3600
+        with admission.write_slot():
+            await db.run(run_write_transaction, _revoke_token_tx, token_cache.digest(credentials.credentials), expires_at)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"登出失败: {str(e)}")
+    token_cache.revoke_token(credentials.credentials, payload.get('exp'))
+    return {"message": "已成功登出"}
+
+@app.get("/api/auth/profile")
+async def get_profile(current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    try:
+        return await db.run(_get_profile, current_user['user_id'])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取用户信息失败: {str(e)}")
+
+# 积分管理API
+def _get_points_balance(conn, user_id: int):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT current_points, total_points FROM users WHERE id = ?",
+        (user_id,)
+    )
+    points_data = cursor.fetchone()
+
+    return {
+        "current_points": points_data[0],
+        "total_points": points_data[1]
+    }
+
+@app.get("/api/points/balance")
+async def get_points_balance(current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    try:
+        return await db.run(_get_points_balance, current_user['user_id'])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取积分失败: {str(e)}")
+
+def _apply_game_record(cursor, user_id: int, record: GameRecord):
+    # 记录游戏结果
+    cursor.execute(
+        "INSERT INTO game_records (user_id, game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, record.game_type, record.result, record.points_earned, record.duration, record.player_score, record.ai_score, record.sets_won, record.sets_lost)
+    )
+
+    # 更新用户积分和统计
+    cursor.execute(
+        "UPDATE users SET current_points = current_points + ?, total_points = total_points + ?, games_played = games_played + 1, games_won = games_won + ? WHERE id = ?",
+        (record.points_earned, record.points_earned, 1 if record.result == 'win' else 0, user_id)
+    )
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=404, detail="用户不存在")
+
+    _update_user_stats(cursor, user_id, [record])
+    _update_rollups(cursor, user_id, [(datetime.datetime.utcnow(), record.points_earned, record.result == 'win')])
+    _update_ratings(cursor, user_id, [_record_rating_fields(record)])
+
+def _earn_points_batch_tx(cursor, items):
+    results = []
+    updated = {}
+
+    # 整批只提交一次；每条记录使用独立的保存点，单条失败不影响同批其他记录
+    for user_id, record, claim in items:
+        cursor.execute("SAVEPOINT earn")
+        try:
+            _claim_idempotency_key(cursor, claim)
+            _apply_game_record(cursor, user_id, record)
+
+            # 获取更新后的积分
+            cursor.execute(
+                "SELECT current_points, total_points, username, games_played, games_won FROM users WHERE id = ?",
+                (user_id,)
+            )
+            points_data = cursor.fetchone()
+            result = {
+                "message": "积分记录成功",
+                "points_earned": record.points_earned,
+                "current_points": points_data[0],
+                "total_points": points_data[1]
+            }
+            _save_idempotency_key(cursor, claim, result)
+            cursor.execute("RELEASE earn")
+        except Exception as e:
+            cursor.execute("ROLLBACK TO earn")
+            cursor.execute("RELEASE earn")
+            results.append(e)
+            continue
+
+        updated[user_id] = points_data
+        results.append(result)
+    return results, updated
+
+def _earn_points_batch(conn, items):
+    # 与其他写入相同经过 run_write_transaction：拿不到写锁时整批回滚后退避重试，不会让排队的请求全部失败
+    results, updated = run_write_transaction(conn, _earn_points_batch_tx, items)
+    for user_id, points_data in updated.items():
+        leaderboard.update(user_id, points_data[2], points_data[1], points_data[3], points_data[4])
+    return results
+
+@app.post("/api/points/earn")
+async def earn_points(record: GameRecord, current_user: dict = Depends(limit_user_write), db: Database = Depends(get_db),
+                      idempotency_key: Optional[str] = Header(None)):
+    user_id = current_user['user_id']
+
+    async def execute(claim):
+        # 不占用写并发名额：排队的记录由同一个写线程合并提交，积压由 EARN_QUEUE_MAX 限制（超过返回503）；
+        # 若每条排队记录都占一个名额，单批最多只能合并 WRITE_MAX_CONCURRENCY 条，排满后还会误返回429
+        result = await earn_pipeline.submit(user_id, record, claim)
+        push_hub.publish_balance(user_id, result["current_points"], result["total_points"])
+        return result
+
+    try:
+        return await idempotency_store.run(db, user_id, idempotency_key, "earn", record, execute)
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"记录积分失败: {str(e)}")
-    finally:
-        conn.close()
+
+def _validate_batch_record(record: BatchGameRecord) -> Optional[str]:
+    if record.result not in GAME_RESULTS:
+        return "无效的比赛结果"
+    if min(record.points_earned, record.duration, record.player_score, record.ai_score, record.sets_won, record.sets_lost) < 0:
+        return "数值不能为负数"
+    return None
+
+def _record_timestamp(played_at: Optional[datetime.datetime], now: datetime.datetime) -> str:
+    # 统一为UTC并与 CURRENT_TIMESTAMP 的格式一致；客户端时间晚于服务器时间时按服务器时间记录
+    if played_at is None:
+        played_at = now
+    elif played_at.tzinfo is not None:
+        played_at = played_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return min(played_at, now).strftime("%Y-%m-%d %H:%M:%S")
+
+def _earn_points_bulk(conn, user_id: int, records: List[BatchGameRecord], claim: Optional[IdempotencyClaim] = None):
+    now = datetime.datetime.utcnow()
+    results = []
+    accepted = []
+    for index, record in enumerate(records):
+        error = _validate_batch_record(record)
+        if error:
+            results.append({"index": index, "status": "rejected", "reason": error})
+            continue
+        accepted.append((_record_timestamp(record.played_at, now), index, record))
+        results.append({"index": index, "status": "accepted", "points_earned": record.points_earned})
+
+    # 按比赛时间顺序写入，保证历史记录的先后关系
+    accepted.sort(key=lambda item: (item[0], item[1]))
+
+    # 与其他写入相同经过 run_write_transaction：拿不到写锁时回滚后退避重试
+    result, points_data = run_write_transaction(conn, _earn_points_bulk_tx, user_id, accepted, results, claim)
+    leaderboard.update(user_id, points_data[2], points_data[1], points_data[3], points_data[4])
+    return result
+
+def _earn_points_bulk_tx(cursor, user_id: int, accepted: list, results: list, claim: Optional[IdempotencyClaim]):
+    # 先确认用户存在，再写入任何记录：不存在的用户不会留下比赛记录、统计、排行汇总和评分
+    cursor.execute("SELECT 1 FROM users WHERE id = ?", (user_id,))
+    if cursor.fetchone() is None:
+        raise HTTPException(status_code=404, detail="用户不存在")
+
+    _claim_idempotency_key(cursor, claim)
+    cursor.executemany(
+        "INSERT INTO game_records (user_id, game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (user_id, record.game_type, record.result, record.points_earned, record.duration, record.player_score, record.ai_score, record.sets_won, record.sets_lost, created_at)
+            for created_at, _, record in accepted
+        ]
+    )
+
+    _update_user_stats(cursor, user_id, [record for _, _, record in accepted])
+    _update_rollups(cursor, user_id, [
+        (datetime.datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S"), record.points_earned, record.result == 'win')
+        for created_at, _, record in accepted
+    ])
+    _update_ratings(cursor, user_id, [_record_rating_fields(record) for _, _, record in accepted])
+
+    # 整批只更新一次用户积分和统计
+    points = sum(record.points_earned for _, _, record in accepted)
+    wins = sum(1 for _, _, record in accepted if record.result == 'win')
+    cursor.execute(
+        "UPDATE users SET current_points = current_points + ?, total_points = total_points + ?, games_played = games_played + ?, games_won = games_won + ? WHERE id = ?",
+        (points, points, len(accepted), wins, user_id)
+    )
+    cursor.execute(
+        "SELECT current_points, total_points, username, games_played, games_won FROM users WHERE id = ?",
+        (user_id,)
+    )
+    points_data = cursor.fetchone()
+
+    result = {
+        "message": "积分记录成功",
+        "accepted": len(accepted),
+        "rejected": len(results) - len(accepted),
+        "points_earned": points,
+        "current_points": points_data[0],
+        "total_points": points_data[1],
+        "results": results
+    }
+    _save_idempotency_key(cursor, claim, result)
+    return result, points_data
+
+async def _read_limited_body(request: Request, max_bytes: int) -> bytes:
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail="请求体过大")
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail="请求体过大")
+    return bytes(body)
+
+@app.post("/api/points/earn/batch")
+async def earn_points_batch(request: Request, current_user: dict = Depends(limit_user_write), db: Database = Depends(get_db),
+                            idempotency_key: Optional[str] = Header(None)):
+    # 先限制请求体大小再解析，超大请求不会进入JSON解析
+    body = await _read_limited_body(request, EARN_BATCH_MAX_BYTES)
+    try:
+        batch = GameRecordBatch.model_validate_json(body)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"请求格式错误: {str(e)}")
+    if not batch.records:
+        raise HTTPException(status_code=400, detail="没有需要提交的记录")
+    if len(batch.records) > EARN_BATCH_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"单次最多提交{EARN_BATCH_MAX_RECORDS}条记录")
+
+    user_id = current_user['user_id']
+
+    async def execute(claim):
+        with admission.write_slot():
+            result = await db.run(_earn_points_bulk, user_id, batch.records, claim)
+        if "current_points" in result:
+            push_hub.publish_balance(user_id, result["current_points"], result["total_points"])
+        return result
+
+    try:
+        return await idempotency_store.run(db, user_id, idempotency_key, "earn_batch", batch, execute)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"记录积分失败: {str(e)}")
+
+HISTORY_COLUMNS = ("game_type", "result", "points_earned", "duration", "player_score", "ai_score", "sets_won", "sets_lost", "created_at")
+
+def encode_history_cursor(created_at: str, record_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, record_id]).encode()).decode().rstrip("=")
+
+def decode_history_cursor(token: str):
+    try:
+        created_at, record_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return str(created_at), int(record_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+def _history_page(conn, user_id: int, after, limit: int, archived: bool):
+    # 基于 (created_at, id) 的键集分页，沿 (user_id, created_at) 索引定位，翻到多深都不需要跳过前面的行
+    # id 放在最后一列：与 HISTORY_COLUMNS zip 时自动截掉，无需逐行切片
+    # archived 为调用方在开启事务前 attach_archive 的结果：事务中不能 ATTACH，这里不再检查
+    columns = ", ".join(HISTORY_COLUMNS)
+    if after is None:
+        where, params = "user_id = ?", (user_id,)
+    else:
+        where, params = "user_id = ? AND (created_at, id) < (?, ?)", (user_id, after[0], after[1])
+    query = f"SELECT {columns}, id FROM {{}}.game_records WHERE {where}"
+    order = "ORDER BY created_at DESC, id DESC LIMIT ?"
+    if not archived:
+        return conn.execute(f"{query.format('main')} {order}", params + (limit,)).fetchall()
+    # 两边都沿 (user_id, created_at) 索引按顺序读取并归并（MERGE），取满一页即停，不需要额外排序
+    return conn.execute(
+        f"{query.format('main')} UNION ALL {query.format('archive')} {order}",
+        params + params + (limit,)
+    ).fetchall()
+
+def _read_history_page(conn, user_id: int, after, limit: int):
+    # 不在事务中：先按需挂载归档库再分页
+    return _history_page(conn, user_id, after, limit, attach_archive(conn))
+
+def _get_points_history(conn, user_id: int, limit: int, after):
+    rows = _read_history_page(conn, user_id, after, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_history_cursor(rows[-1][8], rows[-1][9])
+
+    return {
+        "records": [dict(zip(HISTORY_COLUMNS, row)) for row in rows],
+        "next_cursor": next_cursor
+    }
 
 @app.get("/api/points/history")
-async def get_points_history(current_user: dict = Depends(get_current_user), limit: int = 20):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def get_points_history(current_user: dict = Depends(limit_user_read), limit: int = 20, cursor: Optional[str] = None, db: Database = Depends(get_db)):
+    limit = min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+    after = decode_history_cursor(cursor) if cursor else None
     try:
-        cursor.execute(
-            "SELECT game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at FROM game_records WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-            (current_user['user_id'], limit)
-        )
-        records = cursor.fetchall()
-        
-        return {
-            "records": [
-                {
-                    "game_type": record[0],
-                    "result": record[1],
-                    "points_earned": record[2],
-                    "duration": record[3],
-                    "player_score": record[4],
-                    "ai_score": record[5],
-                    "sets_won": record[6],
-                    "sets_lost": record[7],
-                    "created_at": record[8]
-                }
-                for record in records
-            ]
-        }
-    
+        return FastJSONResponse(await db.run(_get_points_history, current_user['user_id'], limit, after))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取积分历史失败: {str(e)}")
-    finally:
-        conn.close()
 
-@app.get("/api/points/leaderboard")
-async def get_leaderboard(limit: int = 10):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def _iter_history_export(db: Database, user_id: int, export_format: str):
+    # 按块分页读取并逐块输出，内存占用与历史总量无关；每块独立查询，不会长时间占用读快照
+    import csv
+    import io
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(HISTORY_COLUMNS)
+        yield buffer.getvalue().encode("utf-8")
+    after = None
+    while True:
+        rows = await db.run(_read_history_page, user_id, after, HISTORY_EXPORT_CHUNK)
+        if not rows:
+            break
+        if export_format == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(row[:-1] for row in rows)
+            yield buffer.getvalue().encode("utf-8")
+        else:
+            yield b"".join(dump_json(dict(zip(HISTORY_COLUMNS, row))) + b"\n" for row in rows)
+        if len(rows) < HISTORY_EXPORT_CHUNK:
+            break
+        after = (rows[-1][8], rows[-1][9])
+
+@app.get("/api/points/history/export")
+async def export_points_history(format: str = "ndjson", current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="仅支持 ndjson 或 csv 格式")
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv; charset=utf-8"
+    return StreamingResponse(
+        _iter_history_export(db, current_user['user_id'], format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="game_history.{format}"'}
+    )
+
+def _period_leaderboard(conn, period: str, bucket: str, limit: int, offset: int):
+    # 沿 idx_points_rollups_rank 按积分顺序读取当前时段，只涉及该时段有比赛的用户
+    rows = conn.execute(
+        """
+        SELECT u.username, r.points, r.games, r.wins
+        FROM points_rollups r JOIN users u ON u.id = r.user_id
+        WHERE r.period = ? AND r.bucket = ?
+        ORDER BY r.points DESC, r.user_id
+        LIMIT ? OFFSET ?
+        """,
+        (period, bucket, limit, offset)
+    ).fetchall()
+    total = conn.execute(
+        "SELECT COUNT(*) FROM points_rollups WHERE period = ? AND bucket = ?",
+        (period, bucket)
+    ).fetchone()[0]
+    return {
+        "period": period,
+        "bucket": bucket,
+        "leaderboard": [
+            {
+                "rank": offset + i + 1,
+                "username": username,
+                "total_points": points,
+                "games_played": games,
+                "games_won": wins,
+                "win_rate": round(wins / max(games, 1) * 100, 2)
+            }
+            for i, (username, points, games, wins) in enumerate(rows)
+        ],
+        "total_players": total
+    }
+
+def _rating_leaderboard(conn, game_type: str, limit: int, offset: int):
+    # 沿 idx_user_ratings_rank 按评分顺序读取，跳过定级赛未完成的用户
+    rows = conn.execute(
+        """
+        SELECT u.username, r.rating, r.games
+        FROM user_ratings r JOIN users u ON u.id = r.user_id
+        WHERE r.game_type = ? AND r.games >= ?
+        ORDER BY r.rating DESC, r.user_id
+        LIMIT ? OFFSET ?
+        """,
+        (game_type, RATING_PROVISIONAL_GAMES, limit, offset)
+    ).fetchall()
+    total = conn.execute(
+        "SELECT COUNT(*) FROM user_ratings WHERE game_type = ? AND games >= ?",
+        (game_type, RATING_PROVISIONAL_GAMES)
+    ).fetchone()[0]
+    return {
+        "sort": "rating",
+        "game_type": game_type,
+        "leaderboard": [
+            {
+                "rank": offset + i + 1,
+                "username": username,
+                "rating": round(rating, 1),
+                "games_played": games
+            }
+            for i, (username, rating, games) in enumerate(rows)
+        ],
+        "total_players": total
+    }
+
+@app.get("/api/points/leaderboard", dependencies=[Depends(limit_ip_read)])
+async def get_leaderboard(limit: int = 10, offset: int = 0, period: str = "all", sort: str = "points",
+                          game_type: Optional[str] = None, db: Database = Depends(get_db)):
+    if period != "all" and period not in ROLLUP_PERIODS:
+        raise HTTPException(status_code=400, detail="period 仅支持 all、day、week 或 season")
+    if sort not in ("points", "rating"):
+        raise HTTPException(status_code=400, detail="sort 仅支持 points 或 rating")
+    if sort == "rating" and (period != "all" or not game_type):
+        raise HTTPException(status_code=400, detail="按评分排序时需要指定 game_type，且 period 只能为 all")
     try:
-        cursor.execute(
-            "SELECT username, total_points, games_played, games_won FROM users ORDER BY total_points DESC LIMIT ?",
-            (limit,)
-        )
-        users = cursor.fetchall()
-        
-        return {
-            "leaderboard": [
-                {
-                    "rank": idx + 1,
-                    "username": user[0],
-                    "total_points": user[1],
-                    "games_played": user[2],
-                    "games_won": user[3],
-                    "win_rate": round(user[3] / max(user[2], 1) * 100, 2)
-                }
-                for idx, user in enumerate(users)
-            ]
-        }
-    
+        limit = min(max(limit, 1), LEADERBOARD_MAX_LIMIT)
+        if sort == "rating":
+            return FastJSONResponse(await db.run(_rating_leaderboard, game_type, limit, max(offset, 0)))
+        if period != "all":
+            bucket = rollup_bucket(period, datetime.datetime.utcnow())
+            return FastJSONResponse(await db.run(_period_leaderboard, period, bucket, limit, max(offset, 0)))
+        await leaderboard.ensure_loaded(db)
+        return FastJSONResponse({
+            "leaderboard": leaderboard.page(max(offset, 0), limit),
+            "total_players": len(leaderboard)
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取排行榜失败: {str(e)}")
+
+@app.get("/api/points/leaderboard/me")
+async def get_my_rank(radius: int = 5, current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    try:
+        await leaderboard.ensure_loaded(db)
+        rank, neighbours = leaderboard.around(current_user['user_id'], min(max(radius, 0), LEADERBOARD_MAX_LIMIT // 2))
+        if rank is None:
+            raise HTTPException(status_code=404, detail="用户不存在")
+        return FastJSONResponse({
+            "rank": rank,
+            "total_players": len(leaderboard),
+            "neighbours": neighbours
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取排名失败: {str(e)}")
+
+# 服务端推送API
+def _push_balance(conn, user_id: int) -> dict:
+    row = conn.execute("SELECT current_points, total_points FROM users WHERE id = ?", (user_id,)).fetchone()
+    return {"current_points": row[0], "total_points": row[1]} if row else {}
+
+def _issue_push_ticket_tx(cursor, digest: bytes, token_digest: bytes, payload: dict, now: float):
+    # 顺带清理过期票据：有效期很短，每次只有换票后没来得及使用的几条
+    cursor.execute("DELETE FROM push_tickets WHERE expires_at <= ?", (now,))
+    cursor.execute(
+        "INSERT INTO push_tickets (digest, token_digest, payload, expires_at) VALUES (?, ?, ?, ?)",
+        (digest, token_digest, dump_json(payload), now + PUSH_TICKET_TTL)
+    )
+
+def _redeem_push_ticket_tx(cursor, digest: bytes, now: float):
+    # 在写事务中读出后立即删除：同一票据只能建立一个连接，多个 worker 同时兑换时只有一个成功
+    cursor.execute("SELECT token_digest, payload FROM push_tickets WHERE digest = ? AND expires_at > ?", (digest, now))
+    row = cursor.fetchone()
+    cursor.execute("DELETE FROM push_tickets WHERE digest = ?", (digest,))
+    return row
+
+async def _push_events(db: Database, payload: dict, digest: bytes):
+    # 在生成器内订阅：响应开始前客户端就断开时生成器不会运行，也就不会留下无人清理的订阅
+    subscriber = push_hub.subscribe(payload['user_id'])
+    try:
+        # 先订阅再读余额：读之前到达的推送被这次读取覆盖，之后到达的照常推送
+        balance = await db.run(_push_balance, subscriber.user_id)
+        subscriber.balance = None
+        subscriber.last_balance = balance
+        push_hub.refresh_leaderboard()
+        yield b"retry: 3000\n\n" + sse_frame("balance", balance) + (push_hub.leaderboard_frame(subscriber) or b"")
+        while not subscriber.closed:
+            if not await subscriber.wait(PUSH_HEARTBEAT):
+                # 空闲时顺便检查token是否过期或已登出
+                if payload.get('exp', 0) < time.time() or token_cache.is_revoked(digest):
+                    yield sse_frame("expired", {})
+                    break
+                yield b": ping\n\n"
+                continue
+            frames = []
+            if subscriber.balance is not None:
+                frames.append(sse_frame("balance", subscriber.balance))
+                subscriber.balance = None
+            frame = push_hub.leaderboard_frame(subscriber)
+            if frame is not None:
+                frames.append(frame)
+            if frames:
+                push_hub.frames += len(frames)
+                yield b"".join(frames)
     finally:
-        conn.close()
+        push_hub.unsubscribe(subscriber)
 
-# 商店系统API
-@app.get("/api/shop/items")
-async def get_shop_items(item_type: Optional[str] = None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+@app.post("/api/push/ticket")
+async def create_push_ticket(credentials: HTTPAuthorizationCredentials = Depends(security),
+                             current_user: dict = Depends(limit_user_write), db: Database = Depends(get_db)):
+    # EventSource 无法设置请求头：先用 Authorization 头换一张短期、一次性的票据，
+    # 再用票据建立推送连接，token 不会出现在 URL 以及访问日志、代理日志中
+    if not PUSH_ENABLED:
+        raise HTTPException(status_code=404, detail="推送未启用")
     try:
-        if item_type:
-            cursor.execute(
-                "SELECT id, name, type, price, description, image_url, attributes FROM shop_items WHERE type = ? AND is_available = TRUE ORDER BY price",
-                (item_type,)
-            )
-        else:
-            cursor.execute(
-                "SELECT id, name, type, price, description, image_url, attributes FROM shop_items WHERE is_available = TRUE ORDER BY type, price"
+        ticket = secrets.token_urlsafe(32)
+        with admission.write_slot():
+            await db.run(
+                run_write_transaction, _issue_push_ticket_tx, token_cache.digest(ticket),
+                token_cache.digest(credentials.credentials), current_user, time.time()
             )
-        
-        items = cursor.fetchall()
-        
-        return {
-            "items": [
-                {
-                    "id": item[0],
-                    "name": item[1],
-                    "type": item[2],
-                    "price": item[3],
-                    "description": item[4],
-                    "image_url": item[5],
-                    "attributes": item[6]
-                }
-                for item in items
-            ]
-        }
-    
+        return {"ticket": ticket, "expires_in": PUSH_TICKET_TTL}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取推送票据失败: {str(e)}")
+
+@app.get("/api/push/stream", dependencies=[Depends(limit_ip_read)])
+async def push_stream(ticket: str, db: Database = Depends(get_db)):
+    if not PUSH_ENABLED:
+        raise HTTPException(status_code=404, detail="推送未启用")
+    try:
+        with admission.write_slot():
+            row = await db.run(run_write_transaction, _redeem_push_ticket_tx, token_cache.digest(ticket), time.time())
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"建立推送连接失败: {str(e)}")
+    if row is None:
+        raise HTTPException(status_code=401, detail="推送票据无效或已过期")
+    # 换票之后token可能已过期或登出
+    digest, payload = row[0], json.loads(row[1])
+    if payload.get('exp', 0) < time.time() or token_cache.is_revoked(digest):
+        raise HTTPException(status_code=401, detail="Token已失效，请重新登录")
+    push_hub.check_capacity(payload['user_id'])
+    return StreamingResponse(
+        _push_events(db, payload, digest),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# 商店系统API
+@app.get("/api/shop/items", dependencies=[Depends(limit_ip_read)])
+async def get_shop_items(item_type: Optional[str] = None, db: Database = Depends(get_db)):
+    try:
+        await catalog_cache.ensure_fresh(db)
+        return Response(content=catalog_cache.body(item_type), media_type="application/json")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取商店物品失败: {str(e)}")
-    finally:
-        conn.close()
+
+def _purchase_item_tx(cursor, user_id: int, purchase: PurchaseItem, item_name: str, item_price: int, claim: Optional[IdempotencyClaim] = None):
+    _claim_idempotency_key(cursor, claim)
+
+    # 添加物品到用户背包：唯一索引 idx_user_items_owner 保证同一物品只会插入一次
+    cursor.execute(
+        "INSERT OR IGNORE INTO user_items (user_id, item_type, item_id, item_name) VALUES (?, ?, ?, ?)",
+        (user_id, purchase.item_type, purchase.item_id, item_name)
+    )
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=400, detail="您已拥有该物品")
+
+    # 扣除积分：余额检查和扣减在同一条语句中完成，不会出现先读后写的竞争
+    cursor.execute(
+        "UPDATE users SET current_points = current_points - ? WHERE id = ? AND current_points >= ?",
+        (item_price, user_id, item_price)
+    )
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=400, detail="积分不足")
+
+    # 事务持有写锁，读到的就是刚扣减后的余额
+    cursor.execute("SELECT current_points, total_points FROM users WHERE id = ?", (user_id,))
+    current_points, total_points = cursor.fetchone()
+    result = {
+        "message": "购买成功",
+        "item_name": item_name,
+        "price": item_price,
+        "remaining_points": current_points,
+        "total_points": total_points
+    }
+    _save_idempotency_key(cursor, claim, result)
+    return result
+
+def _purchase_item(conn, user_id: int, purchase: PurchaseItem, item_name: str, item_price: int, claim: Optional[IdempotencyClaim] = None):
+    return run_write_transaction(conn, _purchase_item_tx, user_id, purchase, item_name, item_price, claim)
 
 @app.post("/api/shop/purchase")
-async def purchase_item(purchase: PurchaseItem, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
+async def purchase_item(purchase: PurchaseItem, current_user: dict = Depends(limit_user_write), db: Database = Depends(get_db),
+                        idempotency_key: Optional[str] = Header(None)):
+    user_id = current_user['user_id']
+
+    async def execute(claim):
         # 检查物品是否存在
-        cursor.execute(
-            "SELECT name, price FROM shop_items WHERE id = ? AND is_available = TRUE",
-            (purchase.item_id,)
-        )
-        item_data = cursor.fetchone()
-        
-        if not item_data:
+        await catalog_cache.ensure_fresh(db)
+        item = catalog_cache.get_item(purchase.item_id)
+        if not item or item["type"] != purchase.item_type:
             raise HTTPException(status_code=404, detail="物品不存在或不可购买")
-        
-        item_name, item_price = item_data
-        
-        # 检查用户是否已拥有该物品
-        cursor.execute(
-            "SELECT id FROM user_items WHERE user_id = ? AND item_id = ? AND item_type = ?",
-            (current_user['user_id'], purchase.item_id, purchase.item_type)
-        )
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="您已拥有该物品")
-        
-        # 检查用户积分是否足够
-        cursor.execute(
-            "SELECT current_points FROM users WHERE id = ?",
-            (current_user['user_id'],)
-        )
-        current_points = cursor.fetchone()[0]
-        
-        if current_points < item_price:
-            raise HTTPException(status_code=400, detail="积分不足")
-        
-        # 扣除积分
-        cursor.execute(
-            "UPDATE users SET current_points = current_points - ? WHERE id = ?",
-            (item_price, current_user['user_id'])
-        )
-        
-        # 添加物品到用户背包
-        cursor.execute(
-            "INSERT INTO user_items (user_id, item_type, item_id, item_name) VALUES (?, ?, ?, ?)",
-            (current_user['user_id'], purchase.item_type, purchase.item_id, item_name)
-        )
-        
-        conn.commit()
-        
-        return {
-            "message": "购买成功",
-            "item_name": item_name,
-            "price": item_price,
-            "remaining_points": current_points - item_price
-        }
-    
+
+        with admission.write_slot():
+            result = await db.run(_purchase_item, user_id, purchase, item["name"], item["price"], claim)
+        loadout_cache.invalidate(user_id)
+        push_hub.publish_balance(user_id, result["remaining_points"], result["total_points"])
+        return result
+
+    try:
+        return await idempotency_store.run(db, user_id, idempotency_key, "purchase", purchase, execute)
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"购买失败: {str(e)}")
-    finally:
-        conn.close()
+
+def _inventory_payload(cursor, user_id: int) -> list:
+    cursor.execute(
+        "SELECT item_type, item_id, item_name, is_equipped, purchased_at FROM user_items WHERE user_id = ? ORDER BY item_type, purchased_at",
+        (user_id,)
+    )
+    inventory = rows_to_dicts(cursor)
+    for item in inventory:
+        item["is_equipped"] = bool(item["is_equipped"])
+    return inventory
+
+def _get_user_inventory(conn, user_id: int):
+    return {"inventory": _inventory_payload(conn.cursor(), user_id)}
 
 @app.get("/api/shop/inventory")
-async def get_user_inventory(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def get_user_inventory(current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
     try:
-        cursor.execute(
-            "SELECT item_type, item_id, item_name, is_equipped, purchased_at FROM user_items WHERE user_id = ? ORDER BY item_type, purchased_at",
-            (current_user['user_id'],)
-        )
-        items = cursor.fetchall()
-        
-        return {
-            "inventory": [
-                {
-                    "item_type": item[0],
-                    "item_id": item[1],
-                    "item_name": item[2],
-                    "is_equipped": bool(item[3]),
-                    "purchased_at": item[4]
-                }
-                for item in items
-            ]
-        }
-    
+        return FastJSONResponse(await db.run(_get_user_inventory, current_user['user_id']))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取背包失败: {str(e)}")
-    finally:
-        conn.close()
+
+def _equip_item_tx(cursor, user_id: int, equip: EquipItem):
+    # 一条语句完成：装备指定物品并取消同类型其他物品；未拥有该物品时不更新任何行
+    cursor.execute(
+        """
+        UPDATE user_items SET is_equipped = (item_id = ?)
+        WHERE user_id = ? AND item_type = ?
+          AND EXISTS (SELECT 1 FROM user_items WHERE user_id = ? AND item_type = ? AND item_id = ?)
+        """,
+        (equip.item_id, user_id, equip.item_type, user_id, equip.item_type, equip.item_id)
+    )
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=404, detail="您没有该物品")
+
+    return {"message": "装备成功"}
+
+def _equip_item(conn, user_id: int, equip: EquipItem):
+    return run_write_transaction(conn, _equip_item_tx, user_id, equip)
 
 @app.put("/api/shop/equip")
-async def equip_item(equip: EquipItem, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def equip_item(equip: EquipItem, current_user: dict = Depends(limit_user_write), db: Database = Depends(get_db)):
     try:
-        # 检查用户是否拥有该物品
-        cursor.execute(
-            "SELECT id FROM user_items WHERE user_id = ? AND item_id = ? AND item_type = ?",
-            (current_user['user_id'], equip.item_id, equip.item_type)
-        )
-        if not cursor.fetchone():
-            raise HTTPException(status_code=404, detail="您没有该物品")
-        
-        # 取消装备同类型的其他物品
-        cursor.execute(
-            "UPDATE user_items SET is_equipped = FALSE WHERE user_id = ? AND item_type = ?",
-            (current_user['user_id'], equip.item_type)
-        )
-        
-        # 装备指定物品
-        cursor.execute(
-            "UPDATE user_items SET is_equipped = TRUE WHERE user_id = ? AND item_id = ? AND item_type = ?",
-            (current_user['user_id'], equip.item_id, equip.item_type)
-        )
-        
-        conn.commit()
-        
-        return {"message": "装备成功"}
-    
+        with admission.write_slot():
+            result = await db.run(_equip_item, current_user['user_id'], equip)
+        loadout_cache.invalidate(current_user['user_id'])
+        return result
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"装备失败: {str(e)}")
-    finally:
-        conn.close()
+
+@app.get("/api/shop/loadout")
+async def get_loadout(current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    try:
+        await catalog_cache.ensure_fresh(db)
+        loadouts = await loadout_cache.fetch(db, [current_user['user_id']])
+        if current_user['user_id'] not in loadouts:
+            raise HTTPException(status_code=404, detail="用户不存在")
+        return FastJSONResponse(loadouts[current_user['user_id']])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取装备加成失败: {str(e)}")
+
+@app.get("/api/shop/loadouts")
+async def get_loadouts(user_ids: str, current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    # 匹配时批量查询多名玩家的装备加成，user_ids 为逗号分隔的用户id；不存在的用户不出现在结果中
+    try:
+        try:
+            ids = list(dict.fromkeys(int(part) for part in user_ids.split(",") if part.strip()))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="无效的用户id")
+        if not ids or len(ids) > LOADOUT_BULK_MAX:
+            raise HTTPException(status_code=400, detail=f"一次最多查询{LOADOUT_BULK_MAX}名用户")
+        await catalog_cache.ensure_fresh(db)
+        loadouts = await loadout_cache.fetch(db, ids)
+        return FastJSONResponse({"loadouts": [loadouts[user_id] for user_id in ids if user_id in loadouts]})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取装备加成失败: {str(e)}")
 
 # 游戏统计API
+USER_STATS_JOIN_COLUMNS = (
+    "s.games, s.current_win_streak, s.best_win_streak, s.total_play_time, "
+    "s.total_score_margin, s.sets_won, s.sets_lost, s.game_types"
+)
+
+def _recent_games_payload(cursor, user_id: int, archived: bool) -> list:
+    # 长期未活跃用户的最近比赛可能已经归档，与历史记录走同一个查询
+    return [
+        {"result": row[1], "points_earned": row[2], "date": row[8]}
+        for row in _history_page(cursor.connection, user_id, None, 10, archived)
+    ]
+
+def _stats_payload(games_played, games_won, current_points, total_points, materialized) -> dict:
+    # materialized 为 user_stats 的各列，用户还没有比赛记录时全部为 None
+    games, current_streak, best_streak, play_time, score_margin, sets_won, sets_lost, game_types = materialized
+    game_types = json.loads(game_types) if game_types else {}
+    return {
+        "games_played": games_played,
+        "games_won": games_won,
+        "games_lost": games_played - games_won,
+        "win_rate": round(games_won / max(games_played, 1) * 100, 2),
+        "current_points": current_points,
+        "total_points": total_points,
+        "current_win_streak": current_streak or 0,
+        "best_win_streak": best_streak or 0,
+        "total_play_time": play_time or 0,
+        "average_score_margin": round((score_margin or 0) / max(games or 0, 1), 2),
+        "sets_won": sets_won or 0,
+        "sets_lost": sets_lost or 0,
+        "game_types": {
+            game_type: dict(counts, win_rate=round(counts["wins"] / max(sum(counts.values()), 1) * 100, 2))
+            for game_type, counts in game_types.items()
+        }
+    }
+
+def _get_game_stats(conn, user_id: int):
+    archived = attach_archive(conn)
+    cursor = conn.cursor()
+
+    # 基本统计与物化的用户统计一次主键查询取出
+    cursor.execute(
+        f"""
+        SELECT u.games_played, u.games_won, u.current_points, u.total_points, {USER_STATS_JOIN_COLUMNS}
+        FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+        WHERE u.id = ?
+        """,
+        (user_id,)
+    )
+    stats = cursor.fetchone()
+    if not stats:
+        raise HTTPException(status_code=404, detail="用户不存在")
+
+    return {
+        "stats": _stats_payload(stats[0], stats[1], stats[2], stats[3], stats[4:]),
+        "recent_games": _recent_games_payload(cursor, user_id, archived)
+    }
+
 @app.get("/api/game/stats")
-async def get_game_stats(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
+async def get_game_stats(current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    try:
+        return await db.run(_get_game_stats, current_user['user_id'])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取游戏统计失败: {str(e)}")
+
+def _get_ratings(conn, user_id: int):
+    rows = conn.execute(
+        "SELECT game_type, rating, games FROM user_ratings WHERE user_id = ? ORDER BY game_type",
+        (user_id,)
+    ).fetchall()
+    ratings = []
+    for game_type, rating, games in rows:
+        provisional = games < RATING_PROVISIONAL_GAMES
+        rank = None
+        if not provisional:
+            # 名次 = 评分更高的已定级用户数 + 1，沿 idx_user_ratings_rank 计数
+            rank = conn.execute(
+                "SELECT COUNT(*) FROM user_ratings WHERE game_type = ? AND rating > ? AND games >= ?",
+                (game_type, rating, RATING_PROVISIONAL_GAMES)
+            ).fetchone()[0] + 1
+        ratings.append({
+            "game_type": game_type,
+            "rating": round(rating, 1),
+            "games": games,
+            "provisional": provisional,
+            "rank": rank
+        })
+    return {"initial_rating": RATING_INITIAL, "ratings": ratings}
+
+@app.get("/api/game/rating")
+async def get_game_rating(current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    try:
+        return FastJSONResponse(await db.run(_get_ratings, current_user['user_id']))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取评分失败: {str(e)}")
+
+# 会话初始化API：登录后一次请求取回界面需要的全部数据
+BOOTSTRAP_SECTIONS = ("profile", "balance", "inventory", "loadout", "stats")
+
+def _bootstrap(conn, user_id: int, sections: set, loadout=None):
+    # loadout 为事件循环中 loadout_cache.lookup 的结果，未命中时在同一快照中读库
     cursor = conn.cursor()
-    
+    archived = "stats" in sections and attach_archive(conn)
+    # 显式开启读事务，所有查询看到同一个快照
+    cursor.execute("BEGIN")
     try:
-        # 获取基本统计
-        cursor.execute(
-            "SELECT games_played, games_won, current_points, total_points FROM users WHERE id = ?",
-            (current_user['user_id'],)
-        )
-        basic_stats = cursor.fetchone()
-        
-        # 获取最近游戏记录
         cursor.execute(
-            "SELECT result, points_earned, created_at FROM game_records WHERE user_id = ? ORDER BY created_at DESC LIMIT 10",
-            (current_user['user_id'],)
+            f"""
+            SELECT {", ".join("u." + column for column in USER_PROFILE_COLUMNS.split(", "))}, {USER_STATS_JOIN_COLUMNS}
+            FROM users u LEFT JOIN user_stats s ON s.user_id = u.id
+            WHERE u.id = ?
+            """,
+            (user_id,)
         )
-        recent_games = cursor.fetchall()
-        
-        # 计算连胜记录
-        win_streak = 0
-        for game in recent_games:
-            if game[0] == 'win':
-                win_streak += 1
-            else:
-                break
-        
-        return {
-            "stats": {
-                "games_played": basic_stats[0],
-                "games_won": basic_stats[1],
-                "games_lost": basic_stats[0] - basic_stats[1],
-                "win_rate": round(basic_stats[1] / max(basic_stats[0], 1) * 100, 2),
-                "current_points": basic_stats[2],
-                "total_points": basic_stats[3],
-                "current_win_streak": win_streak
-            },
-            "recent_games": [
-                {
-                    "result": game[0],
-                    "points_earned": game[1],
-                    "date": game[2]
-                }
-                for game in recent_games
-            ]
-        }
-    
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"获取游戏统计失败: {str(e)}")
+        user_data = cursor.fetchone()
+        if not user_data:
+            raise HTTPException(status_code=404, detail="用户不存在")
+
+        result = {}
+        if "profile" in sections:
+            result["user"] = _profile_payload(user_data)
+        if "balance" in sections:
+            result["balance"] = {
+                "current_points": user_data[3],
+                "total_points": user_data[4]
+            }
+        if "inventory" in sections:
+            result["inventory"] = _inventory_payload(cursor, user_id)
+        if "loadout" in sections:
+            # 与 /api/shop/loadout 的响应相同，包含装备属性和加成汇总
+            loadouts, missing, started = loadout
+            if missing:
+                loadouts = loadout_cache.load(conn, missing, started)
+            result["loadout"] = loadouts[user_id]
+        if "stats" in sections:
+            result["stats"] = _stats_payload(user_data[5], user_data[6], user_data[3], user_data[4], user_data[9:])
+            result["recent_games"] = _recent_games_payload(cursor, user_id, archived)
+        return result
     finally:
-        conn.close()
+        conn.rollback()
+
+@app.get("/api/me/bootstrap")
+async def get_bootstrap(include: Optional[str] = None, current_user: dict = Depends(limit_user_read), db: Database = Depends(get_db)):
+    sections = set(BOOTSTRAP_SECTIONS)
+    if include:
+        sections = {section.strip() for section in include.split(",") if section.strip()}
+        unknown = sections - set(BOOTSTRAP_SECTIONS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知的数据项: {', '.join(sorted(unknown))}")
+    try:
+        loadout = None
+        if "loadout" in sections:
+            await catalog_cache.ensure_fresh(db)
+            loadout = loadout_cache.lookup([current_user['user_id']])
+        return await db.run(_bootstrap, current_user['user_id'], sections, loadout)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取用户数据失败: {str(e)}")
 
 # 健康检查
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.datetime.utcnow().isoformat()}
 
+# 监控指标（Prometheus 文本格式）
+@app.get("/metrics")
+async def get_metrics():
+    gauges = {}
+    for prefix, stats in (
+        ("db_pool", db_pool.stats()),
+        ("db_executor", db.stats()),
+        ("earn_pipeline", earn_pipeline.stats()),
+        ("token_cache", token_cache.stats()),
+        ("loadout_cache", loadout_cache.stats()),
+        ("cache_coherence", coherence.stats()),
+        ("push", push_hub.stats()),
+        ("idempotency", idempotency_store.stats()),
+        ("password_hasher", password_hasher.stats()),
+        ("admission", admission.stats()),
+    ):
+        for name, value in stats.items():
+            gauges[f"{prefix}_{name}"] = value
+    gauges["leaderboard_players"] = len(leaderboard)
+    return Response(content=metrics.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# 维护任务：python main.py <命令>
+def _run_maintenance(command: str):
+    init_database()
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        result = MAINTENANCE_COMMANDS[command](conn)
+    finally:
+        conn.close()
+    print(f"{command}: {result}")
+
+MAINTENANCE_COMMANDS = {
+    "backfill-stats": backfill_user_stats,
+    "rebuild-rollups": rebuild_rollups,
+    "expire-rollups": expire_rollups,
+    "archive-records": archive_records,
+    "compact": compact_database,
+    "prune-cache-changes": prune_cache_changes,
+    "prune-idempotency-keys": prune_idempotency_keys,
+    "recompute-ratings": recompute_ratings,
+}
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1:
+        if sys.argv[1] not in MAINTENANCE_COMMANDS:
+            sys.exit(f"未知命令: {sys.argv[1]}，可用命令: {', '.join(MAINTENANCE_COMMANDS)}")
+        _run_maintenance(sys.argv[1])
+    else:
+        import uvicorn
+        # uvicorn 要等所有连接结束才执行 shutdown 事件，推送连接不会自己结束：宽限期过后由 uvicorn 取消，
+        # 再由 shutdown 事件关闭推送。用命令行启动时同样需要传入 --timeout-graceful-shutdown
+        uvicorn.run(app, host="0.0.0.0", port=8001, timeout_graceful_shutdown=PUSH_SHUTDOWN_GRACE)
@@ -0,0 +1,88 @@
+# 会话初始化基准：/api/me/bootstrap 一次请求 vs 资料、背包、统计、余额四次请求
+#
+#   python benchmarks/bench_bootstrap.py --rounds 500
+#
+# 统计每轮的服务端耗时（数据库线程内执行时间之和）、执行的 SQL 语句数，
+# 以及其中读取 users 行的次数。
+import argparse
+import json
+import time
+
+from fastapi.testclient import TestClient
+
+from common import Timer, auth_headers, load_app, register_user, sample_game_record
+
+SEPARATE_CALLS = ("/api/auth/profile", "/api/points/balance", "/api/shop/inventory", "/api/game/stats")
+
+
+class SqlCounter:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.statements = 0
+        self.user_reads = 0
+        self.server_time = 0.0
+
+    def trace(self, sql):
+        self.statements += 1
+        if "FROM users" in sql:
+            self.user_reads += 1
+
+
+def instrument(main, counter):
+    # 包装 Database._call，在数据库线程内挂上 trace 回调并累计执行时间
+    original = main.db._call
+
+    def call(fn, args, deadline):
+        def traced(conn, *fn_args):
+            conn.set_trace_callback(counter.trace)
+            start = time.perf_counter()
+            try:
+                return fn(conn, *fn_args)
+            finally:
+                counter.server_time += time.perf_counter() - start
+                conn.set_trace_callback(None)
+        return original(traced, args, deadline)
+
+    main.db._call = call
+
+
+def measure(client, headers, counter, paths, rounds):
+    counter.reset()
+    with Timer() as t:
+        for _ in range(rounds):
+            for path in paths:
+                client.get(path, headers=headers).raise_for_status()
+    return {
+        "requests_per_round": len(paths),
+        "wall_ms_per_round": round(t.elapsed / rounds * 1000, 3),
+        "server_ms_per_round": round(counter.server_time / rounds * 1000, 3),
+        "statements_per_round": counter.statements / rounds,
+        "user_row_reads_per_round": counter.user_reads / rounds,
+    }
+
+
+def main_(args):
+    main = load_app()
+    counter = SqlCounter()
+    with TestClient(main.app) as client:
+        headers = auth_headers(register_user(client, "bootstrap_bench"))
+        for i in range(args.games):
+            client.post("/api/points/earn", json=sample_game_record(i), headers=headers).raise_for_status()
+        for item in client.get("/api/shop/items").json()["items"][:3]:
+            client.post("/api/shop/purchase", json={"item_id": item["id"], "item_type": item["type"]}, headers=headers)
+
+        instrument(main, counter)
+        report = {
+            "separate": measure(client, headers, counter, SEPARATE_CALLS, args.rounds),
+            "bootstrap": measure(client, headers, counter, ("/api/me/bootstrap",), args.rounds),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=500)
+    parser.add_argument("--games", type=int, default=20)
+    main_(parser.parse_args())
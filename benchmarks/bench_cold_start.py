@@ -0,0 +1,68 @@
+# 冷启动基准：从 import 到第一个响应的耗时
+#
+#   python benchmarks/bench_cold_start.py --runs 10
+#
+# 每次在全新的子进程中计时：导入 api/main.py、执行启动事件、完成第一个请求。
+# 分别测量空数据库（需要执行全部迁移）和已是最新结构的数据库（走快速路径）。
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+CHILD = r"""
+import json, os, sys, time
+# 测试客户端属于测量工具本身，先于计时导入
+from fastapi.testclient import TestClient
+t0 = time.perf_counter()
+sys.path.insert(0, {api_dir!r})
+import main
+t_import = time.perf_counter()
+with TestClient(main.app) as client:
+    t_started = time.perf_counter()
+    client.get({path!r}).raise_for_status()
+    t_first = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (t_import - t0) * 1000,
+    "startup_ms": (t_started - t_import) * 1000,
+    "first_response_ms": (t_first - t0) * 1000,
+}}))
+"""
+
+
+def run_child(db_path, path):
+    from common import API_DIR
+    code = CHILD.format(api_dir=str(API_DIR), path=path)
+    env = {"DB_PATH": str(db_path), "PATH": "/usr/bin:/bin"}
+    out = subprocess.run([sys.executable, "-W", "ignore", "-c", code], check=True,
+                         capture_output=True, text=True, env=env).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {
+        key: round(statistics.median(sample[key] for sample in samples), 1)
+        for key in samples[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--path", default="/api/shop/items")
+    args = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix="badminton-cold-"))
+    fresh = [run_child(tmp / f"fresh{i}.db", args.path) for i in range(args.runs)]
+    current = [run_child(tmp / "fresh0.db", args.path) for _ in range(args.runs)]
+    print(json.dumps({
+        "runs": args.runs,
+        "empty_database_median_ms": summarize(fresh),
+        "current_schema_median_ms": summarize(current),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
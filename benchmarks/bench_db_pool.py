@@ -0,0 +1,67 @@
+# 对比“每次请求新建连接”与连接池两种模式下的吞吐量
+#
+#   python benchmarks/bench_db_pool.py --requests 2000
+#
+# 旧行为通过 DB_CONN_MAX_USES=1 模拟：每个连接只借出一次，归还即关闭，
+# 与原先 get_db_connection() 每次 connect/close 的开销一致。
+import argparse
+import json
+import subprocess
+import sys
+
+from common import Timer, auth_headers, load_app, register_user, sample_game_record
+
+MODES = {
+    "connect-per-request": {"DB_CONN_MAX_USES": 1},
+    "pool": {"DB_CONN_MAX_USES": 0},
+}
+
+
+def run_mode(mode, requests):
+    main = load_app(**MODES[mode])
+    from fastapi.testclient import TestClient
+
+    results = {}
+    with TestClient(main.app) as client:
+        token = register_user(client, "bench_pool")
+        headers = auth_headers(token)
+        for _ in range(50):  # 预热
+            client.get("/api/auth/profile", headers=headers)
+
+        with Timer() as t:
+            for _ in range(requests):
+                client.get("/api/auth/profile", headers=headers)
+        results["/api/auth/profile"] = round(requests / t.elapsed, 1)
+
+        with Timer() as t:
+            for i in range(requests):
+                client.post("/api/points/earn", json=sample_game_record(i), headers=headers)
+        results["/api/points/earn"] = round(requests / t.elapsed, 1)
+
+        results["pool"] = main.db_pool.stats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--mode", choices=sorted(MODES))
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.requests)))
+        return
+
+    # 每种模式在独立进程中运行，保证配置和数据库互不影响
+    report = {}
+    for mode in MODES:
+        out = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--requests", str(args.requests)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        report[mode] = json.loads(out.strip().splitlines()[-1])
+    print(json.dumps({"requests_per_sec": report}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
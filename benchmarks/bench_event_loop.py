@@ -0,0 +1,86 @@
+# 写入风暴期间 /health 与 /api/shop/items 的尾延迟
+#
+#   python benchmarks/bench_event_loop.py --writers 64 --seconds 5
+#
+# 在同一个事件循环上并发发起大量 /api/points/earn 写请求，同时持续探测
+# 轻量的读接口。数据库操作如果阻塞事件循环，探测请求的 p99 会随写入量暴涨。
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from common import auth_headers, load_app, percentile, sample_game_record
+
+
+async def probe(client, path, stop, samples):
+    while not stop.is_set():
+        start = time.perf_counter()
+        resp = await client.get(path)
+        samples.append((time.perf_counter() - start) * 1000)
+        resp.raise_for_status()
+        await asyncio.sleep(0.005)
+
+
+async def writer(client, headers, stop, counter):
+    i = 0
+    while not stop.is_set():
+        resp = await client.post("/api/points/earn", json=sample_game_record(i), headers=headers)
+        if resp.status_code == 200:
+            counter["ok"] += 1
+        else:
+            counter[resp.status_code] = counter.get(resp.status_code, 0) + 1
+        i += 1
+
+
+async def measure(client, tokens, writers, seconds):
+    stop = asyncio.Event()
+    samples = {"/health": [], "/api/shop/items": []}
+    counter = {"ok": 0}
+    tasks = [asyncio.create_task(probe(client, path, stop, s)) for path, s in samples.items()]
+    tasks += [
+        asyncio.create_task(writer(client, auth_headers(tokens[i % len(tokens)]), stop, counter))
+        for i in range(writers)
+    ]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return {
+        "writes": counter,
+        "latency_ms": {
+            path: {
+                "p50": round(percentile(s, 50), 2),
+                "p99": round(percentile(s, 99), 2),
+                "samples": len(s),
+            }
+            for path, s in samples.items()
+        },
+    }
+
+
+async def run(args):
+    main = load_app()
+    main.init_database()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        tokens = []
+        for i in range(args.users):
+            resp = await client.post("/api/auth/register", json={
+                "username": f"storm{i}", "email": f"storm{i}@bench.local", "password": "bench",
+            })
+            tokens.append(resp.json()["token"])
+        report = {
+            "idle": await measure(client, tokens, 0, args.seconds),
+            "write_storm": await measure(client, tokens, args.writers, args.seconds),
+            "executor": main.db.stats(),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=64)
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,103 @@
+# 大量历史记录下的分页与导出基准（默认单个用户100万条记录）
+#
+#   python benchmarks/bench_history.py --records 1000000
+#
+# 对比一次性 fetchall 构造全部字典（旧接口 limit 不设上限时的做法）与
+# 键集分页、NDJSON 流式导出的耗时和 Python 堆内存峰值。
+import argparse
+import asyncio
+import datetime
+import json
+import tracemalloc
+
+from common import Timer, auth_headers, load_app, register_user
+
+
+def seed(main, user_id, records):
+    conn = main.db_pool.acquire()
+    try:
+        start = datetime.datetime(2024, 1, 1)
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO game_records (user_id, game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at) VALUES (?, 'single', ?, ?, 300, 11, 7, 2, 1, ?)",
+            (
+                (user_id, "win" if i % 3 else "lose", 50 + i % 100,
+                 (start + datetime.timedelta(seconds=30 * i)).strftime("%Y-%m-%d %H:%M:%S"))
+                for i in range(records)
+            ),
+        )
+        conn.commit()
+    finally:
+        main.db_pool.release(conn)
+
+
+def measure_memory(fn):
+    tracemalloc.start()
+    with Timer() as t:
+        result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, round(t.elapsed, 3), round(peak / 1024 / 1024, 1)
+
+
+def legacy_fetch_all(main, user_id):
+    # 旧实现：一次查询全部记录并在内存中构造字典列表
+    conn = main.db_pool.acquire()
+    try:
+        rows = conn.execute(
+            "SELECT game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at FROM game_records WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, 10 ** 9),
+        ).fetchall()
+        return len([dict(zip(main.HISTORY_COLUMNS, row)) for row in rows])
+    finally:
+        main.db_pool.release(conn)
+
+
+async def export_ndjson(main, user_id):
+    # 直接消费服务端的导出生成器并丢弃输出；httpx 的 ASGITransport 会缓冲整个响应体，
+    # 通过它测量会把客户端缓冲也算进内存峰值
+    lines = 0
+    async for chunk in main._iter_history_export(main.db, user_id, "ndjson"):
+        lines += chunk.count(b"\n")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    main = load_app()
+    from fastapi.testclient import TestClient
+
+    report = {"records": args.records}
+    with TestClient(main.app) as client:
+        token = register_user(client, "history")
+        headers = auth_headers(token)
+        with Timer() as t:
+            seed(main, 1, args.records)
+        report["seed_s"] = round(t.elapsed, 1)
+
+        with Timer() as t:
+            page = client.get("/api/points/history?limit=100", headers=headers).json()
+        report["first_page_ms"] = round(t.elapsed * 1000, 2)
+
+        # 连续翻50页，测量深翻页的单页延迟
+        cursor = page["next_cursor"]
+        with Timer() as t:
+            for _ in range(50):
+                page = client.get(f"/api/points/history?limit=100&cursor={cursor}", headers=headers).json()
+                cursor = page["next_cursor"]
+        report["cursor_page_ms"] = round(t.elapsed * 1000 / 50, 2)
+
+        count, seconds, peak = measure_memory(lambda: legacy_fetch_all(main, 1))
+        report["legacy_fetch_all"] = {"rows": count, "seconds": seconds, "peak_mb": peak}
+
+        count, seconds, peak = measure_memory(lambda: asyncio.run(export_ndjson(main, 1)))
+        report["ndjson_export"] = {"rows": count, "seconds": seconds, "peak_mb": peak}
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# 内存排行榜基准：100万合成用户的建表、积分更新、名次与分页查询
+#
+#   python benchmarks/bench_leaderboard.py --users 1000000
+import argparse
+import json
+import random
+
+from common import Timer, load_app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--ops", type=int, default=100_000)
+    args = parser.parse_args()
+
+    app = load_app()
+    rnd = random.Random(42)
+    rows = [
+        (user_id, f"user{user_id}", rnd.randint(0, 50_000), 0, 0)
+        for user_id in range(1, args.users + 1)
+    ]
+    rows.sort(key=lambda row: (-row[2], row[0]))
+    points = {row[0]: row[2] for row in rows}
+    board = app.Leaderboard()
+    report = {"users": args.users}
+
+    with Timer() as t:
+        board.bulk_load(rows)
+    report["bulk_load_s"] = round(t.elapsed, 2)
+
+    user_ids = [rnd.randint(1, args.users) for _ in range(args.ops)]
+    with Timer() as t:
+        for user_id in user_ids:
+            points[user_id] += rnd.randint(10, 300)
+            board.update(user_id, f"user{user_id}", points[user_id], 1, 1)
+    report["update_per_s"] = round(args.ops / t.elapsed)
+
+    with Timer() as t:
+        for user_id in user_ids:
+            board.around(user_id, 5)
+    report["rank_with_neighbours_per_s"] = round(args.ops / t.elapsed)
+
+    with Timer() as t:
+        for _ in range(args.ops // 10):
+            board.page(rnd.randint(0, args.users - 100), 20)
+    report["page_20_per_s"] = round(args.ops / 10 / t.elapsed)
+
+    with Timer() as t:
+        for _ in range(args.ops // 10):
+            board.page(0, 10)
+    report["top_10_per_s"] = round(args.ops / 10 / t.elapsed)
+
+    # 抽样核对名次：与按 (积分降序, id升序) 完整排序的结果一致
+    expected = sorted(points, key=lambda uid: (-points[uid], uid))
+    for rank in rnd.sample(range(args.users), 1000):
+        entry = board.page(rank, 1)[0]
+        assert entry["username"] == f"user{expected[rank]}", (rank, entry)
+    report["verified_ranks"] = 1000
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
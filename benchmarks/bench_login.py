@@ -0,0 +1,84 @@
+# 登录洪峰基准：登录吞吐量，以及洪峰期间无关接口的延迟
+#
+#   python benchmarks/bench_login.py --users 8 --concurrency 32 --seconds 5
+#
+# 密码哈希在独立的工作池中执行，洪峰期间 /health 与 /api/shop/items 的
+# p99 应与空闲时处于同一量级；超出 PASSWORD_MAX_PENDING 的登录会收到 503。
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from common import load_app, percentile
+
+
+async def probe(client, path, stop, samples):
+    while not stop.is_set():
+        start = time.perf_counter()
+        (await client.get(path)).raise_for_status()
+        samples.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.005)
+
+
+async def login_loop(client, username, stop, counter, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        resp = await client.post("/api/auth/login", json={"username": username, "password": "bench-password"})
+        counter[resp.status_code] = counter.get(resp.status_code, 0) + 1
+        if resp.status_code == 200:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def measure(client, usernames, concurrency, seconds):
+    stop = asyncio.Event()
+    samples = {"/health": [], "/api/shop/items": []}
+    counter, latencies = {}, []
+    tasks = [asyncio.create_task(probe(client, path, stop, s)) for path, s in samples.items()]
+    tasks += [
+        asyncio.create_task(login_loop(client, usernames[i % len(usernames)], stop, counter, latencies))
+        for i in range(concurrency)
+    ]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    return {
+        "login_status_counts": counter,
+        "logins_per_sec": round(counter.get(200, 0) / seconds, 1),
+        "login_p99_ms": round(percentile(latencies, 99), 1),
+        "latency_ms": {
+            path: {"p50": round(percentile(s, 50), 2), "p99": round(percentile(s, 99), 2)}
+            for path, s in samples.items()
+        },
+    }
+
+
+async def run(args):
+    main = load_app()
+    main.init_database()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        usernames = []
+        for i in range(args.users):
+            username = f"login{i}"
+            resp = await client.post("/api/auth/register", json={
+                "username": username, "email": f"{username}@bench.local", "password": "bench-password",
+            })
+            resp.raise_for_status()
+            usernames.append(username)
+        report = {
+            "idle": await measure(client, usernames, 0, args.seconds),
+            "login_burst": await measure(client, usernames, args.concurrency, args.seconds),
+            "hasher": main.password_hasher.stats(),
+        }
+    main.password_hasher.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,286 @@
+# 推送（SSE）压测：保持大量空闲推送连接，测量每个 worker 的内存与 CPU 开销、每次排行榜广播的 CPU 成本，
+# 以及余额推送和排行榜广播的送达延迟。广播成本 = 广播阶段 CPU - 无推送连接时同样提交负载的 CPU
+#
+#   python benchmarks/bench_push.py --connections 2000 --idle-seconds 5 --broadcast-seconds 10
+#
+# 推送连接是长连接，进程内的 ASGI 客户端会缓冲整个响应，因此这里在本机启动一个 uvicorn 子进程，
+# 用原始 socket 建立连接。服务端 CPU 时间从 /proc 读取（仅 Linux）。
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from common import API_DIR, load_app, percentile, sample_game_record
+from seed import seed_database, seed_username
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_cpu(pid):
+    # utime + stime，单位秒
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def process_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def push_metrics(client):
+    text = (await client.get("/metrics")).text
+    return {
+        line.split()[0][len("push_"):]: float(line.split()[1])
+        for line in text.splitlines()
+        if line.startswith("push_")
+    }
+
+
+class PushConnection:
+    # 一个原始 SSE 连接：只解析 event 行，记录每个事件的到达时间
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.reader = None
+        self.writer = None
+        self.events = []  # (到达时间, 事件名, data)
+
+    async def open(self, port, ticket):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.writer.write(
+            f"GET /api/push/stream?ticket={ticket} HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n".encode()
+        )
+        await self.writer.drain()
+        status = await self.reader.readline()
+        if b" 200 " not in status:
+            raise RuntimeError(f"推送连接失败: {status!r}")
+        while await self.reader.readline() not in (b"\r\n", b""):
+            pass
+
+    async def listen(self):
+        # 响应为 chunked 编码，chunk 长度行不以 event/data 开头，直接忽略
+        event = None
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                if line.startswith(b"event: "):
+                    event = line[7:].strip().decode()
+                elif line.startswith(b"data: ") and event:
+                    self.events.append((time.perf_counter(), event, line[6:]))
+                    event = None
+        except (ConnectionError, asyncio.CancelledError):
+            return
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def push_ticket(client, token):
+    resp = await client.post("/api/push/ticket", headers={"Authorization": f"Bearer {token}"})
+    resp.raise_for_status()
+    return resp.json()["ticket"]
+
+
+async def open_connections(client, port, tokens, count, batch=200):
+    # 票据有效期很短，每批连接之前再换票
+    connections = [PushConnection(user_id) for user_id, _ in (tokens[i % len(tokens)] for i in range(count))]
+    for start in range(0, count, batch):
+        chunk = range(start, min(start + batch, count))
+        tickets = await asyncio.gather(*(push_ticket(client, tokens[i % len(tokens)][1]) for i in chunk))
+        await asyncio.gather(*(connections[i].open(port, ticket) for i, ticket in zip(chunk, tickets)))
+    return connections
+
+
+async def drive_earns(client, tokens, rate, seconds, rng, sent):
+    # 按固定速率提交比赛记录，记录每次提交的开始时间和返回的余额，用于计算余额推送延迟
+    interval = 1 / rate
+    deadline = time.perf_counter() + seconds
+    next_at = time.perf_counter()
+    pending = set()
+    while time.perf_counter() < deadline:
+        user_id, token = rng.choice(tokens)
+        record = sample_game_record(rng.randint(0, 999))
+
+        async def earn(user_id=user_id, token=token, record=record):
+            started = time.perf_counter()
+            resp = await client.post("/api/points/earn", json=record, headers={"Authorization": f"Bearer {token}"})
+            if resp.status_code == 200:
+                sent.append((user_id, started, resp.json()["current_points"]))
+
+        task = asyncio.ensure_future(earn())
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        next_at += interval
+        await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+    if pending:
+        await asyncio.gather(*pending)
+
+
+def balance_latencies(connections, sent):
+    # 同一用户的所有连接都应收到余额推送：取提交开始到对应余额事件到达的时间
+    by_user = {}
+    for connection in connections:
+        by_user.setdefault(connection.user_id, []).append(connection)
+    latencies = []
+    missing = 0
+    for user_id, started, current_points in sent:
+        for connection in by_user.get(user_id, ()):
+            arrived = next(
+                (at for at, event, data in connection.events
+                 if event == "balance" and at >= started and json.loads(data)["current_points"] >= current_points),
+                None
+            )
+            if arrived is None:
+                missing += 1
+            else:
+                latencies.append((arrived - started) * 1000)
+    return latencies, missing
+
+
+def fanout_spreads(connections):
+    # 每个排行榜版本从第一个连接收到到最后一个连接收到的时间差
+    arrivals = {}
+    for connection in connections:
+        for at, event, data in connection.events:
+            if event in ("leaderboard", "leaderboard_diff"):
+                arrivals.setdefault(json.loads(data)["version"], []).append(at)
+    return [(max(times) - min(times)) * 1000 for times in arrivals.values() if len(times) > 1], len(arrivals)
+
+
+async def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="badminton-push-"))
+    db_path = workdir / "game.db"
+    main = load_app(db_path, PASSWORD_HASH_ROUNDS=4)
+    seed_database(main, db_path, args.users, 5, 2, args.seed)
+    tokens = [(i + 1, main.create_jwt_token(i + 1, seed_username(i))) for i in range(args.users)]
+
+    port = free_port()
+    env = dict(
+        os.environ, DB_PATH=str(db_path), RATE_LIMIT_ENABLED="0",
+        PUSH_INTERVAL=str(args.push_interval), PUSH_MAX_PER_USER=str(args.connections),
+        PUSH_MAX_CONNECTIONS=str(args.connections + 100),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning",
+         "--timeout-graceful-shutdown", "5"],
+        cwd=API_DIR, env=env,
+    )
+    connections = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/health")
+                    break
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.1)
+            await client.get("/api/points/leaderboard")
+
+            # 基线：没有推送连接时同样的提交负载，广播阶段的 CPU 减去它才是推送本身的开销
+            cpu = process_cpu(server.pid)
+            await drive_earns(client, tokens[: args.active_users], args.earn_rate, args.broadcast_seconds, random.Random(-1), [])
+            await asyncio.sleep(args.push_interval * 2)
+            baseline_cpu = process_cpu(server.pid) - cpu
+            rss_before = process_rss_mb(server.pid)
+
+            started = time.perf_counter()
+            connections = await open_connections(client, port, tokens, args.connections)
+            connect_seconds = time.perf_counter() - started
+            listeners = [asyncio.ensure_future(connection.listen()) for connection in connections]
+            await asyncio.sleep(1)
+            held = (await push_metrics(client))["connections"]
+            rss_after = process_rss_mb(server.pid)
+
+            # 空闲阶段：只有心跳
+            cpu = process_cpu(server.pid)
+            await asyncio.sleep(args.idle_seconds)
+            idle_cpu = process_cpu(server.pid) - cpu
+
+            # 广播阶段：持续有比赛记录提交，排行榜前N名不断变化
+            before = await push_metrics(client)
+            for connection in connections:
+                connection.events.clear()
+            sent = []
+            cpu = process_cpu(server.pid)
+            await drive_earns(client, tokens[: args.active_users], args.earn_rate, args.broadcast_seconds, random.Random(args.seed), sent)
+            await asyncio.sleep(args.push_interval * 2)
+            broadcast_cpu = process_cpu(server.pid) - cpu
+            after = await push_metrics(client)
+
+            for listener in listeners:
+                listener.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+
+        broadcasts = after["broadcasts"] - before["broadcasts"]
+        idle_rate = idle_cpu / args.idle_seconds
+        extra_cpu = broadcast_cpu - baseline_cpu
+        latencies, missing = balance_latencies(connections, sent)
+        spreads, versions = fanout_spreads(connections)
+        return {
+            "connections": args.connections,
+            "connections_held": held,
+            "connect_seconds": round(connect_seconds, 2),
+            "server_rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1)},
+            "rss_kb_per_connection": round((rss_after - rss_before) * 1024 / max(held, 1), 2),
+            "idle_cpu_percent": round(idle_rate * 100, 2),
+            "earns": len(sent),
+            "earn_only_cpu_seconds": round(baseline_cpu, 3),
+            "broadcast_phase_cpu_seconds": round(broadcast_cpu, 3),
+            "broadcasts": broadcasts,
+            "leaderboard_versions_received": versions,
+            "frames": after["frames"] - before["frames"],
+            "wake_ms_per_broadcast": round((after["broadcast_seconds"] - before["broadcast_seconds"]) / max(broadcasts, 1) * 1000, 3),
+            "cpu_ms_per_broadcast": round(extra_cpu / max(broadcasts, 1) * 1000, 2),
+            "cpu_us_per_connection_per_broadcast": round(extra_cpu / max(broadcasts, 1) / max(held, 1) * 1e6, 2),
+            "balance_push_ms": {
+                "p50": round(percentile(latencies, 50), 2),
+                "p99": round(percentile(latencies, 99), 2),
+                "missing": missing,
+            },
+            "fanout_spread_ms": {
+                "p50": round(percentile(spreads, 50), 2),
+                "p99": round(percentile(spreads, 99), 2),
+            },
+        }
+    finally:
+        for connection in connections:
+            connection.close()
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--active-users", type=int, default=50, help="提交比赛记录的用户数，都是有推送连接的用户")
+    parser.add_argument("--earn-rate", type=float, default=50, help="每秒提交的比赛记录数")
+    parser.add_argument("--push-interval", type=float, default=1)
+    parser.add_argument("--idle-seconds", type=float, default=5)
+    parser.add_argument("--broadcast-seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# 限流基准：一个异常客户端猛刷 /api/shop/equip（每次请求一个写事务）时，其他正常用户写入的延迟
+#
+#   python benchmarks/bench_rate_limit.py --abuse-rate 800 --users 16 --seconds 5
+#
+# 分别在关闭和开启限流的子进程中运行。开启后异常客户端的大部分请求应快速收到 429，
+# 正常用户的 p99 与无人捣乱时处于同一量级。最后检查令牌桶在大量不同键下的内存上限。
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+from common import auth_headers, load_app, percentile, sample_game_record
+
+
+def make_client(main, ip):
+    transport = httpx.ASGITransport(app=main.app, client=(ip, 40000))
+    return httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60)
+
+
+async def register(client, name):
+    resp = await client.post("/api/auth/register", json={"username": name, "email": f"{name}@bench.local", "password": "bench"})
+    resp.raise_for_status()
+    return auth_headers(resp.json()["token"])
+
+
+async def run_mode(enabled, args):
+    main = load_app(RATE_LIMIT_ENABLED=int(enabled), PASSWORD_HASH_ROUNDS=4, DB_SYNCHRONOUS=args.synchronous)
+    await main.startup_event()
+    abuser = make_client(main, "10.0.0.1")
+    clients = [make_client(main, f"10.0.1.{i}") for i in range(args.users)]
+    abuser_headers = await register(abuser, "abuser")
+    headers = [await register(client, f"player{i}") for i, client in enumerate(clients)]
+    items = (await abuser.get("/api/shop/items")).json()["items"]
+    item = min(items, key=lambda item: item["price"])
+    item = {"item_id": item["id"], "item_type": item["type"]}
+    (await abuser.post("/api/shop/purchase", json=item, headers=abuser_headers)).raise_for_status()
+
+    stop = asyncio.Event()
+    abuser_counts, abuser_latency = {}, []
+    latencies, counts = [], {}
+
+    async def abuse_once():
+        start = time.perf_counter()
+        resp = await abuser.put("/api/shop/equip", json=item, headers=abuser_headers)
+        abuser_latency.append((time.perf_counter() - start) * 1000)
+        abuser_counts[resp.status_code] = abuser_counts.get(resp.status_code, 0) + 1
+
+    async def hammer():
+        # 开环施压：按固定速率发出请求，不等待响应，两种模式下异常客户端的请求量相同
+        pending = set()
+        started = time.perf_counter()
+        sent = 0
+        while not stop.is_set():
+            task = asyncio.create_task(abuse_once())
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            sent += 1
+            await asyncio.sleep(max(started + sent / args.abuse_rate - time.perf_counter(), 0))
+        await asyncio.gather(*pending)
+
+    async def player(client, player_headers):
+        # 正常玩家：约每 0.5 秒提交一局结果
+        i = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            resp = await client.post("/api/points/earn", json=sample_game_record(i), headers=player_headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+            counts[resp.status_code] = counts.get(resp.status_code, 0) + 1
+            i += 1
+            await asyncio.sleep(0.5)
+
+    tasks = [asyncio.create_task(hammer())]
+    tasks += [asyncio.create_task(player(client, h)) for client, h in zip(clients, headers)]
+    await asyncio.sleep(args.seconds)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await main.shutdown_event()
+    return {
+        "players": {"status_counts": counts, "p50_ms": round(percentile(latencies, 50), 2), "p99_ms": round(percentile(latencies, 99), 2)},
+        "abuser": {"status_counts": abuser_counts, "p50_ms": round(percentile(abuser_latency, 50), 2)},
+        "admission": main.admission.stats(),
+    }
+
+
+def measure_memory(keys, max_keys):
+    main = load_app()
+    tracemalloc.start()
+    limiter = main.TokenBucketLimiter(1, 5, max_keys=max_keys)
+    now = time.monotonic()
+    for key in range(keys):
+        limiter.acquire(f"198.51.{key >> 8 & 255}.{key & 255}:{key}", now)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"distinct_keys": keys, "tracked_keys": len(limiter), "peak_mb": round(peak / 1024 / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    parser.add_argument("--abuse-rate", type=float, default=800, help="异常客户端每秒发出的请求数")
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--keys", type=int, default=1000000)
+    parser.add_argument("--mode", choices=["off", "on"])
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(asyncio.run(run_mode(args.mode == "on", args))))
+        return
+
+    report = {}
+    for mode in ("off", "on"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--abuse-rate", str(args.abuse_rate), "--synchronous", args.synchronous,
+             "--users", str(args.users), "--seconds", str(args.seconds)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        report[f"rate_limit_{mode}"] = json.loads(out.strip().splitlines()[-1])
+    report["limiter_memory"] = measure_memory(args.keys, 100000)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
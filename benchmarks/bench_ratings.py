@@ -0,0 +1,76 @@
+# 评分离线重算压测：生成大量比赛记录，分别用 NumPy 向量化和逐条计算全量重算技术评分，
+# 输出每秒处理的记录数，并检查两种实现的结果一致
+#
+#   python benchmarks/bench_ratings.py --users 20000 --games 50
+#   python benchmarks/bench_ratings.py --db /tmp/load.db --skip-python   # 复用 seed.py 生成的数据库
+import argparse
+import json
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from common import load_app
+from seed import seed_database
+
+
+def timed_recompute(main, db_path):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        started = time.perf_counter()
+        groups = main.recompute_ratings(conn)
+        seconds = time.perf_counter() - started
+        ratings = {
+            (user_id, game_type): (rating, games)
+            for user_id, game_type, rating, games in conn.execute("SELECT user_id, game_type, rating, games FROM user_ratings")
+        }
+        return seconds, groups, ratings
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="已生成的数据库；不指定时生成一个临时数据库")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--games", type=int, default=50, help="每个用户的平均比赛记录数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-python", action="store_true", help="不运行逐条计算的对照（数据量很大时较慢）")
+    args = parser.parse_args()
+
+    db_path = Path(args.db) if args.db else Path(tempfile.mkdtemp(prefix="badminton-ratings-")) / "game.db"
+    app = load_app(db_path, PASSWORD_HASH_ROUNDS=4)
+    if not db_path.exists():
+        seed_database(app, db_path, args.users, args.games, 0, args.seed)
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        raise SystemExit("未安装 NumPy，无法对比向量化实现")
+    conn = sqlite3.connect(str(db_path))
+    records = conn.execute("SELECT COUNT(*) FROM game_records").fetchone()[0]
+    conn.close()
+
+    report = {"records": records}
+    seconds, groups, vectorized = timed_recompute(app, db_path)
+    report["numpy"] = {"seconds": round(seconds, 2), "records_per_second": round(records / seconds), "ratings": groups}
+    if not args.skip_python:
+        # sys.modules 中置为 None 时 import numpy 抛出 ImportError，走与未安装时相同的回退路径
+        numpy_module, sys.modules["numpy"] = sys.modules["numpy"], None
+        try:
+            seconds, groups, scalar = timed_recompute(app, db_path)
+        finally:
+            sys.modules["numpy"] = numpy_module
+        report["python"] = {"seconds": round(seconds, 2), "records_per_second": round(records / seconds), "ratings": groups}
+        report["speedup"] = round(report["python"]["seconds"] / report["numpy"]["seconds"], 2)
+        mismatched = set(vectorized) ^ set(scalar)
+        mismatched |= {key for key in set(vectorized) & set(scalar) if vectorized[key][1] != scalar[key][1]}
+        report["mismatched_keys"] = len(mismatched)
+        report["max_rating_diff"] = max(
+            (abs(vectorized[key][0] - scalar[key][0]) for key in set(vectorized) & set(scalar)), default=0.0
+        )
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# 列表接口序列化微基准：每行的映射与编码开销
+#
+#   python benchmarks/bench_serialization.py --rows 20000
+#
+# before：按下标逐列构造字典，返回 dict 由 FastAPI 经 jsonable_encoder 再用标准库 json 编码；
+# after：按 cursor.description 列名 zip 构造字典，FastJSONResponse 直接编码为字节（装有 orjson 时使用 orjson）。
+import argparse
+import json
+import sqlite3
+
+from fastapi.encoders import jsonable_encoder
+
+from common import Timer, load_app
+
+
+def make_rows(main, count):
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE game_records (id INTEGER PRIMARY KEY, game_type TEXT, result TEXT, points_earned INTEGER, duration INTEGER, player_score INTEGER, ai_score INTEGER, sets_won INTEGER, sets_lost INTEGER, created_at TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO game_records (game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at) VALUES ('single', ?, ?, 300, 11, 7, 2, 1, '2024-01-01 12:00:00')",
+        (("win" if i % 3 else "lose", 50 + i % 100) for i in range(count)),
+    )
+    return conn
+
+
+def before(conn):
+    rows = conn.execute(
+        f"SELECT id, {', '.join(HISTORY)} FROM game_records"
+    ).fetchall()
+    records = [
+        {
+            "game_type": row[1],
+            "result": row[2],
+            "points_earned": row[3],
+            "duration": row[4],
+            "player_score": row[5],
+            "ai_score": row[6],
+            "sets_won": row[7],
+            "sets_lost": row[8],
+            "created_at": row[9],
+        }
+        for row in rows
+    ]
+    content = jsonable_encoder({"records": records})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def after(main, conn):
+    cursor = conn.execute(f"SELECT {', '.join(HISTORY)} FROM game_records")
+    return main.FastJSONResponse({"records": main.rows_to_dicts(cursor)}).body
+
+
+def measure(fn, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        with Timer() as t:
+            body = fn()
+        best = t.elapsed if best is None else min(best, t.elapsed)
+    return {"total_ms": round(best * 1000, 2), "us_per_row": round(best / rows * 1e6, 3), "bytes": len(body)}
+
+
+def run(args):
+    global HISTORY
+    main = load_app()
+    HISTORY = main.HISTORY_COLUMNS
+    conn = make_rows(main, args.rows)
+    assert json.loads(before(conn)) == json.loads(after(main, conn))
+    report = {
+        "rows": args.rows,
+        "encoder": "orjson" if main.orjson is not None else "json",
+        "before": measure(lambda: before(conn), args.rows, args.repeat),
+        "after": measure(lambda: after(main, conn), args.rows, args.repeat),
+    }
+    report["speedup"] = round(report["before"]["total_ms"] / report["after"]["total_ms"], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    run(parser.parse_args())
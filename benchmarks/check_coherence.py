@@ -0,0 +1,217 @@
+# 多进程缓存一致性检查：一个写进程按顺序修改积分、装备、商店价格并登出token，
+# 多个读进程同时通过各自的进程内缓存读取，验证读到的数据不早于请求发出前已确认的写入
+#
+#   python benchmarks/check_coherence.py --readers 4 --seconds 10
+#   python benchmarks/check_coherence.py --disable-coherence   # 对照：关闭同步后读进程会读到旧数据
+#
+# 每个进程各自加载应用（相当于 uvicorn 的一个 worker），共用同一个数据库文件。
+# 任一读进程读到过期数据时以非零状态退出。
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from common import auth_headers, load_app, register_user, sample_game_record
+
+REVOKE_TOKENS = 200
+
+
+def setup(db_path, hash_rounds):
+    # 在父进程中准备数据：一个写用户、两把已购买的球拍、一批待登出的token
+    from fastapi.testclient import TestClient
+
+    main = load_app(db_path, PASSWORD_HASH_ROUNDS=hash_rounds)
+    with TestClient(main.app) as client:
+        token = register_user(client, "coherence_writer")
+        conn = sqlite3.connect(str(db_path))
+        conn.execute("UPDATE users SET current_points = 1000000 WHERE username = 'coherence_writer'")
+        conn.commit()
+        rackets = client.get("/api/shop/items?item_type=racket").json()["items"][:2]
+        for item in rackets:
+            client.post("/api/shop/purchase", json={"item_id": item["id"], "item_type": "racket"}, headers=auth_headers(token)).raise_for_status()
+        client.put("/api/shop/equip", json={"item_id": rackets[0]["id"], "item_type": "racket"}, headers=auth_headers(token)).raise_for_status()
+        # 同一用户同一秒内签发的token完全相同，待登出的token各用一个独立用户，避免误伤写用户的token
+        tokens = [register_user(client, f"coherence_revoke_{i}") for i in range(REVOKE_TOKENS)]
+        total = conn.execute("SELECT total_points FROM users WHERE username = 'coherence_writer'").fetchone()[0]
+        price = conn.execute("SELECT price FROM shop_items WHERE id = ?", (rackets[0]["id"],)).fetchone()[0]
+        conn.close()
+    return token, [item["id"] for item in rackets], tokens, total, price
+
+
+async def run_writer(db_path, hash_rounds, token, rackets, tokens, shared, seconds):
+    main = load_app(db_path, PASSWORD_HASH_ROUNDS=hash_rounds)
+    await main.startup_event()
+    conn = sqlite3.connect(str(db_path), timeout=10)
+    rng = random.Random(0)
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://writer", timeout=30) as client:
+            shared["ready"].wait()
+            deadline = time.monotonic() + seconds
+            step = 0
+            while time.monotonic() < deadline:
+                op = step % 4
+                if op == 0:
+                    resp = await client.post("/api/points/earn", json=sample_game_record(rng.randint(0, 999)), headers=auth_headers(token))
+                    resp.raise_for_status()
+                    shared["total"].value = resp.json()["total_points"]
+                elif op == 1:
+                    # 装备不是单调的：用序号锁（写入期间序号为奇数）让读进程判断请求期间是否发生过写入
+                    shared["equip_seq"].value += 1
+                    racket = rackets[(step // 4 + 1) % 2]
+                    resp = await client.put("/api/shop/equip", json={"item_id": racket, "item_type": "racket"}, headers=auth_headers(token))
+                    resp.raise_for_status()
+                    shared["equipped"].value = racket
+                    shared["equip_seq"].value += 1
+                elif op == 2:
+                    price = shared["price"].value + 1
+                    conn.execute("UPDATE shop_items SET price = ? WHERE id = ?", (price, rackets[0]))
+                    conn.commit()
+                    shared["price"].value = price
+                elif op == 3 and shared["revoked"].value < len(tokens):
+                    resp = await client.post("/api/auth/logout", headers=auth_headers(tokens[shared["revoked"].value]))
+                    resp.raise_for_status()
+                    shared["revoked"].value += 1
+                step += 1
+            shared["writes"].value = step
+    finally:
+        conn.close()
+        shared["done"].set()
+        await main.shutdown_event()
+
+
+async def run_reader(index, db_path, hash_rounds, token, rackets, tokens, shared, results):
+    main = load_app(db_path, PASSWORD_HASH_ROUNDS=hash_rounds)
+    await main.startup_event()
+    rng = random.Random(index)
+    counts = {kind: {"checks": 0, "stale": 0, "raced": 0} for kind in ("leaderboard", "loadout", "catalog", "token")}
+    examples = []
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url=f"http://reader{index}", timeout=30) as client:
+            # 预热：所有token都先进入本进程的token缓存，排行榜和目录完成加载
+            for t in tokens:
+                (await client.get("/api/auth/profile", headers=auth_headers(t))).raise_for_status()
+            (await client.get("/api/points/leaderboard/me?radius=0", headers=auth_headers(token))).raise_for_status()
+            (await client.get("/api/shop/loadout", headers=auth_headers(token))).raise_for_status()
+            with shared["ready_count"].get_lock():
+                shared["ready_count"].value += 1
+                if shared["ready_count"].value == shared["readers"]:
+                    shared["ready"].set()
+            shared["ready"].wait()
+
+            def stale(kind, expected, observed):
+                counts[kind]["stale"] += 1
+                if len(examples) < 10:
+                    examples.append({"kind": kind, "expected": expected, "observed": observed})
+
+            while not shared["done"].is_set():
+                kind = rng.choice(tuple(counts))
+                if kind == "leaderboard":
+                    expected = shared["total"].value
+                    resp = await client.get("/api/points/leaderboard/me?radius=0", headers=auth_headers(token))
+                    observed = resp.json()["neighbours"][0]["total_points"]
+                    if observed < expected:
+                        stale(kind, expected, observed)
+                elif kind == "loadout":
+                    before = shared["equip_seq"].value
+                    expected = shared["equipped"].value
+                    resp = await client.get("/api/shop/loadout", headers=auth_headers(token))
+                    observed = resp.json()["items"]["racket"]["item_id"]
+                    if before % 2 or shared["equip_seq"].value != before:
+                        counts[kind]["raced"] += 1
+                        continue
+                    if observed != expected:
+                        stale(kind, expected, observed)
+                elif kind == "catalog":
+                    expected = shared["price"].value
+                    resp = await client.get("/api/shop/items?item_type=racket")
+                    observed = next(item["price"] for item in resp.json()["items"] if item["id"] == rackets[0])
+                    if observed < expected:
+                        stale(kind, expected, observed)
+                else:
+                    revoked = shared["revoked"].value
+                    if not revoked:
+                        continue
+                    resp = await client.get("/api/auth/profile", headers=auth_headers(tokens[rng.randrange(revoked)]))
+                    if resp.status_code != 401:
+                        stale(kind, 401, resp.status_code)
+                counts[kind]["checks"] += 1
+    finally:
+        await main.shutdown_event()
+    results.put({"reader": index, "counts": counts, "examples": examples})
+
+
+def writer_process(*args):
+    asyncio.run(run_writer(*args))
+
+
+def reader_process(*args):
+    asyncio.run(run_reader(*args))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--hash-rounds", type=int, default=4)
+    parser.add_argument("--disable-coherence", action="store_true", help="关闭跨进程同步作为对照")
+    args = parser.parse_args()
+
+    db_path = Path(tempfile.mkdtemp(prefix="badminton-coherence-")) / "game.db"
+    token, rackets, tokens, total, price = setup(db_path, args.hash_rounds)
+
+    # 子进程用 spawn 启动，各自独立导入应用，与多个 uvicorn worker 相同
+    ctx = multiprocessing.get_context("spawn")
+    if args.disable_coherence:
+        os.environ["CACHE_COHERENCE"] = "0"
+    shared = {
+        "total": ctx.Value("q", total),
+        "equipped": ctx.Value("q", rackets[0]),
+        "equip_seq": ctx.Value("q", 0),
+        "price": ctx.Value("q", price),
+        "revoked": ctx.Value("q", 0),
+        "writes": ctx.Value("q", 0),
+        "ready_count": ctx.Value("q", 0),
+        "readers": args.readers,
+        "ready": ctx.Event(),
+        "done": ctx.Event(),
+    }
+    results = ctx.Queue()
+    common_args = (db_path, args.hash_rounds, token, rackets, tokens, shared)
+    processes = [ctx.Process(target=writer_process, args=common_args + (args.seconds,))]
+    processes += [ctx.Process(target=reader_process, args=(i,) + common_args + (results,)) for i in range(args.readers)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in range(args.readers)]
+    for process in processes:
+        process.join()
+
+    totals = {}
+    for report in reports:
+        for kind, counts in report["counts"].items():
+            merged = totals.setdefault(kind, {"checks": 0, "stale": 0, "raced": 0})
+            for name, value in counts.items():
+                merged[name] += value
+    stale = sum(counts["stale"] for counts in totals.values())
+    print(json.dumps({
+        "coherence": not args.disable_coherence,
+        "readers": args.readers,
+        "writes": shared["writes"].value,
+        "checks": totals,
+        "stale": stale,
+        "examples": [example for report in reports for example in report["examples"]][:10],
+    }, indent=2, ensure_ascii=False))
+    raise SystemExit(1 if stale and not args.disable_coherence else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# 用 EXPLAIN QUERY PLAN 检查热点查询是否命中索引，防止查询计划退化
+#
+#   python benchmarks/check_query_plans.py
+#
+# 不手工抄写 SQL：直接调用 api/main.py 中处理请求的函数，记录它们实际执行的语句和参数，
+# 再逐条取查询计划，覆盖登录、积分写入、历史、统计、排行榜、商店等路径。
+# 积分历史、游戏统计和会话启动数据（bootstrap）在挂载归档库前后各检查一次（挂载后为主库与归档库的 UNION ALL）。
+# 任一查询出现全表扫描或额外的临时排序 B 树时以非零状态退出。
+import sqlite3
+import sys
+
+from common import load_app
+
+# 只检查读写数据的语句，ATTACH、PRAGMA、建表等不涉及查询计划
+PLANNED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+class RecordingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        self.connection.statements.append((sql, tuple(parameters)))
+        return super().execute(sql, parameters)
+
+
+class RecordingConnection(sqlite3.Connection):
+    # 与 PooledConnection 相同：Connection.execute 不经过游标子类，这里改为走 RecordingCursor
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = []
+
+    def cursor(self, factory=RecordingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def hot_paths(app):
+    # 名称 -> 调用应用函数；用户1已有积分、评分和背包，各条分支都会执行到
+    racket = app.PurchaseItem(item_id=1, item_type="racket")
+    record = app.BatchGameRecord(game_type="single", result="win", points_earned=10, duration=60,
+                                 player_score=21, ai_score=15, sets_won=2, sets_lost=0)
+    return {
+        "login": lambda conn: app._find_login_user(conn, "plan"),
+        "record_login": lambda conn: app._record_login(conn, 1, "", "rehashed"),
+        "earn": lambda conn: app._earn_points_batch_tx(conn.cursor(), [(1, record, None)]),
+        "earn_batch": lambda conn: app._earn_points_bulk_tx(conn.cursor(), 1, [("2026-01-01 00:00:00", 0, record)], [], None),
+        "points_history": lambda conn: app._read_history_page(conn, 1, None, 20),
+        "points_history.cursor": lambda conn: app._read_history_page(conn, 1, ("2026-01-01 00:00:00", 100), 20),
+        "game_stats": lambda conn: app._get_game_stats(conn, 1),
+        "game_rating": lambda conn: app._get_ratings(conn, 1),
+        "bootstrap": lambda conn: app._bootstrap(conn, 1, set(app.BOOTSTRAP_SECTIONS), app.loadout_cache.lookup([1])),
+        "leaderboard.period": lambda conn: app._period_leaderboard(conn, "week", "2024-W18", 20, 0),
+        "leaderboard.rating": lambda conn: app._rating_leaderboard(conn, "single", 20, 0),
+        "loadout.bulk": lambda conn: app.LoadoutCache().get_many(conn, [1, 2, 3]),
+        "purchase_item": lambda conn: app._purchase_item_tx(conn.cursor(), 1, racket, "racket", 100),
+        "equip_item": lambda conn: app._equip_item_tx(conn.cursor(), 1, app.EquipItem(item_id=1, item_type="racket")),
+        "get_user_inventory": lambda conn: app._get_user_inventory(conn, 1),
+        "idempotency.lookup": lambda conn: app._get_idempotency_key(conn, 1, "key", 0),
+        "idempotency.prune": lambda conn: app._prune_idempotency_keys_tx(conn.cursor(), 0, 1000),
+        "push_ticket.issue": lambda conn: app._issue_push_ticket_tx(conn.cursor(), b"ticket", b"token", {"user_id": 1}, 0),
+        "push_ticket.redeem": lambda conn: app._redeem_push_ticket_tx(conn.cursor(), b"ticket", 0),
+    }
+
+# 这些路径在挂载归档库后改走合并查询，需要再检查一次
+ARCHIVE_PATHS = ("points_history", "points_history.cursor", "game_stats", "bootstrap")
+
+
+def record_statements(app, conn, path):
+    conn.statements = []
+    try:
+        path(conn)
+    except app.HTTPException:
+        # 业务校验失败（如积分不足）之前执行过的语句照样检查
+        pass
+    statements = []
+    for sql, params in conn.statements:
+        if sql.lstrip().split(None, 1)[0].upper() in PLANNED_STATEMENTS and (sql, params) not in statements:
+            statements.append((sql, params))
+    return statements
+
+
+def plan_problems(conn, sql, params):
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    details = [row[-1] for row in rows]
+    problems = []
+    for detail in details:
+        if detail.startswith("SCAN") and "USING" not in detail:
+            problems.append(detail)
+        # 只对索引前缀内的少量行做二次排序（RIGHT PART）可以接受，整体排序不行
+        if detail.startswith("USE TEMP B-TREE FOR ORDER BY"):
+            problems.append(detail)
+    return details, problems
+
+
+def check(app, conn, name, path):
+    failed = False
+    for index, (sql, params) in enumerate(record_statements(app, conn, path), 1):
+        details, problems = plan_problems(conn, sql, params)
+        status = "FAIL" if problems else "ok"
+        failed = failed or bool(problems)
+        print(f"[{status}] {name}#{index}: {' | '.join(details)}")
+        if problems:
+            print(f"       {' '.join(sql.split())}")
+    return failed
+
+
+def main():
+    app = load_app()
+    app.init_database()
+    conn = sqlite3.connect(app.DB_PATH, factory=RecordingConnection, isolation_level=None)
+    conn.execute("INSERT INTO users (username, email, password_hash, current_points) VALUES ('plan', 'plan@bench.local', '', 1000)")
+    conn.execute("INSERT INTO user_ratings (user_id, game_type, rating, games) VALUES (1, 'single', 1600, ?)", (app.RATING_PROVISIONAL_GAMES,))
+    app.catalog_cache.load(conn)
+    paths = hot_paths(app)
+
+    # 归档库文件创建之后 _read_history_page 会自动挂载，先检查未挂载时的查询
+    failed = False
+    for name, path in paths.items():
+        failed = check(app, conn, name, path) or failed
+    archived = sqlite3.connect(app.DB_PATH, factory=RecordingConnection, isolation_level=None)
+    app.attach_archive(archived, create=True)
+    for name in ARCHIVE_PATHS:
+        failed = check(app, archived, f"{name}.archive", paths[name]) or failed
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# 基准测试公共工具：在临时数据库上加载 api/main.py 中的应用
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+
+
+def load_app(db_path=None, **env):
+    # 环境变量必须在导入 main 之前设置，配置项在模块加载时读取
+    if db_path is None:
+        db_path = Path(tempfile.mkdtemp(prefix="badminton-bench-")) / "game.db"
+    os.environ["DB_PATH"] = str(db_path)
+    # 基准测试的请求都来自同一个IP，默认关闭限流；需要时传入 RATE_LIMIT_ENABLED=1
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    for key, value in env.items():
+        os.environ[key] = str(value)
+    if str(API_DIR) not in sys.path:
+        sys.path.insert(0, str(API_DIR))
+    import main
+    return main
+
+
+def register_user(client, username, password="bench-password"):
+    resp = client.post("/api/auth/register", json={
+        "username": username,
+        "email": f"{username}@bench.local",
+        "password": password,
+    })
+    resp.raise_for_status()
+    return resp.json()["token"]
+
+
+def auth_headers(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def sample_game_record(i=0):
+    return {
+        "game_type": "single",
+        "result": "win" if i % 3 else "lose",
+        "points_earned": 50 + i % 100,
+        "duration": 240 + i % 300,
+        "player_score": 11,
+        "ai_score": 7 + i % 4,
+        "sets_won": 2,
+        "sets_lost": i % 2,
+    }
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,45 @@
+# 对比两次 load_test.py 的结果：逐个接口列出吞吐量和延迟分位数的变化
+#
+#   python benchmarks/compare_reports.py base.json run.json
+import argparse
+import json
+
+METRICS = ("rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def change(old, new):
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base")
+    parser.add_argument("head")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.head, encoding="utf-8") as f:
+        head = json.load(f)
+
+    print(f"base {base['meta']['commit']} -> head {head['meta']['commit']} ({head['meta']['scenario']})")
+    if base["meta"]["dataset"] != head["meta"]["dataset"]:
+        print(f"warning: dataset differs: {base['meta']['dataset']} vs {head['meta']['dataset']}")
+    print(f"{'endpoint':<40}" + "".join(f"{metric:>24}" for metric in METRICS))
+    rows = [("total", {"rps": base["totals"]["rps"]}, {"rps": head["totals"]["rps"]})]
+    for endpoint in sorted(set(base["endpoints"]) | set(head["endpoints"])):
+        rows.append((endpoint, base["endpoints"].get(endpoint, {}), head["endpoints"].get(endpoint, {})))
+    for endpoint, old, new in rows:
+        cells = []
+        for metric in METRICS:
+            if metric in old and metric in new:
+                cells.append(f"{old[metric]:>9} -> {new[metric]:<7} {change(old[metric], new[metric]):>7}")
+            else:
+                cells.append("-")
+        print(f"{endpoint:<40}" + "".join(f"{cell:>24}" for cell in cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# API 压测：按场景混合驱动全部接口，输出每个接口的吞吐量与 p50/p95/p99（JSON）
+#
+#   python benchmarks/load_test.py --scenario mixed --concurrency 32 --seconds 20 --output run.json
+#   python benchmarks/load_test.py --url http://127.0.0.1:8001 --db /tmp/load.db ...
+#   python benchmarks/compare_reports.py base.json run.json
+#
+# 默认在进程内通过 ASGI 客户端压测一个新生成的临时数据库；指定 --url 时压测本机已启动的
+# uvicorn（需先用 seed.py 生成数据，并以相同的 DB_PATH 启动服务）。全程不访问外网。
+# 同一 --seed 下每个虚拟用户的请求序列固定，结果可在不同提交之间对比。
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from common import load_app, percentile, sample_game_record
+from seed import SEED_PASSWORD, seed_database, seed_username
+
+
+class Session:
+    # 一个虚拟用户：持有自己的 token，请求耗时按接口（方法 + 路由模板）记录到共享的 stats
+    def __init__(self, client, stats, username, rng):
+        self.client = client
+        self.stats = stats
+        self.username = username
+        self.rng = rng
+        self.token = None
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    async def request(self, method, path, **kwargs):
+        endpoint = f"{method} {path.split('?')[0]}"
+        start = time.perf_counter()
+        try:
+            resp = await self.client.request(method, path, headers=self.headers, **kwargs)
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            resp, status = None, type(e).__name__
+        self.stats.record(endpoint, (time.perf_counter() - start) * 1000, status)
+        return resp
+
+    async def login(self):
+        resp = await self.request("POST", "/api/auth/login", json={"username": self.username, "password": SEED_PASSWORD})
+        if resp is not None and resp.status_code == 200:
+            self.token = resp.json()["token"]
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}
+        self.statuses = {}
+
+    def record(self, endpoint, elapsed_ms, status):
+        self.latencies.setdefault(endpoint, []).append(elapsed_ms)
+        counts = self.statuses.setdefault(endpoint, {})
+        counts[str(status)] = counts.get(str(status), 0) + 1
+
+    def report(self, seconds):
+        endpoints = {}
+        for endpoint in sorted(self.latencies):
+            samples = self.latencies[endpoint]
+            statuses = self.statuses[endpoint]
+            errors = sum(count for status, count in statuses.items() if not status.startswith(("2", "4")))
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "errors": errors,
+                "status_counts": statuses,
+                "rps": round(len(samples) / seconds, 2),
+                "mean_ms": round(sum(samples) / len(samples), 3),
+                "p50_ms": round(percentile(samples, 50), 3),
+                "p95_ms": round(percentile(samples, 95), 3),
+                "p99_ms": round(percentile(samples, 99), 3),
+            }
+        total = sum(item["requests"] for item in endpoints.values())
+        return {
+            "totals": {
+                "requests": total,
+                "errors": sum(item["errors"] for item in endpoints.values()),
+                "rps": round(total / seconds, 2),
+            },
+            "endpoints": endpoints,
+        }
+
+
+# 各个动作：一次用户操作，可能包含多个请求
+async def act_login(s):
+    await s.login()
+    await s.request("GET", "/api/auth/profile")
+
+
+async def act_bootstrap(s):
+    await s.request("GET", "/api/me/bootstrap")
+
+
+async def act_earn(s):
+    await s.request("POST", "/api/points/earn", json=sample_game_record(s.rng.randint(0, 999)))
+    await s.request("GET", "/api/points/balance")
+
+
+async def act_earn_batch(s):
+    played = datetime.datetime.now() - datetime.timedelta(hours=1)
+    records = []
+    for i in range(s.rng.randint(2, 8)):
+        record = sample_game_record(s.rng.randint(0, 999))
+        record["played_at"] = (played + datetime.timedelta(minutes=10 * i)).isoformat()
+        records.append(record)
+    await s.request("POST", "/api/points/earn/batch", json={"records": records})
+
+
+async def act_history(s):
+    resp = await s.request("GET", "/api/points/history?limit=20")
+    cursor = resp.json().get("next_cursor") if resp is not None and resp.status_code == 200 else None
+    if cursor and s.rng.random() < 0.3:
+        await s.request("GET", f"/api/points/history?limit=20&cursor={cursor}")
+
+
+async def act_export(s):
+    await s.request("GET", "/api/points/history/export?format=ndjson")
+
+
+async def act_stats(s):
+    await s.request("GET", "/api/game/stats")
+
+
+async def act_shop(s):
+    resp = await s.request("GET", "/api/shop/items")
+    if resp is None or resp.status_code != 200:
+        return
+    items = resp.json()["items"]
+    await s.request("GET", "/api/shop/inventory")
+    if items and s.rng.random() < 0.3:
+        item = s.rng.choice(items)
+        await s.request("POST", "/api/shop/purchase", json={"item_id": item["id"], "item_type": item["type"]})
+        await s.request("PUT", "/api/shop/equip", json={"item_id": item["id"], "item_type": item["type"]})
+    await s.request("GET", "/api/shop/loadout")
+
+
+async def act_leaderboard(s):
+    period = s.rng.choice(("all", "all", "day", "week", "season"))
+    await s.request("GET", f"/api/points/leaderboard?limit=20&offset={s.rng.choice((0, 0, 0, 20, 100))}&period={period}")
+    await s.request("GET", "/api/points/leaderboard/me?radius=5")
+
+
+async def act_health(s):
+    await s.request("GET", "/health")
+    await s.request("GET", "/")
+
+
+async def act_register_logout(s):
+    name = f"load_new_{s.username}_{s.rng.randrange(1 << 30)}"
+    token = s.token
+    resp = await s.request("POST", "/api/auth/register", json={"username": name, "email": f"{name}@load.local", "password": SEED_PASSWORD})
+    if resp is not None and resp.status_code == 200:
+        s.token = resp.json()["token"]
+        await s.request("POST", "/api/auth/logout")
+    s.token = token
+
+
+# 场景：动作及其权重
+SCENARIOS = {
+    "login_burst": {act_login: 8, act_bootstrap: 2},
+    "post_match": {act_earn: 6, act_earn_batch: 1, act_history: 2, act_stats: 1},
+    "shop_browsing": {act_shop: 8, act_bootstrap: 2},
+    "leaderboard_polling": {act_leaderboard: 9, act_health: 1},
+    "mixed": {
+        act_login: 1, act_bootstrap: 2, act_earn: 6, act_earn_batch: 1, act_history: 3, act_export: 0.2,
+        act_stats: 2, act_shop: 3, act_leaderboard: 5, act_health: 1, act_register_logout: 0.3,
+    },
+}
+
+
+async def virtual_user(session, scenario, deadline):
+    actions = list(SCENARIOS[scenario])
+    weights = list(SCENARIOS[scenario].values())
+    while time.monotonic() < deadline:
+        await session.rng.choices(actions, weights)[0](session)
+
+
+async def drive(client, args):
+    stats = Stats()
+    sessions = [
+        Session(client, stats, seed_username(i % args.users), random.Random(f"{args.seed}-{i}"))
+        for i in range(args.concurrency)
+    ]
+    # 预热：每个会话先登录一次，不计入结果
+    await asyncio.gather(*(s.login() for s in sessions))
+    stats.reset()
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.seconds
+    await asyncio.gather(*(virtual_user(s, args.scenario, deadline) for s in sessions))
+    return stats.report(time.perf_counter() - started)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+            check=True, capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dataset_counts(db_path):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        return {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("users", "game_records", "user_items")
+        }
+    finally:
+        conn.close()
+
+
+async def run(args):
+    db_path = Path(args.db) if args.db else Path(tempfile.mkdtemp(prefix="badminton-load-")) / "game.db"
+    if args.url:
+        if not db_path.exists():
+            raise SystemExit("压测外部服务时需要用 --db 指定 seed.py 生成的数据库")
+        dataset = dataset_counts(db_path)
+        async with httpx.AsyncClient(base_url=args.url, timeout=30) as client:
+            report = await drive(client, args)
+    else:
+        main = load_app(db_path, PASSWORD_HASH_ROUNDS=args.hash_rounds)
+        if not db_path.exists():
+            seed_database(main, db_path, args.users, args.games, args.items, args.seed)
+        dataset = dataset_counts(db_path)
+        await main.startup_event()
+        try:
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=30) as client:
+                report = await drive(client, args)
+        finally:
+            await main.shutdown_event()
+    report["meta"] = {
+        "commit": git_commit(),
+        "target": args.url or "in-process",
+        "scenario": args.scenario,
+        "concurrency": args.concurrency,
+        "seconds": args.seconds,
+        "seed": args.seed,
+        "hash_rounds": None if args.url else args.hash_rounds,
+        "dataset": dataset,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "cpus": os.cpu_count(),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", default="mixed", choices=sorted(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--url", help="压测已启动的服务，例如 http://127.0.0.1:8001")
+    parser.add_argument("--db", help="已生成的数据库；不存在时在该路径生成")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--games", type=int, default=50)
+    parser.add_argument("--items", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hash-rounds", type=int, default=12, help="进程内压测时的 bcrypt cost")
+    parser.add_argument("--output", help="结果写入该文件，默认输出到标准输出")
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(report + "\n", encoding="utf-8")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# 生成压测数据：在本地 SQLite 数据库中写入指定数量的用户、比赛记录和已购物品
+#
+#   python benchmarks/seed.py --db /tmp/load.db --users 2000 --games 50 --items 4
+#
+# 同一个 --seed 生成的数据完全相同，方便在不同提交之间对比压测结果。
+# 所有用户的用户名为 load_user_<序号>，密码均为 SEED_PASSWORD。
+import argparse
+import datetime
+import json
+import random
+import sqlite3
+import time
+
+from common import load_app
+
+SEED_PASSWORD = "load-password"
+SEED_START = datetime.datetime(2024, 1, 1)
+GAME_TYPES = ("single", "single", "single", "double")
+
+
+def sql_time(ts):
+    return ts.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def seed_username(i):
+    return f"load_user_{i}"
+
+
+def random_game(rng):
+    result = rng.choices(("win", "lose", "draw"), weights=(5, 4, 1))[0]
+    sets_won = 2 if result == "win" else rng.randint(0, 1)
+    sets_lost = rng.randint(0, 1) if result == "win" else 2 - (result == "draw")
+    player_score = rng.randint(5, 21)
+    return {
+        "game_type": rng.choice(GAME_TYPES),
+        "result": result,
+        "points_earned": rng.randint(10, 400) if result == "win" else rng.randint(10, 80),
+        "duration": rng.randint(120, 900),
+        "player_score": player_score,
+        "ai_score": rng.randint(5, 21),
+        "sets_won": sets_won,
+        "sets_lost": sets_lost,
+    }
+
+
+def seed_database(main, db_path, users, games, items, seed=0):
+    # main 必须已通过 load_app(db_path) 加载，迁移由 init_database 完成
+    main.init_database()
+    rng = random.Random(seed)
+    password_hash = main.hash_password(SEED_PASSWORD)
+    conn = sqlite3.connect(str(db_path))
+    try:
+        start = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if start:
+            raise SystemExit(f"{db_path} 中已有 {start} 个用户，请使用新的数据库文件")
+        shop = conn.execute("SELECT id, name, type, price FROM shop_items WHERE is_available = TRUE ORDER BY id").fetchall()
+
+        conn.execute("BEGIN")
+        for i in range(users):
+            created = SEED_START + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 30))
+            user_id = conn.execute(
+                "INSERT INTO users (username, email, password_hash, created_at, last_login) VALUES (?, ?, ?, ?, ?)",
+                (seed_username(i), f"{seed_username(i)}@load.local", password_hash, sql_time(created), sql_time(created))
+            ).lastrowid
+
+            records = []
+            played = created
+            for _ in range(rng.randint(0, games * 2)):
+                played += datetime.timedelta(minutes=rng.randint(5, 600))
+                game = random_game(rng)
+                records.append((
+                    user_id, game["game_type"], game["result"], game["points_earned"], game["duration"],
+                    game["player_score"], game["ai_score"], game["sets_won"], game["sets_lost"],
+                    sql_time(played)
+                ))
+            conn.executemany(
+                "INSERT INTO game_records (user_id, game_type, result, points_earned, duration, player_score, ai_score, sets_won, sets_lost, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                records
+            )
+            total_points = sum(record[3] for record in records)
+
+            # 已购物品：每种类型装备第一件，花费从当前积分中扣除
+            owned = rng.sample(shop, min(rng.randint(0, items * 2), len(shop)))
+            equipped = set()
+            spent = 0
+            for item_id, name, item_type, price in owned:
+                if spent + price > total_points:
+                    continue
+                spent += price
+                conn.execute(
+                    "INSERT INTO user_items (user_id, item_type, item_id, item_name, is_equipped, purchased_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, item_type, item_id, name, item_type not in equipped, sql_time(played))
+                )
+                equipped.add(item_type)
+
+            conn.execute(
+                "UPDATE users SET total_points = ?, current_points = ?, games_played = ?, games_won = ? WHERE id = ?",
+                (total_points, total_points - spent, len(records), sum(record[2] == "win" for record in records), user_id)
+            )
+        conn.commit()
+        main.backfill_user_stats(conn)
+        main.recompute_ratings(conn)
+        return {
+            "users": conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+            "game_records": conn.execute("SELECT COUNT(*) FROM game_records").fetchone()[0],
+            "user_items": conn.execute("SELECT COUNT(*) FROM user_items").fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--games", type=int, default=50, help="每个用户的平均比赛记录数")
+    parser.add_argument("--items", type=int, default=4, help="每个用户的平均已购物品数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = load_app(args.db)
+    started = time.perf_counter()
+    counts = seed_database(app, args.db, args.users, args.games, args.items, args.seed)
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# 购买/装备并发压力测试：验证没有重复扣款、重复物品或丢失更新，并测量争用下的吞吐量
+#
+#   python benchmarks/stress_purchase.py --users 8 --copies 4 --rounds 3
+#
+# 每个用户的积分只够买下部分物品；每件物品同时发出 --copies 个购买请求，并夹杂装备请求。
+# 结束后逐个用户核对：余额 = 初始积分 - 已拥有物品价格之和 >= 0，每种类型最多装备一件；没有任何购买成功时同样以非零状态退出。
+# --legacy 使用改造前“先读后写”的实现作对照。
+import argparse
+import asyncio
+import json
+import random
+
+import httpx
+
+from common import Timer, auth_headers, load_app
+
+START_POINTS = 1500
+
+
+def legacy_purchase(main):
+    # 改造前的实现：延迟事务中先查询再更新；参数和返回值与 main._purchase_item 保持一致，路由才能照常处理
+    def _purchase_item(conn, user_id, purchase, item_name, item_price, claim=None):
+        cursor = conn.cursor()
+        main._claim_idempotency_key(cursor, claim)
+        cursor.execute(
+            "SELECT id FROM user_items WHERE user_id = ? AND item_id = ? AND item_type = ?",
+            (user_id, purchase.item_id, purchase.item_type)
+        )
+        if cursor.fetchone():
+            raise main.HTTPException(status_code=400, detail="您已拥有该物品")
+        cursor.execute("SELECT current_points, total_points FROM users WHERE id = ?", (user_id,))
+        current_points, total_points = cursor.fetchone()
+        if current_points < item_price:
+            raise main.HTTPException(status_code=400, detail="积分不足")
+        cursor.execute("UPDATE users SET current_points = current_points - ? WHERE id = ?", (item_price, user_id))
+        cursor.execute(
+            "INSERT INTO user_items (user_id, item_type, item_id, item_name) VALUES (?, ?, ?, ?)",
+            (user_id, purchase.item_type, purchase.item_id, item_name)
+        )
+        result = {
+            "message": "购买成功",
+            "item_name": item_name,
+            "price": item_price,
+            "remaining_points": current_points - item_price,
+            "total_points": total_points
+        }
+        main._save_idempotency_key(cursor, claim, result)
+        conn.commit()
+        return result
+    return _purchase_item
+
+
+def check_invariants(main, user_ids, prices):
+    conn = main.db_pool.acquire()
+    try:
+        problems = []
+        for user_id in user_ids:
+            points = conn.execute("SELECT current_points FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+            owned = conn.execute("SELECT item_id FROM user_items WHERE user_id = ?", (user_id,)).fetchall()
+            spent = sum(prices[item_id] for (item_id,) in owned)
+            if len(owned) != len(set(owned)):
+                problems.append(f"user {user_id}: duplicate items")
+            if points != START_POINTS - spent or points < 0:
+                problems.append(f"user {user_id}: points {points}, expected {START_POINTS - spent}")
+            equipped = conn.execute(
+                "SELECT item_type, COUNT(*) FROM user_items WHERE user_id = ? AND is_equipped GROUP BY item_type HAVING COUNT(*) > 1",
+                (user_id,)
+            ).fetchall()
+            if equipped:
+                problems.append(f"user {user_id}: multiple equipped {equipped}")
+        return problems
+    finally:
+        main.db_pool.release(conn)
+
+
+async def run(args):
+    main = load_app(PASSWORD_HASH_ROUNDS=4)
+    if args.legacy:
+        main._purchase_item = legacy_purchase(main)
+    await main.startup_event()
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://stress", timeout=60) as client:
+        items = (await client.get("/api/shop/items")).json()["items"]
+        prices = {item["id"]: item["price"] for item in items}
+        users = []
+        for i in range(args.users):
+            resp = await client.post("/api/auth/register", json={"username": f"buyer{i}", "email": f"buyer{i}@stress.local", "password": "stress"})
+            users.append((resp.json()["user"]["id"], auth_headers(resp.json()["token"])))
+
+        counts = {}
+        report = {"mode": "legacy" if args.legacy else "atomic", "rounds": []}
+        for _ in range(args.rounds):
+            # 每轮重置积分与背包，保证每轮都有争用
+            conn = main.db_pool.acquire()
+            try:
+                conn.execute("DELETE FROM user_items")
+                conn.execute("UPDATE users SET current_points = ?", (START_POINTS,))
+                conn.commit()
+            finally:
+                main.db_pool.release(conn)
+
+            async def send(method, path, body, headers):
+                resp = await client.request(method, path, json=body, headers=headers)
+                key = f"{method} {path} {resp.status_code}"
+                counts[key] = counts.get(key, 0) + 1
+
+            requests = []
+            for _, headers in users:
+                for item in items:
+                    body = {"item_id": item["id"], "item_type": item["type"]}
+                    requests += [("POST", "/api/shop/purchase", body, headers)] * args.copies
+                    requests.append(("PUT", "/api/shop/equip", body, headers))
+            rng.shuffle(requests)
+            with Timer() as t:
+                await asyncio.gather(*(send(*request) for request in requests))
+            report["rounds"].append({"requests": len(requests), "seconds": round(t.elapsed, 3), "requests_per_sec": round(len(requests) / t.elapsed, 1)})
+
+        report["status_counts"] = dict(sorted(counts.items()))
+        report["purchases_succeeded"] = sum(count for key, count in counts.items() if key.startswith("POST ") and key.endswith(" 200"))
+        report["invariant_violations"] = check_invariants(main, [user_id for user_id, _ in users], prices)
+        report["busy_retries"] = main.metrics.busy_retries
+    await main.shutdown_event()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--copies", type=int, default=4, help="每件物品同时发出的购买请求数")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--legacy", action="store_true")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    # 没有任何购买成功时不变量检查没有可核对的数据，同样视为失败
+    if report["invariant_violations"] or not report["purchases_succeeded"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
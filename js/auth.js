@@ -9,6 +9,15 @@ class AuthManager {
         // 事件监听器
         this.onAuthChange = [];
         this.onPointsChange = [];
+        this.onLeaderboardChange = [];
+
+        // 服务端推送：余额和排行榜前几名的变化
+        this.eventSource = null;
+        this.pushReconnectTimer = null;
+        this.leaderboardTop = null;
+        if (this.isLoggedIn) {
+            this.connectPush();
+        }
     }
     
     getBaseURL() {
@@ -31,6 +40,11 @@ class AuthManager {
         this.onPointsChange.push(callback);
     }
     
+    // 添加排行榜推送监听器
+    addLeaderboardChangeListener(callback) {
+        this.onLeaderboardChange.push(callback);
+    }
+    
     // 触发认证状态变化事件
     triggerAuthChange() {
         this.onAuthChange.forEach(callback => callback(this.isLoggedIn, this.user));
@@ -41,6 +55,104 @@ class AuthManager {
         this.onPointsChange.forEach(callback => callback(this.user?.current_points || 0));
     }
     
+    // 触发排行榜变化事件
+    triggerLeaderboardChange() {
+        this.onLeaderboardChange.forEach(callback => callback(this.leaderboardTop));
+    }
+    
+    // 建立推送连接：积分和排行榜变化时由服务端主动推送，不再轮询
+    async connectPush() {
+        this.disconnectPush();
+        if (!this.token || typeof EventSource === 'undefined') {
+            return;
+        }
+        
+        // EventSource 无法设置请求头：先用 token 换一张一次性票据，token 不会出现在 URL 中
+        const token = this.token;
+        let ticket;
+        try {
+            const response = await fetch(`${this.baseURL}/api/push/ticket`, {
+                method: 'POST',
+                headers: this.getAuthHeaders()
+            });
+            if (!response.ok) {
+                return;
+            }
+            ticket = (await response.json()).ticket;
+        } catch (error) {
+            this.schedulePushReconnect(token);
+            return;
+        }
+        // 换票期间已登出或重新登录
+        if (this.token !== token || this.eventSource) {
+            return;
+        }
+        
+        const source = new EventSource(`${this.baseURL}/api/push/stream?ticket=${encodeURIComponent(ticket)}`);
+        
+        source.addEventListener('balance', (event) => {
+            const data = JSON.parse(event.data);
+            if (!this.user) {
+                return;
+            }
+            this.user.current_points = data.current_points;
+            this.user.total_points = data.total_points;
+            localStorage.setItem('user_data', JSON.stringify(this.user));
+            this.triggerPointsChange();
+        });
+        
+        // 连接后先收到完整的前几名，之后只收到有变化的名次
+        source.addEventListener('leaderboard', (event) => {
+            this.leaderboardTop = JSON.parse(event.data).top;
+            this.triggerLeaderboardChange();
+        });
+        
+        source.addEventListener('leaderboard_diff', (event) => {
+            const data = JSON.parse(event.data);
+            if (!this.leaderboardTop) {
+                return;
+            }
+            const top = this.leaderboardTop.slice(0, data.size);
+            data.changes.forEach(entry => {
+                top[entry.rank - 1] = entry;
+            });
+            this.leaderboardTop = top;
+            this.triggerLeaderboardChange();
+        });
+        
+        // token过期或已登出：停止自动重连
+        source.addEventListener('expired', () => this.disconnectPush());
+        
+        // 票据只能使用一次，EventSource 自带的重连必然失败：关闭后换新票据重连
+        source.onerror = () => {
+            if (this.eventSource === source) {
+                this.disconnectPush();
+                this.schedulePushReconnect(token);
+            }
+        };
+        
+        this.eventSource = source;
+    }
+    
+    // 稍后重新建立推送连接，期间 token 变化（登出或换号）则放弃
+    schedulePushReconnect(token) {
+        clearTimeout(this.pushReconnectTimer);
+        this.pushReconnectTimer = setTimeout(() => {
+            if (this.token === token && !this.eventSource) {
+                this.connectPush();
+            }
+        }, 3000);
+    }
+    
+    // 断开推送连接
+    disconnectPush() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
+        this.leaderboardTop = null;
+    }
+    
     // 设置认证信息
     setAuth(token, userData) {
         this.token = token;
@@ -50,6 +162,7 @@ class AuthManager {
         localStorage.setItem('auth_token', token);
         localStorage.setItem('user_data', JSON.stringify(userData));
         
+        this.connectPush();
         this.triggerAuthChange();
         this.triggerPointsChange();
     }
@@ -63,6 +176,7 @@ class AuthManager {
         localStorage.removeItem('auth_token');
         localStorage.removeItem('user_data');
         
+        this.disconnectPush();
         this.triggerAuthChange();
         this.triggerPointsChange();
     }
@@ -75,6 +189,37 @@ class AuthManager {
         };
     }
     
+    // 生成幂等键：同一次操作的所有重试使用同一个键，服务端只会执行一次
+    createIdempotencyKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+    
+    // 带幂等键的写请求：网络错误或服务端错误时用同一个键重试，
+    // 上一次其实已经成功时服务端直接返回当时的结果，不会重复加积分或重复购买
+    async postIdempotent(path, body, retries = 2) {
+        const headers = { ...this.getAuthHeaders(), 'Idempotency-Key': this.createIdempotencyKey() };
+        for (let attempt = 0; ; attempt++) {
+            try {
+                const response = await fetch(`${this.baseURL}${path}`, {
+                    method: 'POST',
+                    headers,
+                    body: JSON.stringify(body)
+                });
+                if (response.status < 500 || attempt >= retries) {
+                    return response;
+                }
+            } catch (error) {
+                if (attempt >= retries) {
+                    throw error;
+                }
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+        }
+    }
+    
     // 用户注册
     async register(username, email, password) {
         try {
@@ -123,6 +268,13 @@ class AuthManager {
     
     // 用户登出
     logout() {
+        // 通知服务端吊销当前token，无需等待结果
+        if (this.token) {
+            fetch(`${this.baseURL}/api/auth/logout`, {
+                method: 'POST',
+                headers: this.getAuthHeaders()
+            }).catch(() => {});
+        }
         this.clearAuth();
         return { success: true, message: '已成功登出' };
     }
@@ -158,6 +310,42 @@ class AuthManager {
         }
     }
     
+    // 登录后一次请求获取资料、积分、背包、装备和统计，include 可选择只取部分数据
+    async bootstrap(include = null) {
+        if (!this.isLoggedIn) {
+            return { success: false, message: '请先登录' };
+        }
+
+        try {
+            const url = include
+                ? `${this.baseURL}/api/me/bootstrap?include=${include.join(',')}`
+                : `${this.baseURL}/api/me/bootstrap`;
+            const response = await fetch(url, {
+                headers: this.getAuthHeaders()
+            });
+
+            const data = await response.json();
+
+            if (!response.ok) {
+                if (response.status === 401) {
+                    this.clearAuth();
+                }
+                throw new Error(data.detail || '获取用户数据失败');
+            }
+
+            if (data.user) {
+                this.user = data.user;
+                localStorage.setItem('user_data', JSON.stringify(data.user));
+                this.triggerPointsChange();
+            }
+
+            return { success: true, ...data };
+        } catch (error) {
+            console.error('获取用户数据错误:', error);
+            return { success: false, message: error.message };
+        }
+    }
+
     // 获取积分余额
     async getPointsBalance() {
         if (!this.isLoggedIn) {
@@ -189,11 +377,7 @@ class AuthManager {
         }
         
         try {
-            const response = await fetch(`${this.baseURL}/api/points/earn`, {
-                method: 'POST',
-                headers: this.getAuthHeaders(),
-                body: JSON.stringify(gameRecord)
-            });
+            const response = await this.postIdempotent('/api/points/earn', gameRecord);
             
             const data = await response.json();
             
@@ -216,6 +400,35 @@ class AuthManager {
         }
     }
     
+    // 批量提交离线期间缓存的游戏记录（每条记录可带 played_at 比赛时间）
+    async earnPointsBatch(gameRecords) {
+        if (!this.isLoggedIn) {
+            return { success: false, message: '请先登录以保存游戏记录' };
+        }
+        
+        try {
+            const response = await this.postIdempotent('/api/points/earn/batch', { records: gameRecords });
+            
+            const data = await response.json();
+            
+            if (!response.ok) {
+                throw new Error(data.detail || '记录积分失败');
+            }
+            
+            if (this.user) {
+                this.user.current_points = data.current_points;
+                this.user.total_points = data.total_points;
+                localStorage.setItem('user_data', JSON.stringify(this.user));
+                this.triggerPointsChange();
+            }
+            
+            return { success: true, ...data };
+        } catch (error) {
+            console.error('批量记录积分错误:', error);
+            return { success: false, message: error.message };
+        }
+    }
+    
     // 获取积分历史
     async getPointsHistory(limit = 20) {
         if (!this.isLoggedIn) {
@@ -240,10 +453,14 @@ class AuthManager {
         }
     }
     
-    // 获取排行榜
-    async getLeaderboard(limit = 10) {
+    // 获取排行榜：sort 为 'rating' 时按指定 game_type 的技术评分排序
+    async getLeaderboard(limit = 10, sort = 'points', gameType = null) {
         try {
-            const response = await fetch(`${this.baseURL}/api/points/leaderboard?limit=${limit}`);
+            let url = `${this.baseURL}/api/points/leaderboard?limit=${limit}`;
+            if (sort === 'rating') {
+                url += `&sort=rating&game_type=${encodeURIComponent(gameType)}`;
+            }
+            const response = await fetch(url);
             
             const data = await response.json();
             
@@ -258,6 +475,30 @@ class AuthManager {
         }
     }
     
+    // 获取当前用户各 game_type 的技术评分
+    async getRating() {
+        if (!this.isLoggedIn) {
+            return { success: false, message: '请先登录' };
+        }
+        
+        try {
+            const response = await fetch(`${this.baseURL}/api/game/rating`, {
+                headers: this.getAuthHeaders()
+            });
+            
+            const data = await response.json();
+            
+            if (!response.ok) {
+                throw new Error(data.detail || '获取评分失败');
+            }
+            
+            return { success: true, ...data };
+        } catch (error) {
+            console.error('获取评分错误:', error);
+            return { success: false, message: error.message };
+        }
+    }
+    
     // 获取商店物品
     async getShopItems(itemType = null) {
         try {
@@ -286,11 +527,7 @@ class AuthManager {
         }
         
         try {
-            const response = await fetch(`${this.baseURL}/api/shop/purchase`, {
-                method: 'POST',
-                headers: this.getAuthHeaders(),
-                body: JSON.stringify({ item_id: itemId, item_type: itemType })
-            });
+            const response = await this.postIdempotent('/api/shop/purchase', { item_id: itemId, item_type: itemType });
             
             const data = await response.json();
             
@@ -361,7 +598,31 @@ class AuthManager {
             return { success: false, message: error.message };
         }
     }
-    
+
+    // 获取当前装备的属性加成
+    async getLoadout() {
+        if (!this.isLoggedIn) {
+            return { success: false, message: '请先登录' };
+        }
+
+        try {
+            const response = await fetch(`${this.baseURL}/api/shop/loadout`, {
+                headers: this.getAuthHeaders()
+            });
+
+            const data = await response.json();
+
+            if (!response.ok) {
+                throw new Error(data.detail || '获取装备加成失败');
+            }
+
+            return { success: true, items: data.items, bonuses: data.bonuses };
+        } catch (error) {
+            console.error('获取装备加成错误:', error);
+            return { success: false, message: error.message };
+        }
+    }
+
     // 获取游戏统计
     async getGameStats() {
         if (!this.isLoggedIn) {
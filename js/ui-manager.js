@@ -29,6 +29,14 @@ class UIManager {
                     this.updatePointsDisplay(points);
                 });
                 
+                // 排行榜打开时随推送实时更新
+                this.authManager.addLeaderboardChangeListener((leaderboard) => {
+                    const container = document.getElementById('leaderboardList');
+                    if (leaderboard && container && this.currentModal?.id === 'leaderboardModal') {
+                        this.renderLeaderboard(container, leaderboard);
+                    }
+                });
+                
                 // 初始化显示
                 this.updateUserPanel(this.authManager.isLoggedIn, this.authManager.user);
             }
@@ -550,41 +558,52 @@ class UIManager {
         this.showModal(modal);
         
         const container = document.getElementById('leaderboardList');
+        
+        // 已通过推送拿到前几名时直接显示，不再请求
+        if (this.authManager.leaderboardTop) {
+            this.renderLeaderboard(container, this.authManager.leaderboardTop);
+            return;
+        }
+        
         container.innerHTML = '<div class="loading">加载中...</div>';
         
         const result = await this.authManager.getLeaderboard();
         
         if (result.success) {
-            if (result.leaderboard.length === 0) {
-                container.innerHTML = '<div class="empty">暂无排行数据</div>';
-                return;
-            }
-            
-            container.innerHTML = `
-                <div class="leaderboard-header">
-                    <div class="rank">排名</div>
-                    <div class="username">用户名</div>
-                    <div class="points">总积分</div>
-                    <div class="games">游戏场次</div>
-                    <div class="winrate">胜率</div>
-                </div>
-                ${result.leaderboard.map(user => `
-                    <div class="leaderboard-item ${user.username === this.authManager.user?.username ? 'current-user' : ''}">
-                        <div class="rank">
-                            ${user.rank <= 3 ? `<i class="fas fa-trophy rank-${user.rank}"></i>` : user.rank}
-                        </div>
-                        <div class="username">${user.username}</div>
-                        <div class="points">${user.total_points}</div>
-                        <div class="games">${user.games_played}</div>
-                        <div class="winrate">${user.win_rate}%</div>
-                    </div>
-                `).join('')}
-            `;
+            this.renderLeaderboard(container, result.leaderboard);
         } else {
             container.innerHTML = `<div class="error">加载失败: ${result.message}</div>`;
         }
     }
     
+    renderLeaderboard(container, leaderboard) {
+        if (leaderboard.length === 0) {
+            container.innerHTML = '<div class="empty">暂无排行数据</div>';
+            return;
+        }
+        
+        container.innerHTML = `
+            <div class="leaderboard-header">
+                <div class="rank">排名</div>
+                <div class="username">用户名</div>
+                <div class="points">总积分</div>
+                <div class="games">游戏场次</div>
+                <div class="winrate">胜率</div>
+            </div>
+            ${leaderboard.map(user => `
+                <div class="leaderboard-item ${user.username === this.authManager.user?.username ? 'current-user' : ''}">
+                    <div class="rank">
+                        ${user.rank <= 3 ? `<i class="fas fa-trophy rank-${user.rank}"></i>` : user.rank}
+                    </div>
+                    <div class="username">${user.username}</div>
+                    <div class="points">${user.total_points}</div>
+                    <div class="games">${user.games_played}</div>
+                    <div class="winrate">${user.win_rate}%</div>
+                </div>
+            `).join('')}
+        `;
+    }
+    
     getItemTypeText(type) {
         const typeMap = {
             'racket': '球拍',